@@ -0,0 +1,157 @@
+import asyncio
+import json
+import uuid
+from datetime import datetime
+from typing import Awaitable, Callable, Dict, Optional, Tuple
+
+from . import db as db_module
+from .config import (ADMIN_CACHE_MAX_STALE_SECONDS, ADMIN_CACHE_REFRESH_LOCK_SECONDS, ADMIN_CACHE_MISS_POLL_SECONDS,
+                     logger)
+
+# Пересчеты, выполняющиеся в этом процессе: одновременные промахи ждут один и тот же пересчет.
+_computations: Dict[str, asyncio.Task] = {}
+
+# Блокировку снимает только владелец: истекшую и перехваченную другим процессом блокировку удалять нельзя.
+_RELEASE_LOCK_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+
+def _cache_key(name: str) -> str:
+    return f"admin_cache:{name}"
+
+
+def _lock_key(name: str) -> str:
+    return f"admin_cache:{name}:refresh_lock"
+
+
+async def _acquire_refresh_lock(name: str) -> Tuple[bool, Optional[str]]:
+    """Блокировка пересчета в Redis: (получена ли, токен владельца). Без Redis пересчитываем без блокировки."""
+    redis_client = db_module.redis_client
+    if not redis_client:
+        return True, None
+    token = uuid.uuid4().hex
+    try:
+        acquired = await redis_client.set(_lock_key(name), token, nx=True, ex=ADMIN_CACHE_REFRESH_LOCK_SECONDS)
+    except Exception as e:
+        logger.warning(f"Не удалось взять блокировку пересчета {name}: {e}")
+        return True, None
+    return (True, token) if acquired else (False, None)
+
+
+async def _release_refresh_lock(name: str, token: str):
+    try:
+        await db_module.redis_client.eval(_RELEASE_LOCK_SCRIPT, 1, _lock_key(name), token)
+    except Exception:
+        pass
+
+
+async def _compute_and_store(name: str, compute: Callable[[], Awaitable], ttl_seconds: int,
+                             lock_token: Optional[str]) -> dict:
+    redis_client = db_module.redis_client
+    try:
+        entry = {"computed_at": datetime.now().isoformat(timespec="seconds"), "data": await compute()}
+        if redis_client:
+            try:
+                await redis_client.set(_cache_key(name), json.dumps(entry, default=str),
+                                       ex=ttl_seconds + ADMIN_CACHE_MAX_STALE_SECONDS)
+            except Exception as e:
+                logger.warning(f"Не удалось сохранить {name} в кеш статистики: {e}")
+        return entry
+    finally:
+        if lock_token:
+            await _release_refresh_lock(name, lock_token)
+
+
+async def _wait_for_entry(name: str) -> Optional[dict]:
+    """Ждет значение, которое пересчитывает другой процесс. None, если блокировка снята или истекла без записи
+    (пересчет в другом процессе упал) - тогда пересчитываем сами."""
+    redis_client = db_module.redis_client
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + ADMIN_CACHE_REFRESH_LOCK_SECONDS
+    while loop.time() < deadline:
+        await asyncio.sleep(ADMIN_CACHE_MISS_POLL_SECONDS)
+        try:
+            pipe = redis_client.pipeline(transaction=False)
+            pipe.get(_cache_key(name))
+            pipe.exists(_lock_key(name))
+            raw, locked = await pipe.execute()
+        except Exception as e:
+            logger.warning(f"Не удалось прочитать {name} из кеша статистики: {e}")
+            return None
+        if raw:
+            return json.loads(raw)
+        if not locked:
+            return None
+    return None
+
+
+def _log_failure(name: str, task: asyncio.Task):
+    _computations.pop(name, None)
+    if not task.cancelled() and task.exception():
+        logger.error(f"Ошибка пересчета {name} для кеша статистики: {task.exception()}")
+
+
+def _single_flight(name: str, compute: Callable[[], Awaitable], ttl_seconds: int,
+                   lock_token: Optional[str]) -> asyncio.Task:
+    task = _computations.get(name)
+    if task is None:
+        task = asyncio.create_task(_compute_and_store(name, compute, ttl_seconds, lock_token))
+        _computations[name] = task
+        task.add_done_callback(lambda done: _log_failure(name, done))
+    return task
+
+
+async def get_cached(name: str, compute: Callable[[], Awaitable], ttl_seconds: int) -> Tuple[dict, str]:
+    """Возвращает запись {"computed_at", "data"} и ее состояние: fresh, stale (пересчет запущен в фоне) или miss.
+    Устаревшее значение отдается до ADMIN_CACHE_MAX_STALE_SECONDS после TTL. Пересчитывает только процесс,
+    получивший блокировку в Redis; при промахе остальные процессы ждут сохраненное им значение."""
+    redis_client = db_module.redis_client
+    raw = None
+    if redis_client:
+        try:
+            raw = await redis_client.get(_cache_key(name))
+        except Exception as e:
+            logger.warning(f"Не удалось прочитать {name} из кеша статистики: {e}")
+
+    if raw:
+        entry = json.loads(raw)
+        age_seconds = (datetime.now() - datetime.fromisoformat(entry["computed_at"])).total_seconds()
+        if age_seconds <= ttl_seconds:
+            return entry, "fresh"
+        if name not in _computations:
+            _, lock_token = await _acquire_refresh_lock(name)
+            if lock_token:
+                _single_flight(name, compute, ttl_seconds, lock_token)
+        return entry, "stale"
+
+    waited = False
+    while True:
+        task = _computations.get(name)
+        if task is not None:
+            break
+        acquired, lock_token = await _acquire_refresh_lock(name)
+        if name in _computations:
+            # Пока брали блокировку, пересчет запустил другой запрос этого процесса.
+            if lock_token:
+                await _release_refresh_lock(name, lock_token)
+            continue
+        if acquired or waited:
+            # После одного ожидания пересчитываем и без блокировки, чтобы запрос не ждал бесконечно.
+            task = _single_flight(name, compute, ttl_seconds, lock_token)
+            break
+        entry = await _wait_for_entry(name)
+        if entry is not None:
+            return entry, "miss"
+        waited = True
+    # Отмена одного ожидающего запроса не должна прерывать пересчет, который ждут остальные.
+    entry = await asyncio.shield(task)
+    return entry, "miss"
+
+
+async def invalidate_cached(*names: str):
+    if db_module.redis_client:
+        await db_module.redis_client.delete(*(_cache_key(name) for name in names))
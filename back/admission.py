@@ -0,0 +1,59 @@
+import math
+from datetime import datetime, timedelta
+from typing import Optional, Tuple
+
+from fastapi import HTTPException
+
+from .config import (REQUESTS_PER_MINUTE_LIMIT, GEMINI_MAX_CONCURRENT_PER_KEY, GEMINI_DEFAULT_LATENCY_SECONDS,
+                     logger)
+from .key_health import CIRCUIT_OPEN
+from .quota import get_quota_snapshot
+from .scheduler import cluster_queue_depth
+
+
+def _seconds_until_tomorrow() -> int:
+    now = datetime.now()
+    tomorrow = datetime.combine(now.date() + timedelta(days=1), datetime.min.time())
+    return math.ceil((tomorrow - now).total_seconds())
+
+
+async def estimate_wait_seconds(calls_needed: int) -> Tuple[float, int]:
+    """Оценивает, через сколько секунд будут получены результаты calls_needed вызовов, исходя из очереди за квотой
+    всех процессов, оставшихся токенов минутной квоты и наблюдаемой задержки ключей.
+    Возвращает (оценка, остаток дневной квоты)."""
+    snapshot = await get_quota_snapshot()
+    usable = [key for key in snapshot
+              if key["health"]["circuit"] != CIRCUIT_OPEN and key["daily_requests_remaining"] > 0]
+    daily_remaining = sum(key["daily_requests_remaining"] for key in usable)
+    if not usable:
+        return math.inf, daily_remaining
+
+    latencies = [key["health"]["latency_ewma_seconds"] or GEMINI_DEFAULT_LATENCY_SECONDS for key in usable]
+    # Пропускная способность ключа ограничена и минутной квотой, и числом одновременных вызовов.
+    calls_per_second = sum(min(REQUESTS_PER_MINUTE_LIMIT / 60, GEMINI_MAX_CONCURRENT_PER_KEY / latency)
+                           for latency in latencies)
+    ready_now = sum(key["minute_requests_remaining"] for key in usable)
+    backlog = max(0, await cluster_queue_depth() + calls_needed - ready_now)
+    return backlog / calls_per_second + sum(latencies) / len(latencies), daily_remaining
+
+
+async def check_admission(calls_needed: int, max_wait_seconds: Optional[float] = None) -> float:
+    """Отклоняет генерацию с 429 и Retry-After, если ожидание квоты превысит max_wait_seconds (None - не
+    проверять) или дневной квоты не хватит на calls_needed вызовов. Возвращает оценку ожидания в секундах."""
+    try:
+        estimate, daily_remaining = await estimate_wait_seconds(calls_needed)
+    except Exception as e:
+        # Без оценки не отказываем: дальше запрос все равно ограничен ожиданием квоты в reserve_key.
+        logger.warning(f"Не удалось оценить ожидание квоты Gemini: {e}")
+        return 0.0
+
+    if daily_remaining < calls_needed:
+        logger.warning(f"Генерация отклонена: дневной квоты осталось {daily_remaining} вызовов")
+        raise HTTPException(status_code=429, detail="Дневной лимит генераций исчерпан, попробуйте завтра",
+                            headers={"Retry-After": str(_seconds_until_tomorrow())})
+    if max_wait_seconds is not None and estimate > max_wait_seconds:
+        retry_after = max(5, math.ceil(estimate - max_wait_seconds)) if math.isfinite(estimate) else 60
+        logger.warning(f"Генерация отклонена: ожидаемое время {estimate:.1f} с превышает {max_wait_seconds} с")
+        raise HTTPException(status_code=429, detail="Сервис перегружен, попробуйте позже",
+                            headers={"Retry-After": str(retry_after)})
+    return estimate
@@ -0,0 +1,32 @@
+import hashlib
+import re
+from typing import Optional
+
+from fastapi import HTTPException
+
+from . import db as db_module
+from .config import BLOB_TTL_SECONDS, logger
+
+BLOB_ID_PATTERN = re.compile(r"^[0-9a-f]{64}$")
+
+
+def _blob_key(blob_id: str) -> str:
+    return f"blob:{blob_id}"
+
+
+async def put_blob(data: bytes, ttl_seconds: int = BLOB_TTL_SECONDS) -> str:
+    if not db_module.redis_blob_client:
+        logger.error("Клиент Redis не инициализирован. Хранилище изображений недоступно.")
+        raise HTTPException(status_code=503, detail="Сервис временно недоступен (Redis)")
+    blob_id = hashlib.sha256(data).hexdigest()
+    await db_module.redis_blob_client.set(_blob_key(blob_id), data, ex=ttl_seconds)
+    return blob_id
+
+
+async def get_blob(blob_id: str) -> Optional[bytes]:
+    if not BLOB_ID_PATTERN.match(blob_id):
+        return None
+    if not db_module.redis_blob_client:
+        logger.error("Клиент Redis не инициализирован. Хранилище изображений недоступно.")
+        raise HTTPException(status_code=503, detail="Сервис временно недоступен (Redis)")
+    return await db_module.redis_blob_client.get(_blob_key(blob_id))
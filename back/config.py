@@ -29,6 +29,76 @@ NUM_KEYS = len(GEMINI_API_KEYS)
 
 REQUESTS_PER_MINUTE_LIMIT = 9
 REQUESTS_PER_DAY_LIMIT = 1400
+GEMINI_MODEL_NAME = "gemini-1.5-flash-latest"
+GEMINI_HEALTH_CHECK_TIMEOUT_SECONDS = 10
+GEMINI_MAX_CONCURRENT_PER_KEY = 2
+# Сколько изображений запрашивать за один вызов (candidate_count). 1 - по вызову на изображение.
+GEMINI_CANDIDATES_PER_CALL = int(os.getenv("GEMINI_CANDIDATES_PER_CALL", "1"))
+GEMINI_KEY_WAIT_TIMEOUT_SECONDS = 120
+GEMINI_QUOTA_MAX_BLOCK_SECONDS = 5
+GEMINI_LATENCY_EWMA_ALPHA = 0.2
+GEMINI_LATENCY_WINDOW = 50
+GEMINI_DEFAULT_LATENCY_SECONDS = 15
+GEMINI_CIRCUIT_FAILURE_THRESHOLD = 3
+GEMINI_CIRCUIT_ERROR_RATE_THRESHOLD = 0.5
+GEMINI_CIRCUIT_OPEN_SECONDS = 60
+GEMINI_HEDGING_ENABLED = True
+GEMINI_HEDGE_LATENCY_PERCENTILE = 0.9
+GEMINI_HEDGE_MIN_DELAY_SECONDS = 5
+GEMINI_HEDGE_MIN_SAMPLES = 20
+# Доля суммарной дневной квоты всех ключей, которую можно потратить на дублирующие вызовы.
+GEMINI_HEDGE_BUDGET_PERCENT = 5
+GENERATION_MAX_CONCURRENT_PER_CHAT = 1
+GENERATION_CHAT_SLOT_TTL_SECONDS = 60 * 10
+# Сколько бонусные изображения ждут квоту, прежде чем от них откажутся в пользу основных.
+GENERATION_BONUS_WAIT_SECONDS = 20
+# Оценка ожидания квоты, сверх которой новая генерация отклоняется с 429 и Retry-After.
+GENERATION_ADMISSION_MAX_WAIT_SECONDS = 90
+# Предельное время генерации на сервере - меньше таймаута запроса бота (300 с), чтобы успеть вернуть ответ.
+GENERATION_DEADLINE_SECONDS = 240
+GENERATION_DISCONNECT_POLL_SECONDS = 1
+
+GENERATION_JOBS_STREAM = "generation_jobs"
+GENERATION_JOBS_GROUP = "generation_workers"
+GENERATION_JOB_CLAIM_IDLE_SECONDS = 60 * 10
+# Оценка ожидания квоты, сверх которой задача очереди отклоняется с 429 (допуск мягче, чем у синхронной генерации).
+GENERATION_JOB_ADMISSION_MAX_WAIT_SECONDS = 60 * 20
+# Срок хранения задачи и слота чата: с запасом больше допустимого ожидания, переназначения зависшей записи
+# и времени самой генерации. Списание хранится и в записи потока, поэтому возвращается даже после истечения.
+GENERATION_JOB_TTL_SECONDS = 60 * 60
+BLOB_TTL_SECONDS = 60 * 30
+GENERATION_WORKER_CONCURRENCY = int(os.getenv("GENERATION_WORKER_CONCURRENCY", "4"))
+IMAGE_MAX_DIMENSION = 1024
+IMAGE_JPEG_QUALITY = 85
+IMAGE_PREPROCESS_WORKERS = 2
+GENERATION_CACHE_ENABLED = True
+GENERATION_CACHE_TTL_SECONDS = 60 * 60 * 24 * 7
+# Суммарный размер сохраненных изображений, сверх которого записи вытесняются по LRU.
+GENERATION_CACHE_MAX_BYTES = 512 * 1024 * 1024
+# Списывать ли оживашку, если все изображения взяты из кеша без обращений к Gemini. По умолчанию нет:
+# повтор того же рисунка не расходует квоту, и пользователь не должен платить за уже полученный результат.
+GENERATION_CACHE_BILL_HITS = os.getenv("GENERATION_CACHE_BILL_HITS", "false").lower() == "true"
+# Сколько последних идентификаторов операций с балансом хранить в документе пользователя для защиты от повторов.
+BALANCE_LEDGER_OPS_KEPT = 50
+# Время последней активности копится в памяти процесса и записывается в MongoDB пачкой.
+ACTIVITY_FLUSH_INTERVAL_SECONDS = 10
+ACTIVITY_BUFFER_MAX_ENTRIES = 5000
+USER_PROFILE_CACHE_TTL_SECONDS = 30
+# Заявка на миграцию схемы, не завершенная за это время (процесс упал), может быть перехвачена другим процессом.
+MIGRATION_CLAIM_TIMEOUT_SECONDS = 60 * 60
+# Удаление прежнего словаря users.yookassa_payments (миграция 4). Включать только после того, как все сервисы
+# читают платежи из коллекции payments и миграция 3 завершилась без расхождений.
+DROP_LEGACY_USER_PAYMENTS = os.getenv("DROP_LEGACY_USER_PAYMENTS", "false").lower() == "true"
+# Кеш админских эндпоинтов статистики: после TTL отдается устаревшее значение, пока идет пересчет в фоне.
+STATS_CACHE_TTL_SECONDS = int(os.getenv("STATS_CACHE_TTL_SECONDS", "60"))
+SOURCE_STATISTICS_CACHE_TTL_SECONDS = int(os.getenv("SOURCE_STATISTICS_CACHE_TTL_SECONDS", "60"))
+API_KEY_LIMITS_CACHE_TTL_SECONDS = int(os.getenv("API_KEY_LIMITS_CACHE_TTL_SECONDS", "5"))
+ADMIN_CACHE_MAX_STALE_SECONDS = 60 * 10
+ADMIN_CACHE_REFRESH_LOCK_SECONDS = 30
+# Как часто процесс без блокировки пересчета проверяет, не сохранил ли значение другой процесс.
+ADMIN_CACHE_MISS_POLL_SECONDS = 0.2
+# Блокировка пересчета сводок статистики (один пересчет на все процессы).
+STATS_ROLLUPS_REBUILD_LOCK_SECONDS = 60 * 30
 
 GENERATION_PROMPT = ("Bring this child's drawing to life as a detailed digital painting. "
                      "Maintain the core design, whimsical elements, and composition from the original drawing, "
@@ -1,32 +1,173 @@
+import asyncio
 from datetime import datetime
-from typing import Optional
+from typing import Dict, Optional
 
+import redis.asyncio as redis_async
+from bson import json_util
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import UpdateOne
 
-from .config import MONGO_URI, MONGO_DB_NAME, logger
+from .config import (MONGO_URI, MONGO_DB_NAME, REDIS_URL, ACTIVITY_FLUSH_INTERVAL_SECONDS, ACTIVITY_BUFFER_MAX_ENTRIES,
+                     USER_PROFILE_CACHE_TTL_SECONDS, logger)
 
 if MONGO_URI and MONGO_DB_NAME:
     client = AsyncIOMotorClient(MONGO_URI)
     db = client[MONGO_DB_NAME]
     users_collection = db.users
     advertising_sources_collection = db.advertising_sources
+    payments_collection = db.payments
+    balance_ledger_collection = db.balance_ledger
+    stats_rollups_collection = db.stats_rollups
 else:
     logger.error("MONGO_URI или MONGO_DB_NAME не установлены. Функциональность базы данных будет нарушена.")
     client = None
     db = None
     users_collection = None
     advertising_sources_collection = None
+    payments_collection = None
+    balance_ledger_collection = None
+    stats_rollups_collection = None
+
+# Кеш профилей пользователей: история платежей и служебные поля не кешируются и не отдаются.
+USER_PROFILE_PROJECTION = {"_id": 0, "yookassa_payments": 0, "ledger_ops": 0, "merged_duplicate_ids": 0}
+# Канонический формат сохраняет даты как даты; tz_aware=False - как и в ответах motor.
+_PROFILE_JSON_OPTIONS = json_util.CANONICAL_JSON_OPTIONS.with_options(tz_aware=False)
+# Счетчики этого процесса.
+_profile_cache_stats = {"hits": 0, "misses": 0, "invalidations": 0}
+
+# chat_id -> время последней активности, еще не записанное в базу.
+_pending_activity: Dict[int, datetime] = {}
+_flush_in_progress = asyncio.Lock()
+_pending_flushes = set()
 
 redis_client = None
+# Клиент без декодирования ответов - для хранения сырых байтов изображений.
+redis_blob_client = None
+
+
+async def connect_redis():
+    global redis_client, redis_blob_client
+    if not REDIS_URL:
+        logger.warning("REDIS_URL не указан. Функциональность, зависящая от Redis, будет ограничена.")
+        redis_client = None
+        redis_blob_client = None
+        return None
+    try:
+        redis_client = redis_async.from_url(REDIS_URL, decode_responses=True)
+        await redis_client.ping()
+        redis_blob_client = redis_async.from_url(REDIS_URL)
+        logger.info("Успешное подключение к Redis.")
+    except Exception as e:
+        logger.error(f"Не удалось подключиться к Redis: {e}", exc_info=True)
+        redis_client = None
+        redis_blob_client = None
+    return redis_client
+
+
+async def close_redis():
+    global redis_client, redis_blob_client
+    if redis_client:
+        await redis_client.close()
+    if redis_blob_client:
+        await redis_blob_client.close()
+    redis_client = None
+    redis_blob_client = None
+
+
+def _profile_key(chat_id: int) -> str:
+    return f"user_profile:{chat_id}"
 
 
 async def get_db_user(chat_id: int) -> Optional[dict]:
-    if users_collection:
-        user = await users_collection.find_one({"chat_id": chat_id})
-        return user
-    return None
+    """Профиль пользователя без истории платежей и служебных полей: из кеша Redis, при промахе - из MongoDB."""
+    if not users_collection:
+        return None
+    if redis_client:
+        try:
+            cached = await redis_client.get(_profile_key(chat_id))
+        except Exception as e:
+            logger.warning(f"Не удалось прочитать профиль {chat_id} из кеша: {e}")
+            cached = None
+        if cached:
+            _profile_cache_stats["hits"] += 1
+            return json_util.loads(cached, json_options=_PROFILE_JSON_OPTIONS)
+        _profile_cache_stats["misses"] += 1
+
+    user = await users_collection.find_one({"chat_id": chat_id}, USER_PROFILE_PROJECTION)
+    if user and redis_client:
+        try:
+            await redis_client.set(_profile_key(chat_id), json_util.dumps(user, json_options=_PROFILE_JSON_OPTIONS),
+                                   ex=USER_PROFILE_CACHE_TTL_SECONDS)
+        except Exception as e:
+            logger.warning(f"Не удалось сохранить профиль {chat_id} в кеш: {e}")
+    return user
+
+
+async def invalidate_user_profile(chat_id: int):
+    """Вызывается после каждого изменения документа пользователя."""
+    if not redis_client:
+        return
+    try:
+        await redis_client.delete(_profile_key(chat_id))
+        _profile_cache_stats["invalidations"] += 1
+    except Exception as e:
+        logger.error(f"Не удалось сбросить кеш профиля {chat_id}: {e}")
+
+
+async def invalidate_all_user_profiles():
+    """Для массовых изменений (update_many), после которых нельзя перечислить затронутых пользователей."""
+    if not redis_client:
+        return
+    batch = []
+    async for key in redis_client.scan_iter(match="user_profile:*", count=1000):
+        batch.append(key)
+        if len(batch) >= 1000:
+            await redis_client.unlink(*batch)
+            batch = []
+    if batch:
+        await redis_client.unlink(*batch)
+
+
+def get_user_profile_cache_stats() -> dict:
+    lookups = _profile_cache_stats["hits"] + _profile_cache_stats["misses"]
+    return {**_profile_cache_stats, "hit_rate": round(_profile_cache_stats["hits"] / lookups, 3) if lookups else None}
 
 
 async def update_last_activity(chat_id: int):
-    if users_collection:
-        await users_collection.update_one({"chat_id": chat_id}, {"$set": {"last_activity_time": datetime.now()}})
+    """Запоминает активность пользователя в буфере; в базу она попадает при следующей записи буфера."""
+    _pending_activity[chat_id] = datetime.now()
+    if len(_pending_activity) >= ACTIVITY_BUFFER_MAX_ENTRIES and not _flush_in_progress.locked():
+        task = asyncio.create_task(flush_activity())
+        _pending_flushes.add(task)
+        task.add_done_callback(_pending_flushes.discard)
+
+
+async def flush_activity():
+    """Записывает накопленные времена активности одним неупорядоченным bulk_write."""
+    global _pending_activity
+    async with _flush_in_progress:
+        if not _pending_activity or not users_collection:
+            return
+        pending, _pending_activity = _pending_activity, {}
+        # $max: не затирает более позднее время, уже записанное списанием генерации.
+        operations = [UpdateOne({"chat_id": chat_id}, {"$max": {"last_activity_time": active_at}})
+                      for chat_id, active_at in pending.items()]
+        try:
+            await users_collection.bulk_write(operations, ordered=False)
+        except Exception as e:
+            logger.error(f"Не удалось записать время активности {len(operations)} пользователей: {e}")
+            # Возвращаем в буфер то, что не было перезаписано более свежей активностью, не превышая лимит.
+            for chat_id, active_at in pending.items():
+                if len(_pending_activity) >= ACTIVITY_BUFFER_MAX_ENTRIES:
+                    break
+                _pending_activity.setdefault(chat_id, active_at)
+
+
+async def run_activity_flusher():
+    try:
+        while True:
+            await asyncio.sleep(ACTIVITY_FLUSH_INTERVAL_SECONDS)
+            await flush_activity()
+    except asyncio.CancelledError:
+        await flush_activity()
+        raise
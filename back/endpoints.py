@@ -1,12 +1,33 @@
+import asyncio
+import base64
+import json
 import uuid
-from datetime import datetime, timedelta
-
-from fastapi import APIRouter, File, Form, HTTPException, UploadFile, Depends
-
-from .config import logger, TELEGRAM_BOT_USERNAME, NUM_KEYS
-from .db import users_collection, get_db_user, update_last_activity, advertising_sources_collection, redis_client
-from .models import User, UserCreate, PaymentRequestBody, GenerationResponse, SourceCreate
-from .services import (get_api_key_dependency, generate_images_service, create_yookassa_payment_service)
+from contextlib import aclosing
+from datetime import datetime
+from typing import Optional
+
+from fastapi import APIRouter, File, Form, HTTPException, Request, UploadFile, Depends
+from fastapi.responses import Response, StreamingResponse
+
+from . import db as db_module
+from .config import (logger, TELEGRAM_BOT_USERNAME, GENERATION_DISCONNECT_POLL_SECONDS, STATS_CACHE_TTL_SECONDS,
+                     SOURCE_STATISTICS_CACHE_TTL_SECONDS, API_KEY_LIMITS_CACHE_TTL_SECONDS)
+from .db import (users_collection, get_db_user, update_last_activity, advertising_sources_collection,
+                 invalidate_user_profile, invalidate_all_user_profiles, get_user_profile_cache_stats)
+from .admin_cache import get_cached, invalidate_cached
+from .blobs import get_blob, put_blob
+from .gemini import check_all_clients, get_clients_status
+from .ledger import apply_balance_op, record_ledger_entry
+from .jobs import enqueue_generation_job, get_generation_job
+from .models import (User, UserSummary, UserCreate, PaymentRequestBody, GenerationDebit, GenerationResponse,
+                     SourceCreate, GenerationJobStatus)
+from .quota import get_quota_snapshot
+from .result_cache import get_cache_stats
+from .rollups import (DAY_MS, get_total_rollup, get_daily_rollups, get_source_rollups, rebuild_rollups,
+                      record_user_created, count_active_users)
+from .scheduler import get_queue_stats
+from .services import (get_api_key_dependency, generate_images_service, create_yookassa_payment_service,
+                       debit_generation, stream_generation, abort_generation)
 
 router = APIRouter()
 
@@ -52,7 +73,7 @@ async def create_user_endpoint(user_data: UserCreate):
                     "generation_count": 0, "last_generation_time": None, "registered_at": now,
                     "referral_code": f"ref_{user_data.chat_id}", "referred_by": None, "referral_bonus_claimed": False,
                     "first_generation_time": None, "daily_bonus_claimed_today": False, "daily_bonus_streak": 0,
-                    "discount_offered": False, "last_activity_time": now, "yookassa_payments": {}}
+                    "discount_offered": False, "last_activity_time": now, "has_successful_payment": False}
 
     if user_data.referral_code and user_data.referral_code.startswith("ref_"):
         try:
@@ -80,213 +101,180 @@ async def create_user_endpoint(user_data: UserCreate):
         logger.error(f"Не удалось добавить нового пользователя {user_data.chat_id} в базу данных")
         raise HTTPException(status_code=500, detail="Не удалось создать пользователя")
 
+    record_user_created(new_user_doc)
     logger.info(f"Пользователь создан: {user_data.chat_id} с 1 оживашкой. Username: {user_data.username}")
     new_user_doc.pop("_id", None)  # Ensure _id is not in the response if it was added by insert_one
     return User(**new_user_doc)
 
 
+def _set_freshness_headers(response: Response, entry: dict, cache_status: str):
+    response.headers["X-Computed-At"] = entry["computed_at"]
+    response.headers["X-Cache"] = cache_status
+
+
 @router.get("/api_key_limits", dependencies=[Depends(get_api_key_dependency)])
-async def get_api_key_limits_endpoint():
-    """Возвращает текущие лимиты использования для каждого API ключа Gemini."""
-    if not redis_client:
+async def get_api_key_limits_endpoint(response: Response):
+    """Возвращает текущие лимиты использования для каждого API ключа Gemini (кешируется на
+    API_KEY_LIMITS_CACHE_TTL_SECONDS, время расчета - в заголовке X-Computed-At)."""
+    if not db_module.redis_client:
         logger.warning("Запрос лимитов API ключей при недоступном Redis.")
         raise HTTPException(status_code=503, detail="Redis недоступен")
-    key_limits = []
-    for i in range(NUM_KEYS):
-        key_prefix = f"gemini_key:{i}"
-        try:
-            minute_requests_bytes = await redis_client.get(f"{key_prefix}:minute_requests")
-            daily_requests_bytes = await redis_client.get(f"{key_prefix}:daily_requests")
-            minute_requests_remaining = int(minute_requests_bytes) if minute_requests_bytes else 0
-            daily_requests_remaining = int(daily_requests_bytes) if daily_requests_bytes else 0
-            key_limits.append({"key_index": i, "minute_requests_remaining": minute_requests_remaining,
-                               "daily_requests_remaining": daily_requests_remaining})
-        except Exception as e:
-            logger.error(f"Ошибка получения лимитов для ключа {i}: {e}")
-            key_limits.append({"key_index": i, "error": str(e)})
-    return key_limits
+    try:
+        entry, cache_status = await get_cached("api_key_limits", get_quota_snapshot, API_KEY_LIMITS_CACHE_TTL_SECONDS)
+    except Exception as e:
+        logger.error(f"Ошибка получения лимитов API ключей: {e}")
+        raise HTTPException(status_code=500, detail="Не удалось получить лимиты API ключей")
+    _set_freshness_headers(response, entry, cache_status)
+    return entry["data"]
+
+
+@router.get("/gemini_clients", dependencies=[Depends(get_api_key_dependency)])
+async def get_gemini_clients_endpoint(check: bool = False):
+    """Возвращает состояние пула клиентов Gemini; при check=true выполняет проверку каждого ключа."""
+    if check:
+        return await check_all_clients()
+    return get_clients_status()
+
+
+@router.get("/generation_queue_stats", dependencies=[Depends(get_api_key_dependency)])
+async def get_generation_queue_stats_endpoint():
+    """Возвращает по классам приоритета глубину очереди за квотой (в этом процессе) и среднее время ожидания."""
+    if not db_module.redis_client:
+        logger.warning("Запрос статистики очереди генераций при недоступном Redis.")
+        raise HTTPException(status_code=503, detail="Redis недоступен")
+    try:
+        return await get_queue_stats()
+    except Exception as e:
+        logger.error(f"Ошибка получения статистики очереди генераций: {e}")
+        raise HTTPException(status_code=500, detail="Не удалось получить статистику очереди генераций")
+
+
+@router.get("/user_profile_cache_stats", dependencies=[Depends(get_api_key_dependency)])
+async def get_user_profile_cache_stats_endpoint():
+    """Возвращает счетчики кеша профилей пользователей (в этом процессе): попадания, промахи, сбросы."""
+    return get_user_profile_cache_stats()
+
+
+@router.get("/generation_cache_stats", dependencies=[Depends(get_api_key_dependency)])
+async def get_generation_cache_stats_endpoint():
+    """Возвращает статистику кеша генераций: попадания, промахи и сэкономленные вызовы Gemini."""
+    if not db_module.redis_client:
+        logger.warning("Запрос статистики кеша генераций при недоступном Redis.")
+        raise HTTPException(status_code=503, detail="Redis недоступен")
+    try:
+        return await get_cache_stats()
+    except Exception as e:
+        logger.error(f"Ошибка получения статистики кеша генераций: {e}")
+        raise HTTPException(status_code=500, detail="Не удалось получить статистику кеша генераций")
 
 
 @router.get("/stats", dependencies=[Depends(get_api_key_dependency)])
-async def get_stats_endpoint():
-    """Собирает и возвращает расширенную статистику по пользователям, генерациям и платежам."""
-    if not users_collection:
+async def get_stats_endpoint(response: Response):
+    """Собирает и возвращает расширенную статистику по пользователям, генерациям и платежам
+    (кешируется на STATS_CACHE_TTL_SECONDS, время расчета - в поле computed_at)."""
+    if not users_collection or db_module.stats_rollups_collection is None:
         logger.warning("Запрос статистики при недоступной коллекции пользователей")
         raise HTTPException(status_code=503, detail="Сервис базы данных недоступен")
+    entry, cache_status = await get_cached("stats", _compute_stats, STATS_CACHE_TTL_SECONDS)
+    _set_freshness_headers(response, entry, cache_status)
+    return {**entry["data"], "computed_at": entry["computed_at"]}
 
-    total_users = await users_collection.count_documents({})
-
-    pipeline_generations = [{"$group": {"_id": None, "total_generations": {"$sum": "$generation_count"}}}]
-    result_generations = await users_collection.aggregate(pipeline_generations).to_list(None)
-    total_generations = result_generations[0]["total_generations"] if result_generations and result_generations[0].get(
-        "total_generations") is not None else 0
-
-    pipeline_revenue = [{"$project": {"successful_payments": {
-        "$filter": {"input": {"$objectToArray": "$yookassa_payments"}, "as": "payment",
-                    "cond": {"$eq": ["$$payment.v.status", "succeeded"]}}}}}, {"$unwind": "$successful_payments"}, {
-        "$group": {"_id": None, "total_revenue": {"$sum": "$successful_payments.v.price"},
-                   "total_successful_payments": {"$sum": 1}}}]
-    result_revenue = await users_collection.aggregate(pipeline_revenue).to_list(None)
-    total_revenue = result_revenue[0]["total_revenue"] if result_revenue and result_revenue[0].get(
-        "total_revenue") is not None else 0
-    total_successful_payments = result_revenue[0]["total_successful_payments"] if result_revenue and result_revenue[
-        0].get("total_successful_payments") is not None else 0
-
-    seven_days_ago = datetime.now() - timedelta(days=7)
-    active_users = await users_collection.count_documents({"last_generation_time": {"$gte": seven_days_ago}})
-
-    pipeline_time_to_first_gen = [
-        {"$match": {"first_generation_time": {"$exists": True}, "registered_at": {"$exists": True}}},
-        {"$project": {"time_to_first_gen": {"$subtract": ["$first_generation_time", "$registered_at"]}}},
-        {"$group": {"_id": None, "avg_time_to_first_gen": {"$avg": "$time_to_first_gen"}}}]
-    result_time_to_first_gen = await users_collection.aggregate(pipeline_time_to_first_gen).to_list(None)
-    avg_time_to_first_gen_ms = result_time_to_first_gen[0]["avg_time_to_first_gen"] if result_time_to_first_gen and \
-                                                                                       result_time_to_first_gen[0].get(
-                                                                                           "avg_time_to_first_gen") is not None else 0
-    avg_time_to_first_gen_hours = avg_time_to_first_gen_ms / 3600000 if avg_time_to_first_gen_ms else 0
-
-    users_with_zero_generations = await users_collection.count_documents({"generation_count": 0})
-    percentage_zero_generations = (users_with_zero_generations / total_users * 100) if total_users > 0 else 0
 
-    average_payment = total_revenue / total_successful_payments if total_successful_payments > 0 else 0
+async def _compute_stats() -> dict:
+    stats = await get_total_rollup()
 
-    pipeline_repeat = [{"$project": {"successful_payments_count": {"$size": {
-        "$filter": {"input": {"$objectToArray": "$yookassa_payments"}, "as": "payment",
-                    "cond": {"$eq": ["$$payment.v.status", "succeeded"]}}}}}}, {"$group": {"_id": None,
-                                                                                           "total_repeat_payments": {
-                                                                                               "$sum": {"$cond": [{
-                                                                                                   "$gt": [
-                                                                                                       "$successful_payments_count",
-                                                                                                       1]}, {
-                                                                                                   "$subtract": [
-                                                                                                       "$successful_payments_count",
-                                                                                                       1]}, 0]}}}}]
-    result_repeat = await users_collection.aggregate(pipeline_repeat).to_list(None)
-    total_repeat_payments = result_repeat[0]["total_repeat_payments"] if result_repeat and result_repeat[0].get(
-        "total_repeat_payments") is not None else 0
-    percentage_repeat_payments = (
-            total_repeat_payments / total_successful_payments * 100) if total_successful_payments > 0 else 0
-
-    pipeline_paying_users = [{"$match": {"yookassa_payments": {"$exists": True}}}, {"$project": {
-        "has_successful_payment": {"$gt": [{"$size": {
-            "$filter": {"input": {"$objectToArray": "$yookassa_payments"}, "as": "payment",
-                        "cond": {"$eq": ["$$payment.v.status", "succeeded"]}}}}, 0]}}},
-                             {"$match": {"has_successful_payment": True}}, {"$count": "paying_users"}]
-    result_paying_users = await users_collection.aggregate(pipeline_paying_users).to_list(None)
-    paying_users = result_paying_users[0]["paying_users"] if result_paying_users and result_paying_users[0].get(
-        "paying_users") is not None else 0
-    average_payments_per_paying_user = total_successful_payments / paying_users if paying_users > 0 else 0
+    def metric(name: str):
+        return stats.get(name) or 0
 
-    pipeline_activity_depth = [{
-        "$match": {"first_generation_time": {"$exists": True}, "last_generation_time": {"$exists": True},
-                   "generation_count": {"$gte": 2}}},
-        {"$project": {"activity_depth": {"$subtract": ["$last_generation_time", "$first_generation_time"]}}},
-        {"$group": {"_id": None, "avg_activity_depth": {"$avg": "$activity_depth"}}}]
-    result_activity_depth = await users_collection.aggregate(pipeline_activity_depth).to_list(None)
-    avg_activity_depth_ms = result_activity_depth[0]["avg_activity_depth"] if result_activity_depth and \
-                                                                              result_activity_depth[0].get(
-                                                                                  "avg_activity_depth") is not None else 0
-    avg_activity_depth_days = avg_activity_depth_ms / 86400000 if avg_activity_depth_ms else 0  # 1000*60*60*24
-
-    threshold = 1000.0
-    pipeline_ltv = [{"$project": {"total_revenue_per_user": {"$sum": {"$map": {"input": {
-        "$filter": {"input": {"$objectToArray": "$yookassa_payments"}, "as": "payment",
-                    "cond": {"$eq": ["$$payment.v.status", "succeeded"]}}}, "as": "payment",
-        "in": "$$payment.v.price"}}}}}, {"$match": {"total_revenue_per_user": {"$gt": threshold}}},
-        {"$count": "users_with_high_ltv"}]
-    result_ltv = await users_collection.aggregate(pipeline_ltv).to_list(None)
-    users_with_high_ltv = result_ltv[0]["users_with_high_ltv"] if result_ltv and result_ltv[0].get(
-        "users_with_high_ltv") is not None else 0
-    percentage_high_ltv = (users_with_high_ltv / total_users * 100) if total_users > 0 else 0
-
-    pipeline_time_between = [{
-        "$match": {"first_generation_time": {"$exists": True}, "last_generation_time": {"$exists": True},
-                   "generation_count": {"$gte": 2}}}, {"$project": {"time_between": {
-        "$divide": [{"$subtract": ["$last_generation_time", "$first_generation_time"]},
-                    {"$subtract": ["$generation_count", 1]}]}}},
-        {"$group": {"_id": None, "avg_time_between": {"$avg": "$time_between"}}}]
-    result_time_between = await users_collection.aggregate(pipeline_time_between).to_list(None)
-    avg_time_between_ms = result_time_between[0]["avg_time_between"] if result_time_between and result_time_between[
-        0].get("avg_time_between") is not None else 0
-    avg_time_between_days = avg_time_between_ms / 86400000 if avg_time_between_ms else 0
-
-    pipeline_failed_payments = [{"$project": {"has_failed_payment": {"$gt": [{"$size": {
-        "$filter": {"input": {"$objectToArray": "$yookassa_payments"}, "as": "payment",
-                    "cond": {"$in": ["$$payment.v.status", ["failed", "canceled"]]}}}}, 0]}}},
-        {"$match": {"has_failed_payment": True}}, {"$count": "users_with_failed_payments"}]
-    result_failed_payments = await users_collection.aggregate(pipeline_failed_payments).to_list(None)
-    users_with_failed_payments = result_failed_payments[0]["users_with_failed_payments"] if result_failed_payments and \
-                                                                                            result_failed_payments[
-                                                                                                0].get(
-                                                                                                "users_with_failed_payments") is not None else 0
-    percentage_failed_payments = (users_with_failed_payments / total_users * 100) if total_users > 0 else 0
+    active_users = await count_active_users()
 
-    revenue_per_generation = total_revenue / total_generations if total_generations > 0 else 0
+    total_users = metric("total_users")
+    total_generations = metric("total_generations")
+    total_revenue = metric("total_revenue")
+    total_successful_payments = metric("total_successful_payments")
+    paying_users = metric("paying_users")
+    repeat_users = metric("repeat_users")
+    time_to_first_gen_count = metric("time_to_first_gen_count")
 
-    pipeline_within_1_day = [{"$match": {"first_generation_time": {"$exists": True}, "registered_at": {"$exists": True},
-                                         "first_generation_time": {
-                                             "$lte": {"$add": ["$registered_at", 24 * 60 * 60 * 1000]}}}},
-                             {"$count": "users_within_1_day"}]
-    result_within_1_day = await users_collection.aggregate(pipeline_within_1_day).to_list(None)
-    users_within_1_day = result_within_1_day[0]["users_within_1_day"] if result_within_1_day and result_within_1_day[
-        0].get("users_within_1_day") is not None else 0
-    percentage_within_1_day = (users_within_1_day / total_users * 100) if total_users > 0 else 0
-
-    pipeline_within_7_days = [{
-        "$match": {"first_generation_time": {"$exists": True}, "registered_at": {"$exists": True},
-                   "first_generation_time": {"$lte": {"$add": ["$registered_at", 7 * 24 * 60 * 60 * 1000]}}}},
-        {"$count": "users_within_7_days"}]
-    result_within_7_days = await users_collection.aggregate(pipeline_within_7_days).to_list(None)
-    users_within_7_days = result_within_7_days[0]["users_within_7_days"] if result_within_7_days and \
-                                                                            result_within_7_days[0].get(
-                                                                                "users_within_7_days") is not None else 0
-    percentage_within_7_days = (users_within_7_days / total_users * 100) if total_users > 0 else 0
-
-    pipeline_within_30_days = [{
-        "$match": {"first_generation_time": {"$exists": True}, "registered_at": {"$exists": True},
-                   "first_generation_time": {"$lte": {"$add": ["$registered_at", 30 * 24 * 60 * 60 * 1000]}}}},
-        {"$count": "users_within_30_days"}]
-    result_within_30_days = await users_collection.aggregate(pipeline_within_30_days).to_list(None)
-    users_within_30_days = result_within_30_days[0]["users_within_30_days"] if result_within_30_days and \
-                                                                               result_within_30_days[0].get(
-                                                                                   "users_within_30_days") is not None else 0
-    percentage_within_30_days = (users_within_30_days / total_users * 100) if total_users > 0 else 0
+    def percentage_of_users(count: int) -> float:
+        return (count / total_users * 100) if total_users > 0 else 0
+
+    avg_time_to_first_gen_hours = (metric("time_to_first_gen_sum_ms") / time_to_first_gen_count / 3600000
+                                   ) if time_to_first_gen_count > 0 else 0
+    average_payment = total_revenue / total_successful_payments if total_successful_payments > 0 else 0
+    percentage_repeat_payments = (metric("total_repeat_payments") / total_successful_payments * 100
+                                  ) if total_successful_payments > 0 else 0
+    average_payments_per_paying_user = total_successful_payments / paying_users if paying_users > 0 else 0
+    avg_activity_depth_days = metric("activity_depth_sum_ms") / repeat_users / DAY_MS if repeat_users > 0 else 0
+    avg_time_between_days = metric("time_between_sum_ms") / repeat_users / DAY_MS if repeat_users > 0 else 0
+    revenue_per_generation = total_revenue / total_generations if total_generations > 0 else 0
 
     logger.info("Статистика успешно собрана.")
     return {"total_users": total_users, "total_generations": total_generations, "total_revenue": total_revenue,
             "active_users_last_7_days": active_users,
             "average_time_to_first_generation_hours": round(avg_time_to_first_gen_hours, 2),
-            "percentage_users_with_zero_generations": round(percentage_zero_generations, 2),
+            "percentage_users_with_zero_generations": round(percentage_of_users(metric("users_with_zero_generations")), 2),
             "average_payment_amount": round(average_payment, 2),
             "percentage_repeat_payments": round(percentage_repeat_payments, 2),
             "average_payments_per_paying_user": round(average_payments_per_paying_user, 2),
             "average_activity_depth_days": round(avg_activity_depth_days, 2),
-            "percentage_users_with_high_ltv": round(percentage_high_ltv, 2),
+            "percentage_users_with_high_ltv": round(percentage_of_users(metric("users_with_high_ltv")), 2),
             "average_time_between_generations_days": round(avg_time_between_days, 2),
-            "percentage_users_with_payment_errors": round(percentage_failed_payments, 2),
+            "percentage_users_with_payment_errors": round(percentage_of_users(metric("users_with_failed_payments")), 2),
             "revenue_per_generation": round(revenue_per_generation, 2),
-            "percentage_first_generation_within_1_day": round(percentage_within_1_day, 2),
-            "percentage_first_generation_within_7_days": round(percentage_within_7_days, 2),
-            "percentage_first_generation_within_30_days": round(percentage_within_30_days, 2), }
+            "percentage_first_generation_within_1_day": round(percentage_of_users(metric("users_within_1_days")), 2),
+            "percentage_first_generation_within_7_days": round(percentage_of_users(metric("users_within_7_days")), 2),
+            "percentage_first_generation_within_30_days": round(percentage_of_users(metric("users_within_30_days")), 2), }
+
+
+@router.get("/stats/daily", dependencies=[Depends(get_api_key_dependency)])
+async def get_daily_stats_endpoint(days: int = 30):
+    """Возвращает дневные счетчики: регистрации, первые генерации, генерации, выручку и успешные платежи."""
+    if db_module.stats_rollups_collection is None:
+        logger.warning("Запрос дневной статистики при недоступной базе данных")
+        raise HTTPException(status_code=503, detail="Сервис базы данных недоступен")
+    return await get_daily_rollups(max(1, min(days, 366)))
+
+
+@router.post("/stats/rebuild", dependencies=[Depends(get_api_key_dependency)])
+async def rebuild_stats_endpoint():
+    """Пересчитывает сводки статистики по исходным данным (полный проход по коллекциям)."""
+    if not users_collection or db_module.stats_rollups_collection is None:
+        logger.warning("Запрос пересчета статистики при недоступной базе данных")
+        raise HTTPException(status_code=503, detail="Сервис базы данных недоступен")
+    try:
+        result = await rebuild_rollups()
+    except Exception as e:
+        logger.error(f"Ошибка пересчета сводок статистики: {e}", exc_info=True)
+        raise HTTPException(status_code=500, detail="Не удалось пересчитать статистику")
+    if result is None:
+        raise HTTPException(status_code=409, detail="Пересчет статистики уже выполняется")
+    await invalidate_cached("stats", "source_statistics")
+    return result
 
 
 @router.get("/source_statistics", dependencies=[Depends(get_api_key_dependency)])
-async def get_source_statistics_endpoint():
-    """Возвращает статистику по пользователям и генерациям, сгруппированную по рекламным источникам."""
+async def get_source_statistics_endpoint(response: Response):
+    """Возвращает статистику по пользователям и генерациям, сгруппированную по рекламным источникам
+    (кешируется на SOURCE_STATISTICS_CACHE_TTL_SECONDS, время расчета - в заголовке X-Computed-At)."""
     if not users_collection or not advertising_sources_collection:
         logger.warning("Запрос статистики по источникам при недоступных коллекциях пользователей и источников")
         raise HTTPException(status_code=503, detail="Сервис базы данных недоступен")
-
-    pipeline = [{"$group": {"_id": "$advertising_source", "user_count": {"$sum": 1},
-                            "total_generations": {"$sum": "$generation_count"},
-                            "users_with_generations": {"$sum": {"$cond": [{"$gt": ["$generation_count", 0]}, 1, 0]}}}},
-                {"$lookup": {"from": advertising_sources_collection.name, "localField": "_id",
-                             "foreignField": "source_code", "as": "source_info"}},
-                {"$unwind": {"path": "$source_info", "preserveNullAndEmptyArrays": True}}, {
-                    "$project": {"source_code": "$_id",
-                                 "campaign_name": {"$ifNull": ["$source_info.campaign_name", "Неизвестно"]},
-                                 "user_count": 1, "total_generations": 1, "users_with_generations": 1}}]
-    result = await users_collection.aggregate(pipeline).to_list(None)
+    entry, cache_status = await get_cached("source_statistics", _compute_source_statistics,
+                                           SOURCE_STATISTICS_CACHE_TTL_SECONDS)
+    _set_freshness_headers(response, entry, cache_status)
+    return entry["data"]
+
+
+async def _compute_source_statistics() -> list:
+    rollups = await get_source_rollups()
+    source_codes = [rollup["source_code"] for rollup in rollups if rollup.get("source_code")]
+    campaign_names = {source["source_code"]: source.get("campaign_name") async for source in
+                      advertising_sources_collection.find({"source_code": {"$in": source_codes}})}
+    result = [{"_id": rollup.get("source_code"), "source_code": rollup.get("source_code"),
+               "campaign_name": campaign_names.get(rollup.get("source_code")) or "Неизвестно",
+               "user_count": rollup.get("user_count", 0), "total_generations": rollup.get("total_generations", 0),
+               "users_with_generations": rollup.get("users_with_generations", 0)} for rollup in rollups]
     logger.info("Статистика по источникам успешно собрана.")
     return result
 
@@ -304,19 +292,171 @@ async def get_user_endpoint(chat_id: int):
     return User(**user)
 
 
+@router.get("/users/{chat_id}/summary", response_model=UserSummary, dependencies=[Depends(get_api_key_dependency)])
+async def get_user_summary_endpoint(chat_id: int):
+    """Возвращает краткий профиль пользователя для меню бота."""
+    user = await get_db_user(chat_id)
+    if not user:
+        raise HTTPException(status_code=404, detail="Пользователь не найден")
+    await update_last_activity(chat_id)
+    referral_link = None
+    if TELEGRAM_BOT_USERNAME and user.get("referral_code"):
+        referral_link = f"https://t.me/{TELEGRAM_BOT_USERNAME}?start={user['referral_code']}"
+    # Лишние поля профиля отбрасываются моделью.
+    return UserSummary(**user, referral_link=referral_link)
+
+
+IMAGE_TRANSPORTS = ("base64", "blob")
+
+
+def _validate_transport(transport: str):
+    if transport not in IMAGE_TRANSPORTS:
+        raise HTTPException(status_code=400, detail=f"Неизвестный способ передачи изображений: {transport}")
+
+
+async def _run_until_disconnect(request: Request, chat_id: int, coro):
+    """Выполняет генерацию, отменяя ее, если клиент закрыл соединение: незавершенные вызовы Gemini отменяются,
+    квота и оживашка возвращаются (см. stream_generation)."""
+    task = asyncio.create_task(coro)
+    try:
+        while True:
+            done, _ = await asyncio.wait({task}, timeout=GENERATION_DISCONNECT_POLL_SECONDS)
+            if done:
+                return task.result()
+            if await request.is_disconnected():
+                logger.warning(f"Клиент отключился во время генерации для {chat_id}, отменяем генерацию")
+                break
+    finally:
+        if not task.done():
+            task.cancel()
+    try:
+        await task
+    except (asyncio.CancelledError, HTTPException):
+        pass
+    raise HTTPException(status_code=499, detail="Клиент закрыл соединение")
+
+
 @router.post("/generate", response_model=GenerationResponse, dependencies=[Depends(get_api_key_dependency)])
-async def generate_drawing_endpoint(chat_id: int = Form(...), image: UploadFile = File(...)):
-    """Принимает изображение от пользователя и генерирует на его основе новые изображения."""
+async def generate_drawing_endpoint(request: Request, chat_id: int = Form(...), image: UploadFile = File(...),
+                                    transport: str = Form("base64")):
+    """Принимает изображение от пользователя и генерирует на его основе новые изображения.
+
+    При transport=blob изображения не кодируются в base64: ответ содержит идентификаторы
+    в main_image_ids/bonus_image_ids, а сами байты забираются через GET /blobs/{blob_id}.
+    """
+    _validate_transport(transport)
     image_data = await image.read()
     if not image_data:
         logger.warning(f"Пользователь {chat_id} загрузил пустое изображение.")
         raise HTTPException(status_code=400, detail="Загруженное изображение пустое")
 
-    response = await generate_images_service(chat_id, image_data)
-    await update_last_activity(chat_id)
+    response = await _run_until_disconnect(request, chat_id, generate_images_service(chat_id, image_data, transport))
     return response
 
 
+class _GenerationStreamingResponse(StreamingResponse):
+    """Поток уже оплаченной генерации. Тело закрывается явно при любом завершении ответа, чтобы обработчики
+    отключения в потоке сработали сразу, а не в финализаторе сборщика мусора. Если клиент отключился до начала
+    отдачи тела, генератор так и не запускался - списание и слот чата возвращаются здесь."""
+
+    def __init__(self, content, debit: GenerationDebit, stream_state: dict, **kwargs):
+        super().__init__(content, **kwargs)
+        self.debit = debit
+        self.stream_state = stream_state
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            await asyncio.shield(self.body_iterator.aclose())
+            if not self.stream_state["started"]:
+                logger.warning(f"Клиент отключился до отправки ответа потоковой генерации для {self.debit.chat_id}")
+                await abort_generation(self.debit)
+
+
+@router.post("/generate/stream", dependencies=[Depends(get_api_key_dependency)])
+async def generate_drawing_stream_endpoint(chat_id: int = Form(...), image: UploadFile = File(...),
+                                           transport: str = Form("base64")):
+    """Генерирует изображения, отдавая каждое в поток NDJSON сразу после получения от модели."""
+    _validate_transport(transport)
+    image_data = await image.read()
+    if not image_data:
+        logger.warning(f"Пользователь {chat_id} загрузил пустое изображение.")
+        raise HTTPException(status_code=400, detail="Загруженное изображение пустое")
+
+    debit = await debit_generation(chat_id, image_data)
+    # stream_state["started"] - тело ответа начало отдаваться и само отвечает за возврат при отключении клиента.
+    stream_state = {"started": False}
+
+    async def event_stream():
+        stream_state["started"] = True
+        # До первой итерации stream_generation еще не отвечает за возврат: отключение клиента обрабатываем здесь.
+        generation_started = False
+        counters = {"main": 0, "bonus": 0}
+        try:
+            yield json.dumps({"event": "started", "num_main_images": debit.num_main_images,
+                              "num_bonus_images": debit.num_bonus_images,
+                              "estimated_wait_seconds": debit.estimated_wait_seconds}) + "\n"
+            generation_started = True
+            async with aclosing(stream_generation(debit, image_data)) as generated:
+                async for kind, img_bytes in generated:
+                    counters[kind] += 1
+                    event = {"event": "image", "kind": kind, "index": counters[kind]}
+                    if transport == "blob":
+                        event["blob_id"] = await put_blob(img_bytes)
+                    else:
+                        event["image"] = base64.b64encode(img_bytes).decode('utf-8')
+                    yield json.dumps(event) + "\n"
+        except HTTPException as http_exc:
+            yield json.dumps({"event": "error", "status_code": http_exc.status_code, "detail": http_exc.detail}) + "\n"
+            return
+        except (asyncio.CancelledError, GeneratorExit):
+            if not generation_started:
+                logger.warning(f"Клиент отключился до начала потоковой генерации для {chat_id}")
+                await abort_generation(debit)
+            raise
+        logger.info(f"Потоковая генерация для {chat_id} завершена. Основные: {counters['main']}, "
+                    f"Бонусные: {counters['bonus']}")
+        yield json.dumps({"event": "done", "ozhivashki_spent": debit.ozhivashki_spent,
+                          "new_balance": debit.new_balance}) + "\n"
+
+    return _GenerationStreamingResponse(event_stream(), debit, stream_state, media_type="application/x-ndjson")
+
+
+@router.post("/generate/jobs", status_code=202, response_model=GenerationJobStatus,
+             dependencies=[Depends(get_api_key_dependency)])
+async def create_generation_job_endpoint(chat_id: int = Form(...), image: UploadFile = File(...),
+                                         transport: str = Form("base64")):
+    """Списывает оживашку и ставит генерацию в очередь воркеров, сразу возвращая идентификатор задачи."""
+    _validate_transport(transport)
+    image_data = await image.read()
+    if not image_data:
+        logger.warning(f"Пользователь {chat_id} загрузил пустое изображение.")
+        raise HTTPException(status_code=400, detail="Загруженное изображение пустое")
+
+    job_id = await enqueue_generation_job(chat_id, image_data, transport)
+    return GenerationJobStatus(job_id=job_id, status="queued")
+
+
+@router.get("/generate/jobs/{job_id}", response_model=GenerationJobStatus,
+            dependencies=[Depends(get_api_key_dependency)])
+async def get_generation_job_endpoint(job_id: str):
+    """Возвращает статус задачи генерации и, когда она выполнена, сгенерированные изображения."""
+    job = await get_generation_job(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Задача генерации не найдена")
+    return job
+
+
+@router.get("/blobs/{blob_id}", dependencies=[Depends(get_api_key_dependency)])
+async def get_blob_endpoint(blob_id: str):
+    """Отдает сгенерированное изображение как сырые байты, без base64 и JSON."""
+    data = await get_blob(blob_id)
+    if data is None:
+        raise HTTPException(status_code=404, detail="Изображение не найдено или срок его хранения истек")
+    return Response(content=data, media_type="application/octet-stream")
+
+
 @router.post("/users/{chat_id}/create_payment", dependencies=[Depends(get_api_key_dependency)])
 async def create_payment_endpoint(chat_id: int, payment_data: PaymentRequestBody):
     """Создает платежную ссылку YooKassa для указанного пользователя и информации о покупке."""
@@ -327,16 +467,34 @@ async def create_payment_endpoint(chat_id: int, payment_data: PaymentRequestBody
 
 
 @router.post("/users/{chat_id}/add_ozhivashki/{amount}", dependencies=[Depends(get_api_key_dependency)])
-async def add_ozhivashki_endpoint(chat_id: int, amount: int):
-    """Добавляет указанное количество 'оживашек' пользователю. (Административная функция)"""
+async def add_ozhivashki_endpoint(chat_id: int, amount: int, payment_id: Optional[str] = None):
+    """Добавляет указанное количество 'оживашек' пользователю. (Административная функция)
+
+    С payment_id начисление идемпотентно: повторный запрос за тот же платеж (повтор после таймаута сервиса
+    платежей) ничего не добавляет. Тем же обновлением пользователю выставляется признак has_successful_payment.
+    """
     if not users_collection:
         raise HTTPException(status_code=503, detail="Сервис базы данных недоступен")
     if amount <= 0:
         raise HTTPException(status_code=400, detail="Количество должно быть положительным")
-    result = await users_collection.update_one({"chat_id": chat_id}, {"$inc": {"ozhivashki": amount}})
-    if result.matched_count == 0:
-        logger.warning(f"Попытка добавить оживашки несуществующему пользователю: {chat_id}")
-        raise HTTPException(status_code=404, detail="Пользователь не найден")
+    if payment_id:
+        op_id = f"payment:{payment_id}"
+        user = await apply_balance_op(chat_id, op_id, [{"$set": {"ozhivashki": {"$add": ["$ozhivashki", amount]},
+                                                                 "has_successful_payment": True}}])
+        if user:
+            record_ledger_entry(op_id, chat_id, "payment", amount, user.get("ozhivashki"))
+        elif not await users_collection.count_documents({"chat_id": chat_id}, limit=1):
+            logger.warning(f"Попытка добавить оживашки несуществующему пользователю: {chat_id}")
+            raise HTTPException(status_code=404, detail="Пользователь не найден")
+        else:
+            logger.info(f"Оживашки за платеж {payment_id} пользователю {chat_id} уже начислены.")
+            return {"message": "Оживашки за этот платеж уже начислены."}
+    else:
+        result = await users_collection.update_one({"chat_id": chat_id}, {"$inc": {"ozhivashki": amount}})
+        if result.matched_count == 0:
+            logger.warning(f"Попытка добавить оживашки несуществующему пользователю: {chat_id}")
+            raise HTTPException(status_code=404, detail="Пользователь не найден")
+        await invalidate_user_profile(chat_id)
     logger.info(f"Добавлено {amount} оживашек пользователю {chat_id} через API.")
     await update_last_activity(chat_id)
     return {"message": f"{amount} оживашек успешно добавлено."}
@@ -366,9 +524,14 @@ async def claim_daily_bonus_endpoint(chat_id: int):
         raise HTTPException(status_code=400, detail="Период получения ежедневного бонуса истек (только первые 3 дня).")
 
     ozhivashki_added = 1
-    await users_collection.update_one({"chat_id": chat_id}, {"$inc": {"ozhivashki": ozhivashki_added},
-                                                             "$set": {"daily_bonus_claimed_today": True,
-                                                                      "last_activity_time": datetime.now()}})
+    # Условие в запросе: профиль мог быть прочитан из кеша, а два одновременных запроса не должны дать два бонуса.
+    result = await users_collection.update_one({"chat_id": chat_id, "daily_bonus_claimed_today": {"$ne": True}},
+                                               {"$inc": {"ozhivashki": ozhivashki_added},
+                                                "$set": {"daily_bonus_claimed_today": True,
+                                                         "last_activity_time": datetime.now()}})
+    await invalidate_user_profile(chat_id)
+    if result.modified_count == 0:
+        raise HTTPException(status_code=400, detail="Ежедневный бонус уже получен сегодня.")
     logger.info(
         f"Пользователь {chat_id} получил ежедневный бонус ({ozhivashki_added} оживашка). Дней с момента регистрации: {days_since_registration}")
     return {"message": "Ежедневный бонус получен!", "ozhivashki_added": ozhivashki_added}
@@ -383,6 +546,7 @@ async def mark_discount_offered_endpoint(chat_id: int):
         "$set": {"discount_offered": True, "last_activity_time": datetime.now()}})
     if result.matched_count == 0:
         raise HTTPException(status_code=404, detail="Пользователь не найден")
+    await invalidate_user_profile(chat_id)
     logger.info(f"Скидка отмечена как предложенная для пользователя {chat_id}")
     return {"message": "Скидка отмечена как предложенная."}
 
@@ -395,6 +559,7 @@ async def reset_daily_bonus_flags_endpoint():
     try:
         result = await users_collection.update_many({"daily_bonus_claimed_today": True},
                                                     {"$set": {"daily_bonus_claimed_today": False}})
+        await invalidate_all_user_profiles()
         logger.info(f"Сброшен флаг получения ежедневного бонуса для {result.modified_count} пользователей.")
         return {"message": f"Сброшен флаг получения ежедневного бонуса для {result.modified_count} пользователей."}
     except Exception as e:
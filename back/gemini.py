@@ -0,0 +1,53 @@
+import asyncio
+import time
+from datetime import datetime
+from typing import Dict, List
+
+from google import genai
+from google.genai import types as genai_types
+
+from .config import GEMINI_API_KEYS, GEMINI_MODEL_NAME, GEMINI_HEALTH_CHECK_TIMEOUT_SECONDS, logger
+
+# Один долгоживущий клиент на ключ: у каждого свое HTTP-соединение, глобальное состояние SDK не используется.
+_clients: Dict[int, genai.Client] = {}
+_client_health: Dict[int, dict] = {}
+
+
+def get_client(key_index: int) -> genai.Client:
+    client = _clients.get(key_index)
+    if client is None:
+        client = genai.Client(api_key=GEMINI_API_KEYS[key_index])
+        _clients[key_index] = client
+        logger.info(f"Создан клиент Gemini для ключа с индексом {key_index}")
+    return client
+
+
+async def generate_content(key_index: int, contents: list,
+                           config: genai_types.GenerateContentConfig) -> genai_types.GenerateContentResponse:
+    return await get_client(key_index).aio.models.generate_content(model=GEMINI_MODEL_NAME, contents=contents,
+                                                                   config=config)
+
+
+async def check_client_health(key_index: int) -> dict:
+    """Проверяет ключ запросом метаданных модели, который не расходует квоту генераций."""
+    started = time.monotonic()
+    try:
+        await asyncio.wait_for(get_client(key_index).aio.models.get(model=GEMINI_MODEL_NAME),
+                               timeout=GEMINI_HEALTH_CHECK_TIMEOUT_SECONDS)
+        health = {"key_index": key_index, "healthy": True, "error": None}
+    except Exception as e:
+        logger.warning(f"Проверка клиента Gemini для ключа с индексом {key_index} не пройдена: {e}")
+        health = {"key_index": key_index, "healthy": False, "error": str(e) or type(e).__name__}
+    health["latency_ms"] = round((time.monotonic() - started) * 1000)
+    health["checked_at"] = datetime.now().isoformat()
+    _client_health[key_index] = health
+    return health
+
+
+async def check_all_clients() -> List[dict]:
+    return list(await asyncio.gather(*(check_client_health(i) for i in range(len(GEMINI_API_KEYS)))))
+
+
+def get_clients_status() -> List[dict]:
+    return [{"key_index": i, "client_created": i in _clients, "last_health_check": _client_health.get(i)}
+            for i in range(len(GEMINI_API_KEYS))]
@@ -0,0 +1,45 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+from PIL import Image, ImageOps
+from fastapi import HTTPException
+
+from .config import IMAGE_MAX_DIMENSION, IMAGE_JPEG_QUALITY, IMAGE_PREPROCESS_WORKERS, logger
+
+_preprocess_executor = ThreadPoolExecutor(max_workers=IMAGE_PREPROCESS_WORKERS, thread_name_prefix="image_preprocess")
+
+
+def _preprocess_image(image_bytes: bytes) -> bytes:
+    with Image.open(BytesIO(image_bytes)) as source:
+        image = ImageOps.exif_transpose(source)
+        if image.mode in ("RGBA", "LA") or (image.mode == "P" and "transparency" in image.info):
+            # Прозрачный фон рисунка заливаем белым, как на бумаге.
+            rgba = image.convert("RGBA")
+            image = Image.new("RGB", rgba.size, (255, 255, 255))
+            image.paste(rgba, mask=rgba.getchannel("A"))
+        elif image.mode != "RGB":
+            image = image.convert("RGB")
+        image.thumbnail((IMAGE_MAX_DIMENSION, IMAGE_MAX_DIMENSION), Image.LANCZOS)
+
+        # Сохраняем без exif/icc, чтобы в модель не уходили метаданные.
+        output = BytesIO()
+        image.save(output, format="JPEG", quality=IMAGE_JPEG_QUALITY, optimize=True)
+        return output.getvalue()
+
+
+async def prepare_image_part(chat_id: int, image_bytes: bytes) -> dict:
+    """Подготавливает загруженный рисунок к отправке в Gemini вне event loop.
+
+    Изображение поворачивается по EXIF, уменьшается до IMAGE_MAX_DIMENSION по большей стороне,
+    очищается от метаданных и один раз кодируется в JPEG. Полученная часть переиспользуется
+    всеми вызовами модели для этого рисунка.
+    """
+    loop = asyncio.get_running_loop()
+    try:
+        data = await loop.run_in_executor(_preprocess_executor, _preprocess_image, image_bytes)
+    except Exception as e:
+        logger.error(f"Не удалось обработать изображение пользователя {chat_id}: {e}")
+        raise HTTPException(status_code=400, detail="Не удалось прочитать загруженное изображение")
+    logger.info(f"Изображение пользователя {chat_id} подготовлено: {len(image_bytes)} -> {len(data)} байт")
+    return {"mime_type": "image/jpeg", "data": data}
@@ -0,0 +1,311 @@
+import asyncio
+import sys
+from datetime import datetime, timedelta
+from typing import Awaitable, Callable, List, Tuple
+
+from pymongo import ASCENDING, DESCENDING, IndexModel, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError, OperationFailure
+
+from . import db as db_module
+from .config import MIGRATION_CLAIM_TIMEOUT_SECONDS, DROP_LEGACY_USER_PAYMENTS, logger
+
+# Индексы и миграции схемы общей базы MongoDB для всех сервисов (back, tasks, notifies). Индексы объявлены рядом
+# с запросами, которым они нужны, и создаются идемпотентно при запуске бэкенда. Проверка планов горячих запросов:
+# python -m back.indexes --check (код возврата 1, если какой-то запрос выполняется через COLLSCAN).
+
+# Коллекция -> индексы. Имена заданы явно, чтобы изменение ключей не создавало дубликаты под новым именем.
+INDEXES = {
+    "users": [
+        # get_db_user и все обновления по chat_id во всех сервисах.
+        IndexModel([("chat_id", ASCENDING)], name="chat_id_unique", unique=True),
+        # notifies/discounts.py: равенства generation_count и ozhivashki, затем диапазон last_generation_time.
+        IndexModel([("generation_count", ASCENDING), ("ozhivashki", ASCENDING), ("last_generation_time", ASCENDING)],
+                   name="discount_candidates"),
+        # Пересчет сводок: активные за неделю пользователи.
+        IndexModel([("last_generation_time", ASCENDING)], name="last_generation_time"),
+        # notifies/reminders.py: зарегистрированные за последние 3 дня.
+        IndexModel([("registered_at", ASCENDING)], name="registered_at"),
+    ],
+    "advertising_sources": [
+        IndexModel([("source_code", ASCENDING)], name="source_code_unique", unique=True),
+    ],
+    "payments": [
+        # tasks/payments.py: необработанные платежи по статусу в порядке создания.
+        IndexModel([("status", ASCENDING), ("created_at", ASCENDING)], name="status_created_at"),
+        # Платежи пользователя (повторные платежи, LTV).
+        IndexModel([("chat_id", ASCENDING), ("created_at", DESCENDING)], name="chat_id_created_at"),
+    ],
+    "balance_ledger": [
+        IndexModel([("chat_id", ASCENDING), ("created_at", DESCENDING)], name="chat_id_created_at"),
+    ],
+    "stats_rollups": [
+        # /stats/daily: дневные сводки по дате.
+        IndexModel([("date", ASCENDING)], name="date", sparse=True),
+    ],
+}
+
+
+def _hot_queries() -> List[Tuple[str, str, dict]]:
+    """(описание, коллекция, фильтр) запросов, которые не должны выполняться полным проходом по коллекции."""
+    now = datetime.now()
+    return [
+        ("back: get_db_user", "users", {"chat_id": 0}),
+        ("back: /stats active users", "users", {"last_generation_time": {"$gte": now}}),
+        ("tasks: payment status loop", "payments", {"$or": [{"status": {"$nin": ["succeeded", "canceled"]}},
+                                                            {"status": "succeeded", "generations_added": {"$ne": True}}]}),
+        ("tasks: user payments", "payments", {"chat_id": 0, "_id": {"$ne": ""}}),
+        ("notifies: discount offers", "users", {"generation_count": 1, "last_generation_time": {"$lt": now},
+                                                "ozhivashki": 0, "discount_offered": {"$ne": True}}),
+        ("notifies: daily bonus reminders", "users", {"registered_at": {"$gte": now},
+                                                      "daily_bonus_claimed_today": {"$ne": True}}),
+        ("back: advertising source lookup", "advertising_sources", {"source_code": ""}),
+        ("back: /stats/daily", "stats_rollups", {"date": {"$gte": now.strftime("%Y-%m-%d")}}),
+    ]
+
+
+def _merge_user_docs(primary: dict, extras: list) -> dict:
+    """Поля самого раннего документа пользователя после слияния с дублями: балансы и счетчики складываются,
+    платежи объединяются, даты и флаги берутся так, чтобы не потерять ни одно событие."""
+    docs = [primary, *extras]
+
+    def present(field: str) -> list:
+        return [doc[field] for doc in docs if doc.get(field) is not None]
+
+    merged = {
+        "ozhivashki": sum(doc.get("ozhivashki") or 0 for doc in docs),
+        "generation_count": sum(doc.get("generation_count") or 0 for doc in docs),
+        # Платеж из раннего документа важнее: его статус мог уже обновить сервис платежей.
+        "yookassa_payments": {payment_id: info for doc in reversed(docs)
+                              for payment_id, info in (doc.get("yookassa_payments") or {}).items()},
+    }
+    for field in ("registered_at", "first_generation_time"):
+        if present(field):
+            merged[field] = min(present(field))
+    for field in ("last_generation_time", "last_activity_time"):
+        if present(field):
+            merged[field] = max(present(field))
+    for field in ("referral_bonus_claimed", "discount_offered", "daily_bonus_claimed_today"):
+        merged[field] = any(doc.get(field) for doc in docs)
+    for field in ("username", "referred_by", "advertising_source"):
+        if primary.get(field) is None and present(field):
+            merged[field] = present(field)[0]
+    return merged
+
+
+async def _merge_duplicate_chat_ids():
+    """Сливает документы пользователей с одинаковым chat_id в самый ранний, иначе уникальный индекс
+    не создастся. Исходные документы дублей сохраняются в users_duplicates для ручной проверки."""
+    users = db_module.users_collection
+    duplicates = users.aggregate([
+        {"$group": {"_id": "$chat_id", "count": {"$sum": 1}}},
+        {"$match": {"count": {"$gt": 1}}}], allowDiskUse=True)
+    merged_chat_ids = []
+    async for group in duplicates:
+        chat_id = group["_id"]
+        primary, *extras = await users.find({"chat_id": chat_id}).sort([("registered_at", 1), ("_id", 1)]).to_list(None)
+        # Дубли, уже слитые до прерванного запуска миграции, повторно не складываются.
+        already_merged = set(primary.get("merged_duplicate_ids") or [])
+        extras_to_merge = [doc for doc in extras if doc["_id"] not in already_merged]
+        try:
+            await db_module.db.users_duplicates.insert_many(extras, ordered=False)
+        except BulkWriteError as e:
+            if any(error.get("code") != 11000 for error in e.details.get("writeErrors", [])):
+                raise
+        if extras_to_merge:
+            await users.update_one({"_id": primary["_id"]}, {
+                "$set": _merge_user_docs(primary, extras_to_merge),
+                "$addToSet": {"merged_duplicate_ids": {"$each": [doc["_id"] for doc in extras_to_merge]}}})
+        await users.delete_many({"_id": {"$in": [doc["_id"] for doc in extras]}})
+        merged_chat_ids.append(chat_id)
+    if merged_chat_ids:
+        logger.warning(f"Миграция: слиты дублирующиеся документы пользователей {merged_chat_ids}, исходные документы "
+                       f"сохранены в users_duplicates - проверьте балансы этих пользователей.")
+    else:
+        logger.info("Миграция: дублирующихся документов пользователей не найдено.")
+
+
+async def _default_generation_count():
+    """Запросы по generation_count (скидки, статистика) не видят пользователей без этого поля."""
+    result = await db_module.users_collection.update_many({"generation_count": {"$exists": False}},
+                                                          {"$set": {"generation_count": 0}})
+    logger.info(f"Миграция: generation_count = 0 выставлен {result.modified_count} пользователям.")
+
+
+def _legacy_payments(user: dict) -> dict:
+    return {payment_id: info for payment_id, info in (user.get("yookassa_payments") or {}).items()
+            if isinstance(info, dict)}
+
+
+async def _count_copied_payments(payments: dict) -> int:
+    return await db_module.payments_collection.count_documents({"_id": {"$in": list(payments)}})
+
+
+async def _move_payments_to_collection():
+    """Копирует платежи из словаря users.yookassa_payments в коллекцию payments и выставляет пользователю признак
+    has_successful_payment. Словарь не удаляется: после копирования число платежей сверяется, а удаление
+    выполняет отдельная миграция 4, когда ее включат."""
+    users = db_module.users_collection
+    copied = 0
+    mismatched = []
+    async for user in users.find({"yookassa_payments": {"$exists": True}}, {"chat_id": 1, "yookassa_payments": 1}):
+        payments = _legacy_payments(user)
+        operations = []
+        for payment_id, info in payments.items():
+            created_at = info.get("created_at")
+            if isinstance(created_at, str):
+                # Раньше платежи сохранялись через model_dump(mode='json'), и дата хранилась строкой.
+                created_at = datetime.fromisoformat(created_at)
+            # $setOnInsert: платеж, уже обновленный сервисом платежей в новой коллекции, не перезаписывается.
+            operations.append(UpdateOne({"_id": payment_id}, {"$setOnInsert": {
+                **info, "chat_id": user["chat_id"], "created_at": created_at}}, upsert=True))
+        if operations:
+            await db_module.payments_collection.bulk_write(operations, ordered=False)
+            if await _count_copied_payments(payments) != len(payments):
+                mismatched.append(user["chat_id"])
+        # Только выставляем признак: false из старого словаря не должен затереть признак, выставленный новым платежом.
+        if any(info.get("status") == "succeeded" for info in payments.values()):
+            await users.update_one({"_id": user["_id"]}, {"$set": {"has_successful_payment": True}})
+        copied += len(operations)
+    if mismatched:
+        raise RuntimeError(f"Платежи скопированы не полностью для chat_id: {mismatched}")
+    logger.info(f"Миграция: {copied} платежей скопировано в коллекцию payments, расхождений нет.")
+
+
+async def _drop_legacy_user_payments():
+    """Удаляет словарь users.yookassa_payments и его индекс. Словарь пользователя удаляется, только если все его
+    платежи есть в коллекции payments."""
+    users = db_module.users_collection
+    dropped = 0
+    kept = []
+    async for user in users.find({"yookassa_payments": {"$exists": True}}, {"chat_id": 1, "yookassa_payments": 1}):
+        payments = _legacy_payments(user)
+        if payments and await _count_copied_payments(payments) != len(payments):
+            kept.append(user["chat_id"])
+            continue
+        await users.update_one({"_id": user["_id"]}, {"$unset": {"yookassa_payments": ""}})
+        dropped += 1
+    if kept:
+        raise RuntimeError(f"Не все платежи есть в коллекции payments, словарь оставлен для chat_id: {kept}")
+    try:
+        await users.drop_index("yookassa_payments")
+    except OperationFailure:
+        pass
+    logger.info(f"Миграция: словарь yookassa_payments удален у {dropped} пользователей.")
+
+
+# Версионированные миграции данных: выполняются по порядку, каждая один раз (учет в schema_migrations).
+MIGRATIONS: List[Tuple[int, str, Callable[[], Awaitable]]] = [
+    (1, "merge_duplicate_chat_ids", _merge_duplicate_chat_ids),
+    (2, "default_generation_count", _default_generation_count),
+    (3, "move_payments_to_collection", _move_payments_to_collection),
+    (4, "drop_legacy_user_payments", _drop_legacy_user_payments),
+]
+
+# Миграции, которые выполняются только при включенном флаге. Пока флаг выключен, эта и следующие миграции ждут.
+MIGRATION_GATES = {
+    4: DROP_LEGACY_USER_PAYMENTS,
+}
+
+
+async def _claim_migration(version: int, name: str) -> bool:
+    """Заявка на выполнение миграции: не дает нескольким процессам бэкенда выполнить ее одновременно. Заявку,
+    не завершенную за MIGRATION_CLAIM_TIMEOUT_SECONDS (процесс упал посреди миграции), перехватывает
+    следующий процесс."""
+    migrations_collection = db_module.db.schema_migrations
+    now = datetime.now()
+    try:
+        await migrations_collection.insert_one({"_id": version, "name": name, "status": "running", "started_at": now})
+        return True
+    except DuplicateKeyError:
+        pass
+    stale_before = now - timedelta(seconds=MIGRATION_CLAIM_TIMEOUT_SECONDS)
+    stale_claim = await migrations_collection.find_one_and_update(
+        {"_id": version, "status": "running", "started_at": {"$lt": stale_before}}, {"$set": {"started_at": now}})
+    if stale_claim:
+        logger.warning(f"Миграция {version} ({name}) не завершена с {stale_claim['started_at']}, выполняем повторно.")
+    return stale_claim is not None
+
+
+async def run_migrations():
+    migrations_collection = db_module.db.schema_migrations
+    for version, name, migrate in MIGRATIONS:
+        if not MIGRATION_GATES.get(version, True):
+            migration = await migrations_collection.find_one({"_id": version})
+            if migration and migration.get("status") == "done":
+                continue
+            logger.info(f"Миграция {version} ({name}) не включена, она и следующие миграции пропущены.")
+            return
+        if not await _claim_migration(version, name):
+            migration = await migrations_collection.find_one({"_id": version})
+            if migration and migration.get("status") == "done":
+                continue
+            # Следующие миграции могут зависеть от этой, поэтому ждем ее завершения другим процессом.
+            logger.info(f"Миграция {version} ({name}) выполняется другим процессом, остальные миграции пропущены.")
+            return
+        logger.info(f"Выполнение миграции {version} ({name})...")
+        try:
+            await migrate()
+        except Exception:
+            await migrations_collection.delete_one({"_id": version})
+            raise
+        await migrations_collection.update_one({"_id": version},
+                                               {"$set": {"status": "done", "applied_at": datetime.now()}})
+
+
+async def ensure_indexes():
+    for collection_name, indexes in INDEXES.items():
+        try:
+            created = await db_module.db[collection_name].create_indexes(indexes)
+            logger.info(f"Индексы коллекции {collection_name} проверены: {', '.join(created)}")
+        except Exception as e:
+            logger.error(f"Не удалось создать индексы коллекции {collection_name}: {e}")
+
+
+async def bootstrap_schema():
+    """Применяет миграции и индексы. Ошибки логируются, но не мешают запуску сервиса."""
+    if db_module.db is None:
+        logger.warning("База данных не инициализирована, миграции и индексы пропущены.")
+        return
+    try:
+        await run_migrations()
+    except Exception as e:
+        logger.error(f"Ошибка выполнения миграций: {e}", exc_info=True)
+    await ensure_indexes()
+
+
+def _plan_stages(plan: dict) -> List[str]:
+    stages = [plan.get("stage", "")]
+    for child_key in ("inputStage", "queryPlan"):
+        if child_key in plan:
+            stages += _plan_stages(plan[child_key])
+    for child in plan.get("inputStages", []):
+        stages += _plan_stages(child)
+    return stages
+
+
+async def find_collscans() -> List[str]:
+    """Описания горячих запросов, выигрышный план которых - полный проход по коллекции (COLLSCAN)."""
+    offenders = []
+    for description, collection_name, query in _hot_queries():
+        explanation = await db_module.db[collection_name].find(query).explain()
+        winning_plan = explanation["queryPlanner"]["winningPlan"]
+        if "COLLSCAN" in _plan_stages(winning_plan):
+            offenders.append(f"{description} ({collection_name}: {query})")
+    return offenders
+
+
+async def _check() -> int:
+    await bootstrap_schema()
+    offenders = await find_collscans()
+    for offender in offenders:
+        logger.error(f"COLLSCAN в горячем запросе: {offender}")
+    if not offenders:
+        logger.info("Все горячие запросы используют индексы.")
+    return 1 if offenders else 0
+
+
+if __name__ == "__main__":
+    if "--check" not in sys.argv:
+        asyncio.run(bootstrap_schema())
+        sys.exit(0)
+    sys.exit(asyncio.run(_check()))
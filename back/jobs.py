@@ -0,0 +1,204 @@
+import asyncio
+import uuid
+from datetime import datetime
+from typing import Optional
+
+from fastapi import HTTPException
+from redis.exceptions import ResponseError
+
+from . import db as db_module
+from .config import (GENERATION_JOBS_STREAM, GENERATION_JOBS_GROUP, GENERATION_JOB_TTL_SECONDS,
+                     GENERATION_JOB_ADMISSION_MAX_WAIT_SECONDS, GENERATION_JOB_CLAIM_IDLE_SECONDS,
+                     GENERATION_WORKER_CONCURRENCY, logger)
+from .models import GenerationDebit, GenerationJobStatus, GenerationResponse
+from .scheduler import extend_chat_slot, release_chat_slot
+from .services import debit_generation, refund_generation, run_generation
+
+
+def _job_key(job_id: str) -> str:
+    return f"generation_job:{job_id}"
+
+
+def _job_input_key(job_id: str) -> str:
+    return f"generation_job:{job_id}:input"
+
+
+def _require_redis():
+    if not db_module.redis_client:
+        logger.error("Клиент Redis не инициализирован. Очередь генераций недоступна.")
+        raise HTTPException(status_code=503, detail="Сервис временно недоступен (Redis)")
+    return db_module.redis_client
+
+
+async def enqueue_generation_job(chat_id: int, image_bytes: bytes, transport: str = "base64") -> str:
+    redis_client = _require_redis()
+    # Очередь сглаживает всплески, поэтому допустимое ожидание больше, чем у синхронной генерации, но меньше срока
+    # хранения задачи.
+    debit = await debit_generation(chat_id, image_bytes, max_wait_seconds=GENERATION_JOB_ADMISSION_MAX_WAIT_SECONDS)
+
+    job_id = uuid.uuid4().hex
+    debit_json = debit.model_dump_json()
+    try:
+        pipe = redis_client.pipeline(transaction=True)
+        pipe.hset(_job_key(job_id), mapping={"status": "queued", "chat_id": chat_id,
+                                             "created_at": datetime.now().isoformat(),
+                                             "transport": transport, "debit": debit_json})
+        pipe.expire(_job_key(job_id), GENERATION_JOB_TTL_SECONDS)
+        pipe.set(_job_input_key(job_id), image_bytes, ex=GENERATION_JOB_TTL_SECONDS)
+        # Списание хранится и в самой записи потока (без TTL и обрезки по длине), чтобы вернуть его, даже если
+        # хеш задачи истек до того, как задачу взял воркер.
+        pipe.xadd(GENERATION_JOBS_STREAM, {"job_id": job_id, "debit": debit_json})
+        await pipe.execute()
+    except Exception as e:
+        logger.error(f"Не удалось поставить задачу генерации в очередь для {chat_id}: {e}", exc_info=True)
+        await refund_generation(debit)
+        await release_chat_slot(chat_id, debit.submission_digest)
+        raise HTTPException(status_code=503, detail="Очередь генераций временно недоступна")
+
+    await extend_chat_slot(chat_id, debit.submission_digest, GENERATION_JOB_TTL_SECONDS)
+    logger.info(f"Задача генерации {job_id} поставлена в очередь для пользователя {chat_id}")
+    return job_id
+
+
+async def get_generation_job(job_id: str) -> Optional[GenerationJobStatus]:
+    redis_client = _require_redis()
+    job = await redis_client.hgetall(_job_key(job_id))
+    if not job:
+        return None
+    result = GenerationResponse.model_validate_json(job["result"]) if job.get("result") else None
+    error_status_code = int(job["error_status_code"]) if job.get("error_status_code") else None
+    return GenerationJobStatus(job_id=job_id, status=job["status"], result=result,
+                               error_status_code=error_status_code, error_detail=job.get("error_detail"))
+
+
+async def _fail_expired_job(job_id: str, debit_json: Optional[str]):
+    """Хеш задачи истек до обработки: возвращает списание из записи потока и отмечает задачу неудавшейся."""
+    if not debit_json:
+        logger.error(f"Задача генерации {job_id} не найдена, списание в записи очереди отсутствует")
+        return
+    debit = GenerationDebit.model_validate_json(debit_json)
+    logger.error(f"Задача генерации {job_id} истекла до обработки, возвращаем оживашку {debit.chat_id}")
+    await refund_generation(debit)
+    await release_chat_slot(debit.chat_id, debit.submission_digest)
+    pipe = db_module.redis_client.pipeline(transaction=True)
+    pipe.hset(_job_key(job_id), mapping={"status": "failed", "chat_id": debit.chat_id, "error_status_code": 410,
+                                         "error_detail": "Задача истекла до обработки"})
+    pipe.expire(_job_key(job_id), GENERATION_JOB_TTL_SECONDS)
+    await pipe.execute()
+
+
+async def process_generation_job(job_id: str, debit_json: Optional[str] = None):
+    redis_client = _require_redis()
+    job = await redis_client.hgetall(_job_key(job_id))
+    if not job:
+        await _fail_expired_job(job_id, debit_json)
+        return
+    if job["status"] in ("done", "failed"):
+        logger.info(f"Задача генерации {job_id} уже завершена со статусом {job['status']}")
+        return
+
+    debit = GenerationDebit.model_validate_json(job["debit"])
+    # Входное изображение хранится сырыми байтами, поэтому читается клиентом без декодирования ответов.
+    image_bytes = await db_module.redis_blob_client.get(_job_input_key(job_id))
+    if not image_bytes:
+        logger.error(f"Входное изображение задачи {job_id} не найдено, возвращаем оживашку {debit.chat_id}")
+        await refund_generation(debit)
+        await release_chat_slot(debit.chat_id, debit.submission_digest)
+        await redis_client.hset(_job_key(job_id), mapping={"status": "failed", "error_status_code": 410,
+                                                           "error_detail": "Изображение задачи не найдено"})
+        return
+
+    await redis_client.hset(_job_key(job_id), "status", "running")
+    try:
+        # Прерванная при остановке воркера задача будет переназначена, поэтому списание не возвращаем.
+        response = await run_generation(debit, image_bytes, job.get("transport", "base64"), refund_on_cancel=False)
+    except HTTPException as http_exc:
+        await redis_client.hset(_job_key(job_id), mapping={"status": "failed", "error_status_code": http_exc.status_code,
+                                                           "error_detail": str(http_exc.detail)})
+        logger.info(f"Задача генерации {job_id} завершилась ошибкой: {http_exc.detail}")
+        return
+
+    pipe = redis_client.pipeline(transaction=True)
+    pipe.hset(_job_key(job_id), mapping={"status": "done", "result": response.model_dump_json()})
+    pipe.delete(_job_input_key(job_id))
+    await pipe.execute()
+    logger.info(f"Задача генерации {job_id} выполнена для пользователя {debit.chat_id}")
+
+
+async def _ensure_consumer_group():
+    try:
+        await db_module.redis_client.xgroup_create(GENERATION_JOBS_STREAM, GENERATION_JOBS_GROUP, id="0",
+                                                   mkstream=True)
+        logger.info(f"Создана группа потребителей {GENERATION_JOBS_GROUP} для потока {GENERATION_JOBS_STREAM}")
+    except ResponseError as e:
+        if "BUSYGROUP" not in str(e):
+            raise
+
+
+async def _trim_acked_entries():
+    """Удаляет из потока только записи, подтвержденные группой: все записи до самой ранней неподтвержденной
+    (или до последней выданной, если неподтвержденных нет). Невыданные задачи с уже списанной оживашкой остаются."""
+    redis_client = db_module.redis_client
+    pending = await redis_client.xpending(GENERATION_JOBS_STREAM, GENERATION_JOBS_GROUP)
+    if pending["pending"]:
+        min_id = pending["min"]
+    else:
+        groups = await redis_client.xinfo_groups(GENERATION_JOBS_STREAM)
+        min_id = next((group["last-delivered-id"] for group in groups if group["name"] == GENERATION_JOBS_GROUP), None)
+    if min_id:
+        await redis_client.xtrim(GENERATION_JOBS_STREAM, minid=min_id, approximate=True)
+
+
+async def _handle_entry(entry_id: str, fields: dict, slots: asyncio.Semaphore):
+    try:
+        job_id = fields.get("job_id")
+        if job_id:
+            await process_generation_job(job_id, fields.get("debit"))
+        await db_module.redis_client.xack(GENERATION_JOBS_STREAM, GENERATION_JOBS_GROUP, entry_id)
+        try:
+            await _trim_acked_entries()
+        except Exception as e:
+            logger.warning(f"Не удалось обрезать поток задач генерации: {e}")
+    except Exception as e:
+        # Без XACK запись останется в pending и будет переназначена после GENERATION_JOB_CLAIM_IDLE_SECONDS.
+        logger.error(f"Ошибка обработки записи очереди {entry_id}: {e}", exc_info=True)
+    finally:
+        slots.release()
+
+
+async def run_generation_worker(consumer_name: str):
+    _require_redis()
+    await _ensure_consumer_group()
+    slots = asyncio.Semaphore(GENERATION_WORKER_CONCURRENCY)
+    running = set()
+    claim_cursor = "0-0"
+    logger.info(f"Воркер генерации {consumer_name} запущен (параллельных задач: {GENERATION_WORKER_CONCURRENCY})")
+
+    while True:
+        await slots.acquire()
+        try:
+            claim_cursor, claimed, *_ = await db_module.redis_client.xautoclaim(
+                GENERATION_JOBS_STREAM, GENERATION_JOBS_GROUP, consumer_name,
+                min_idle_time=GENERATION_JOB_CLAIM_IDLE_SECONDS * 1000, start_id=claim_cursor, count=1)
+            entries = [entry for entry in claimed if entry and entry[1]]
+            if entries:
+                logger.info(f"Воркер {consumer_name} забрал зависшую запись очереди {entries[0][0]}")
+            else:
+                response = await db_module.redis_client.xreadgroup(GENERATION_JOBS_GROUP, consumer_name,
+                                                                   {GENERATION_JOBS_STREAM: ">"}, count=1,
+                                                                   block=5000)
+                entries = response[0][1] if response else []
+        except Exception as e:
+            slots.release()
+            logger.error(f"Ошибка чтения очереди генераций: {e}", exc_info=True)
+            await asyncio.sleep(5)
+            continue
+
+        if not entries:
+            slots.release()
+            continue
+
+        entry_id, fields = entries[0]
+        task = asyncio.create_task(_handle_entry(entry_id, fields, slots))
+        running.add(task)
+        task.add_done_callback(running.discard)
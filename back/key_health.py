@@ -0,0 +1,138 @@
+import time
+from collections import deque
+from typing import Dict, List, Optional
+
+from .config import (GEMINI_LATENCY_EWMA_ALPHA, GEMINI_LATENCY_WINDOW, GEMINI_DEFAULT_LATENCY_SECONDS,
+                     GEMINI_CIRCUIT_FAILURE_THRESHOLD, GEMINI_CIRCUIT_ERROR_RATE_THRESHOLD,
+                     GEMINI_CIRCUIT_OPEN_SECONDS, GEMINI_HEDGING_ENABLED, GEMINI_HEDGE_LATENCY_PERCENTILE,
+                     GEMINI_HEDGE_MIN_DELAY_SECONDS, GEMINI_HEDGE_MIN_SAMPLES, logger)
+
+CIRCUIT_CLOSED = "closed"
+CIRCUIT_OPEN = "open"
+CIRCUIT_HALF_OPEN = "half_open"
+
+# Минимум вызовов, после которого доля ошибок может открыть цепь.
+_MIN_CALLS_FOR_ERROR_RATE = 5
+
+
+class _KeyStats:
+    def __init__(self):
+        self.latency_ewma: Optional[float] = None
+        self.latencies = deque(maxlen=GEMINI_LATENCY_WINDOW)
+        self.error_rate = 0.0
+        self.block_rate = 0.0
+        self.calls = 0
+        self.consecutive_failures = 0
+        self.circuit = CIRCUIT_CLOSED
+        self.opened_at = 0.0
+        self.probe_in_flight = False
+
+    def p95(self) -> Optional[float]:
+        return _percentile(list(self.latencies), 0.95)
+
+
+def _percentile(values: List[float], quantile: float) -> Optional[float]:
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * quantile))]
+
+
+# Статистика ведется в каждом процессе отдельно: она отражает то, что видит именно этот процесс.
+_stats: Dict[int, _KeyStats] = {}
+
+
+def _get_stats(key_index: int) -> _KeyStats:
+    stats = _stats.get(key_index)
+    if stats is None:
+        stats = _KeyStats()
+        _stats[key_index] = stats
+    return stats
+
+
+def _ewma(previous: float, value: float) -> float:
+    return previous + GEMINI_LATENCY_EWMA_ALPHA * (value - previous)
+
+
+def _open_circuit(key_index: int, stats: _KeyStats, reason: str):
+    stats.circuit = CIRCUIT_OPEN
+    stats.opened_at = time.monotonic()
+    logger.warning(f"Цепь ключа Gemini {key_index} разомкнута на {GEMINI_CIRCUIT_OPEN_SECONDS} с: {reason}")
+
+
+def key_allows_call(key_index: int) -> bool:
+    """Можно ли направить новый вызов на ключ. После паузы разомкнутая цепь пропускает один пробный вызов."""
+    stats = _get_stats(key_index)
+    if stats.circuit == CIRCUIT_CLOSED:
+        return True
+    if stats.circuit == CIRCUIT_OPEN and time.monotonic() - stats.opened_at >= GEMINI_CIRCUIT_OPEN_SECONDS:
+        stats.circuit = CIRCUIT_HALF_OPEN
+        logger.info(f"Цепь ключа Gemini {key_index} полуоткрыта, пропускаем пробный вызов")
+    return stats.circuit == CIRCUIT_HALF_OPEN and not stats.probe_in_flight
+
+
+def mark_call_started(key_index: int):
+    stats = _get_stats(key_index)
+    if stats.circuit == CIRCUIT_HALF_OPEN:
+        stats.probe_in_flight = True
+
+
+def expected_completion_seconds(key_index: int, in_flight: int) -> float:
+    """Ожидаемое время получения результата с ключа с учетом его загрузки и доли неудачных вызовов."""
+    stats = _get_stats(key_index)
+    latency = stats.latency_ewma if stats.latency_ewma is not None else GEMINI_DEFAULT_LATENCY_SECONDS
+    success_rate = max(0.05, 1 - stats.error_rate)
+    return latency * (1 + in_flight) / success_rate
+
+
+def record_call_result(key_index: int, latency_seconds: float, outcome: str):
+    """Учитывает завершенный вызов модели: outcome - ok, error или blocked."""
+    stats = _get_stats(key_index)
+    stats.calls += 1
+    stats.probe_in_flight = False
+    failed = outcome == "error"
+    stats.error_rate = _ewma(stats.error_rate, 1.0 if failed else 0.0)
+    stats.block_rate = _ewma(stats.block_rate, 1.0 if outcome == "blocked" else 0.0)
+    if not failed:
+        stats.latencies.append(latency_seconds)
+        stats.latency_ewma = latency_seconds if stats.latency_ewma is None else _ewma(stats.latency_ewma,
+                                                                                     latency_seconds)
+        stats.consecutive_failures = 0
+        if stats.circuit != CIRCUIT_CLOSED:
+            stats.circuit = CIRCUIT_CLOSED
+            logger.info(f"Цепь ключа Gemini {key_index} замкнута после успешного пробного вызова")
+        return
+
+    stats.consecutive_failures += 1
+    if stats.circuit == CIRCUIT_HALF_OPEN:
+        _open_circuit(key_index, stats, "пробный вызов завершился ошибкой")
+    elif stats.circuit == CIRCUIT_CLOSED:
+        if stats.consecutive_failures >= GEMINI_CIRCUIT_FAILURE_THRESHOLD:
+            _open_circuit(key_index, stats, f"{stats.consecutive_failures} ошибок подряд")
+        elif stats.calls >= _MIN_CALLS_FOR_ERROR_RATE and stats.error_rate >= GEMINI_CIRCUIT_ERROR_RATE_THRESHOLD:
+            _open_circuit(key_index, stats, f"доля ошибок {stats.error_rate:.2f}")
+
+
+def release_probe(key_index: int):
+    """Снимает отметку пробного вызова, если он был отменен, не дойдя до результата."""
+    _get_stats(key_index).probe_in_flight = False
+
+
+def get_key_health(key_index: int) -> dict:
+    stats = _get_stats(key_index)
+    p95 = stats.p95()
+    return {"circuit": stats.circuit,
+            "latency_ewma_seconds": round(stats.latency_ewma, 3) if stats.latency_ewma is not None else None,
+            "latency_p95_seconds": round(p95, 3) if p95 is not None else None,
+            "error_rate": round(stats.error_rate, 3), "block_rate": round(stats.block_rate, 3), "calls": stats.calls}
+
+
+def hedge_delay_seconds() -> Optional[float]:
+    """Через сколько секунд без ответа стоит дублировать вызов на другой ключ; None - хеджирование выключено
+    или задержек накоплено слишком мало."""
+    if not GEMINI_HEDGING_ENABLED:
+        return None
+    latencies = [latency for stats in _stats.values() for latency in stats.latencies]
+    if len(latencies) < GEMINI_HEDGE_MIN_SAMPLES:
+        return None
+    return max(GEMINI_HEDGE_MIN_DELAY_SECONDS, _percentile(latencies, GEMINI_HEDGE_LATENCY_PERCENTILE))
@@ -0,0 +1,52 @@
+import asyncio
+from datetime import datetime
+from typing import List, Optional
+
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+from . import db as db_module
+from .config import BALANCE_LEDGER_OPS_KEPT, logger
+
+# Ссылки на фоновые записи журнала, чтобы задачи не были собраны сборщиком мусора до завершения.
+_pending_entries = set()
+
+
+async def apply_balance_op(chat_id: int, op_id: str, stages: List[dict],
+                           condition: Optional[dict] = None) -> Optional[dict]:
+    """Атомарно применяет к пользователю конвейер обновления stages за один запрос к базе и возвращает документ
+    после изменения. Идентификатор операции op_id запоминается в документе, поэтому повтор той же операции
+    (например, повторный возврат) ничего не меняет. None - пользователь не найден, не выполнено условие
+    condition или операция уже была применена."""
+    if db_module.users_collection is None:
+        logger.error("Коллекция пользователей не инициализирована, операция с балансом невозможна.")
+        return None
+    query = {"chat_id": chat_id, "ledger_ops": {"$ne": op_id}, **(condition or {})}
+    remember_op = {"$set": {"ledger_ops": {"$slice": [
+        {"$concatArrays": [{"$ifNull": ["$ledger_ops", []]}, [op_id]]}, -BALANCE_LEDGER_OPS_KEPT]}}}
+    user = await db_module.users_collection.find_one_and_update(
+        query, [*stages, remember_op], projection={"ledger_ops": 0},
+        return_document=ReturnDocument.AFTER)
+    if user:
+        await db_module.invalidate_user_profile(chat_id)
+    return user
+
+
+async def _insert_ledger_entry(entry: dict):
+    try:
+        await db_module.balance_ledger_collection.insert_one(entry)
+    except DuplicateKeyError:
+        pass
+    except Exception as e:
+        logger.error(f"Не удалось записать операцию {entry['_id']} в журнал баланса: {e}")
+
+
+def record_ledger_entry(op_id: str, chat_id: int, kind: str, delta: int, balance_after: Optional[int] = None):
+    """Записывает операцию в журнал баланса в фоне, не задерживая ответ пользователю."""
+    if db_module.balance_ledger_collection is None:
+        return
+    entry = {"_id": op_id, "chat_id": chat_id, "kind": kind, "delta": delta, "balance_after": balance_after,
+             "created_at": datetime.now()}
+    task = asyncio.create_task(_insert_ledger_entry(entry))
+    _pending_entries.add(task)
+    task.add_done_callback(_pending_entries.discard)
@@ -1,17 +1,18 @@
-from datetime import datetime
+import asyncio
 
-import redis.asyncio as redis_async
 import uvicorn
 from fastapi import FastAPI
 
 from . import db as db_module
-from .config import (REDIS_URL, NUM_KEYS, REQUESTS_PER_MINUTE_LIMIT, REQUESTS_PER_DAY_LIMIT, logger, MONGO_URI,
-                     MONGO_DB_NAME, GEMINI_API_KEYS_STR, API_KEY, YOOKASSA_SHOP_ID, YOOKASSA_SECRET_KEY,
-                     TELEGRAM_BOT_USERNAME)
+from .config import (REDIS_URL, NUM_KEYS, logger, MONGO_URI, MONGO_DB_NAME, GEMINI_API_KEYS_STR, API_KEY,
+                     YOOKASSA_SHOP_ID, YOOKASSA_SECRET_KEY, TELEGRAM_BOT_USERNAME)
 from .db import client as mongo_client
 from .endpoints import router as api_router
+from .indexes import bootstrap_schema
+from .quota import init_quota_counters
 
 app = FastAPI(title="Ozhivlyator Backend")
+activity_flusher_task = None
 
 
 def check_env_vars():
@@ -28,33 +29,19 @@ def check_env_vars():
 
 @app.on_event("startup")
 async def startup_event():
+    global activity_flusher_task
     logger.info("Запуск Ozhivlyator Backend...")
     check_env_vars()
 
-    if REDIS_URL:
-        try:
-            db_module.redis_client = redis_async.from_url(REDIS_URL, decode_responses=True)
-            await db_module.redis_client.ping()
-            logger.info("Успешное подключение к Redis.")
-            now_ts = datetime.now().timestamp()
-            for i in range(NUM_KEYS):
-                key_prefix = f"gemini_key:{i}"
-                await db_module.redis_client.setnx(f"{key_prefix}:minute_requests", REQUESTS_PER_MINUTE_LIMIT)
-                await db_module.redis_client.setnx(f"{key_prefix}:daily_requests", REQUESTS_PER_DAY_LIMIT)
-                await db_module.redis_client.setnx(f"{key_prefix}:last_minute_reset", now_ts)
-                await db_module.redis_client.setnx(f"{key_prefix}:last_daily_reset", now_ts)
-            logger.info("Квоты Redis инициализированы/проверены.")
-        except Exception as e:
-            logger.error(f"Не удалось подключиться или инициализировать Redis: {e}", exc_info=True)
-            db_module.redis_client = None
-    else:
-        logger.warning("REDIS_URL не указан. Функциональность, зависящая от Redis, будет ограничена.")
-        db_module.redis_client = None
+    await db_module.connect_redis()
+    await init_quota_counters()
 
     if mongo_client:
         try:
             await mongo_client.admin.command('ping')
             logger.info("Подключение к MongoDB успешно.")
+            await bootstrap_schema()
+            activity_flusher_task = asyncio.create_task(db_module.run_activity_flusher())
         except Exception as e:
             logger.error(f"Ошибка подключения к MongoDB при запуске: {e}")
     else:
@@ -66,8 +53,15 @@ async def startup_event():
 
 @app.on_event("shutdown")
 async def shutdown_event():
+    if activity_flusher_task:
+        # Отмена записывает оставшиеся в буфере времена активности.
+        activity_flusher_task.cancel()
+        try:
+            await activity_flusher_task
+        except asyncio.CancelledError:
+            pass
     if db_module.redis_client:
-        await db_module.redis_client.close()
+        await db_module.close_redis()
         logger.info("Соединение с Redis закрыто.")
     if mongo_client:
         mongo_client.close()
@@ -76,4 +70,4 @@ async def shutdown_event():
 
 
 if __name__ == "__main__":
-    uvicorn.run("main:app", host="0.0.0.0", port=8000, workers=4, reload=True)  # reload=True для разработки
+    uvicorn.run("back.main:app", host="0.0.0.0", port=8000, workers=4, reload=True)  # reload=True для разработки
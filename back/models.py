@@ -1,5 +1,5 @@
 from datetime import datetime
-from typing import List, Optional, Dict
+from typing import List, Optional
 
 from pydantic import BaseModel, Field
 
@@ -30,12 +30,26 @@ class User(BaseModel):
     discount_offered: bool = False
     last_activity_time: Optional[datetime] = Field(default_factory=datetime.now)
     advertising_source: Optional[str] = None
-    yookassa_payments: Dict[str, PaymentInfo] = {}
+    has_successful_payment: bool = False
 
     class Config:
         orm_mode = True
 
 
+class UserSummary(BaseModel):
+    """Поля профиля, нужные боту для отрисовки меню. Размер не зависит от истории пользователя."""
+    chat_id: int
+    ozhivashki: int = 0
+    generation_count: int = 0
+    registered_at: Optional[datetime] = None
+    daily_bonus_claimed_today: bool = False
+    daily_bonus_streak: int = 0
+    discount_offered: bool = False
+    referral_code: Optional[str] = None
+    referral_link: Optional[str] = None
+    referred_by: Optional[int] = None
+
+
 class UserCreate(BaseModel):
     chat_id: int
     username: str
@@ -50,11 +64,36 @@ class PaymentRequestBody(BaseModel):
 
 
 class GenerationResponse(BaseModel):
-    main_images: List[str]
-    bonus_images: List[str]
+    main_images: List[str] = []
+    bonus_images: List[str] = []
+    main_image_ids: List[str] = []
+    bonus_image_ids: List[str] = []
     ozhivashki_spent: int
     new_balance: Optional[int] = None
 
 
+class GenerationDebit(BaseModel):
+    chat_id: int
+    debit_id: str
+    generation_count: int
+    ozhivashki_spent: int
+    new_balance: int
+    num_main_images: int
+    num_bonus_images: int
+    priority: str = "standard"
+    estimated_wait_seconds: float = 0.0
+    submission_digest: Optional[str] = None
+    # Время первой генерации, если ее выставило это списание: при возврате отметка снимается.
+    first_generation_time: Optional[datetime] = None
+
+
+class GenerationJobStatus(BaseModel):
+    job_id: str
+    status: str
+    result: Optional[GenerationResponse] = None
+    error_status_code: Optional[int] = None
+    error_detail: Optional[str] = None
+
+
 class SourceCreate(BaseModel):
     campaign_name: str
@@ -0,0 +1,414 @@
+import asyncio
+import time
+from datetime import date, datetime
+from typing import Dict, FrozenSet, List, Optional, Tuple
+
+from fastapi import HTTPException
+from redis.exceptions import ConnectionError as RedisConnectionError
+
+from . import db as db_module
+from .key_health import key_allows_call, mark_call_started, expected_completion_seconds, get_key_health
+from .scheduler import PRIORITY_STANDARD, priority_rank, queue_entered, queue_left, record_queue_wait
+from .config import (NUM_KEYS, REQUESTS_PER_MINUTE_LIMIT, REQUESTS_PER_DAY_LIMIT, GEMINI_MAX_CONCURRENT_PER_KEY,
+                     GEMINI_QUOTA_MAX_BLOCK_SECONDS, GEMINI_HEDGE_BUDGET_PERCENT, logger)
+
+QUOTA_WAKEUP_KEY = "gemini_quota:wakeup"
+# Число процессов, ожидающих квоту на QUOTA_WAKEUP_KEY: без ожидающих токены пробуждения не копятся.
+QUOTA_WAITERS_KEY = "gemini_quota:waiters"
+
+# Минутная квота - токен-бакет: minute_requests хранит число токенов, last_minute_reset - время последнего
+# пополнения. Дневная квота сбрасывается при смене суток.
+# Скрипт пополняет бакеты кандидатов, выбирает ключ с наименьшим ожидаемым временем выполнения (при равенстве - с
+# наибольшей дневной квотой) и списывает по единице из обеих квот. Если свободных ключей нет, возвращает время до
+# появления ближайшего токена.
+# KEYS: по четыре ключа на кандидата (minute_requests, daily_requests, last_daily_reset, last_minute_reset).
+# ARGV: лимит в минуту, лимит в день, текущее время, начало текущих суток, затем пары (индекс, ожидаемое время).
+_RESERVE_SCRIPT = """
+local minute_limit = tonumber(ARGV[1])
+local day_limit = tonumber(ARGV[2])
+local now_ts = tonumber(ARGV[3])
+local day_start_ts = tonumber(ARGV[4])
+local refill_per_second = minute_limit / 60
+local best_pos = -1
+local best_score = 0
+local best_daily = 0
+local best_tokens = 0
+local min_wait = -1
+local candidates = #KEYS / 4
+for pos = 0, candidates - 1 do
+    local minute_key = KEYS[pos * 4 + 1]
+    local daily_key = KEYS[pos * 4 + 2]
+    local daily_reset_key = KEYS[pos * 4 + 3]
+    local minute_reset_key = KEYS[pos * 4 + 4]
+    local last_daily_reset = tonumber(redis.call('GET', daily_reset_key))
+    if not last_daily_reset or last_daily_reset < day_start_ts then
+        redis.call('SET', daily_key, day_limit)
+        redis.call('SET', daily_reset_key, ARGV[3])
+    end
+    local tokens = tonumber(redis.call('GET', minute_key)) or minute_limit
+    local last_refill = tonumber(redis.call('GET', minute_reset_key)) or now_ts
+    if now_ts > last_refill then
+        tokens = math.min(minute_limit, tokens + (now_ts - last_refill) * refill_per_second)
+        redis.call('SET', minute_key, tostring(tokens))
+        redis.call('SET', minute_reset_key, ARGV[3])
+    end
+    local daily_remaining = tonumber(redis.call('GET', daily_key)) or day_limit
+    local score = tonumber(ARGV[6 + pos * 2])
+    if daily_remaining > 0 then
+        if tokens >= 1 then
+            if best_pos < 0 or score < best_score or (score == best_score and daily_remaining > best_daily) then
+                best_pos = pos
+                best_score = score
+                best_daily = daily_remaining
+                best_tokens = tokens
+            end
+        else
+            local wait = (1 - tokens) / refill_per_second
+            if min_wait < 0 or wait < min_wait then
+                min_wait = wait
+            end
+        end
+    end
+end
+if best_pos < 0 then
+    if min_wait < 0 then
+        min_wait = day_start_ts + 86400 - now_ts
+    end
+    return {-1, '0', 0, tostring(min_wait)}
+end
+redis.call('SET', KEYS[best_pos * 4 + 1], tostring(best_tokens - 1))
+local daily_left = redis.call('DECR', KEYS[best_pos * 4 + 2])
+return {tonumber(ARGV[5 + best_pos * 2]), tostring(best_tokens - 1), daily_left, '0'}
+"""
+
+# Возврат единицы квоты ключу, вызов модели с которым не состоялся, и пробуждение ожидающих.
+# KEYS: minute_requests, daily_requests, ключ пробуждения, счетчик ожидающих. ARGV: лимит в минуту, лимит в день.
+_RELEASE_SCRIPT = """
+local minute_left = tonumber(redis.call('INCRBYFLOAT', KEYS[1], 1))
+if minute_left > tonumber(ARGV[1]) then
+    minute_left = tonumber(ARGV[1])
+    redis.call('SET', KEYS[1], minute_left)
+end
+local daily_left = redis.call('INCR', KEYS[2])
+if daily_left > tonumber(ARGV[2]) then
+    daily_left = tonumber(ARGV[2])
+    redis.call('SET', KEYS[2], daily_left)
+end
+local waiters = tonumber(redis.call('GET', KEYS[4]) or '0')
+if waiters > 0 then
+    redis.call('LPUSH', KEYS[3], 1)
+    redis.call('LTRIM', KEYS[3], 0, waiters - 1)
+end
+return {tostring(minute_left), daily_left}
+"""
+
+# KEYS: счетчик ожидающих, ключ пробуждения. Последний ушедший ожидающий убирает невостребованные токены.
+_LEAVE_WAIT_SCRIPT = """
+if redis.call('DECR', KEYS[1]) <= 0 then
+    redis.call('DEL', KEYS[1], KEYS[2])
+end
+"""
+
+_scripts: Dict[str, object] = {}
+
+# Количество вызовов Gemini, выполняющихся прямо сейчас в этом процессе, по индексу ключа.
+_key_in_flight: Dict[int, int] = {}
+
+# Количество ключей, занятых вызовами каждого чата в этом процессе, - для честного дележа внутри класса приоритета.
+_chat_in_flight: Dict[int, int] = {}
+
+
+class _PriorityLock:
+    """Блокировка, которую при освобождении получает ожидающий с наивысшим приоритетом, среди равных - чат
+    с наименьшим числом занятых ключей, затем пришедший раньше."""
+
+    def __init__(self):
+        self._held = False
+        self._waiters = []
+        self._seq = 0
+
+    def locked(self) -> bool:
+        return self._held or bool(self._waiters)
+
+    async def acquire(self, rank: int, chat_id: Optional[int]):
+        if not self.locked():
+            self._held = True
+            return
+        self._seq += 1
+        waiter = (rank, chat_id, self._seq, asyncio.get_running_loop().create_future())
+        self._waiters.append(waiter)
+        try:
+            await waiter[3]
+        except BaseException:
+            if waiter in self._waiters:
+                self._waiters.remove(waiter)
+            elif waiter[3].done() and not waiter[3].cancelled():
+                # Блокировка уже передана нам, но ожидание отменено - передаем ее дальше.
+                self.release()
+            raise
+
+    def release(self):
+        self._held = False
+        while self._waiters:
+            waiter = min(self._waiters, key=lambda w: (w[0], _chat_in_flight.get(w[1], 0), w[2]))
+            self._waiters.remove(waiter)
+            if not waiter[3].done():
+                self._held = True
+                waiter[3].set_result(True)
+                return
+
+
+# Ожидающие квоту корутины процесса встают в очередь по приоритету; к Redis обращается только получившая блокировку.
+_reservation_lock = _PriorityLock()
+_slot_released = asyncio.Event()
+
+
+def _get_script(name: str, source: str):
+    redis_client = db_module.redis_client
+    script = _scripts.get(name)
+    if script is None or script.registered_client is not redis_client:
+        script = redis_client.register_script(source)
+        _scripts[name] = script
+    return script
+
+
+def _key_names(key_index: int) -> List[str]:
+    key_prefix = f"gemini_key:{key_index}"
+    return [f"{key_prefix}:minute_requests", f"{key_prefix}:daily_requests", f"{key_prefix}:last_daily_reset",
+            f"{key_prefix}:last_minute_reset"]
+
+
+def _quota_exhausted(detail: str = "Все ключи генерации заняты, попробуйте позже"):
+    return HTTPException(status_code=503, detail=detail)
+
+
+def _remaining(deadline: Optional[float]) -> Optional[float]:
+    if deadline is None:
+        return None
+    return deadline - time.monotonic()
+
+
+async def _try_reserve(exclude: FrozenSet[int] = frozenset()) -> Tuple[int, float]:
+    candidates = [i for i in range(NUM_KEYS) if i not in exclude
+                  and _key_in_flight.get(i, 0) < GEMINI_MAX_CONCURRENT_PER_KEY and key_allows_call(i)]
+    if not candidates:
+        return -1, -1.0
+
+    now = datetime.now()
+    day_start_ts = datetime.combine(now.date(), datetime.min.time()).timestamp()
+    keys = []
+    args = [REQUESTS_PER_MINUTE_LIMIT, REQUESTS_PER_DAY_LIMIT, now.timestamp(), day_start_ts]
+    for i in candidates:
+        keys.extend(_key_names(i))
+        args.extend([i, round(expected_completion_seconds(i, _key_in_flight.get(i, 0)), 3)])
+    try:
+        key_index, minute_left, daily_left, wait_seconds = await _get_script("reserve", _RESERVE_SCRIPT)(keys=keys,
+                                                                                                        args=args)
+    except RedisConnectionError as e:
+        logger.error(f"Ошибка подключения Redis при резервировании ключа Gemini: {e}")
+        raise HTTPException(status_code=503, detail="Сервис временно недоступен (Redis)")
+
+    key_index = int(key_index)
+    if key_index < 0:
+        return -1, float(wait_seconds)
+
+    _key_in_flight[key_index] = _key_in_flight.get(key_index, 0) + 1
+    mark_call_started(key_index)
+    logger.info(f"Зарезервирован ключ Gemini {key_index}. Осталось в минуту: {float(minute_left):.2f}, "
+                f"в день: {max(0, int(daily_left))}, активных вызовов: {_key_in_flight[key_index]}")
+    return key_index, 0.0
+
+
+async def _wait_for_capacity(wait_seconds: float, deadline: Optional[float]):
+    timeout = GEMINI_QUOTA_MAX_BLOCK_SECONDS if wait_seconds < 0 else min(wait_seconds, GEMINI_QUOTA_MAX_BLOCK_SECONDS)
+    remaining = _remaining(deadline)
+    if remaining is not None:
+        timeout = min(timeout, remaining)
+    if timeout <= 0:
+        return
+
+    if wait_seconds < 0:
+        # Все ключи заняты вызовами этого процесса или их цепи разомкнуты - ждем освобождения локального слота.
+        _slot_released.clear()
+        try:
+            await asyncio.wait_for(_slot_released.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        return
+
+    logger.info(f"Нет доступных ключей Gemini в соответствии с квотой, ожидание до {timeout:.2f} с...")
+    redis_client = db_module.redis_client
+    try:
+        pipe = redis_client.pipeline(transaction=True)
+        pipe.incr(QUOTA_WAITERS_KEY)
+        # TTL страхует от завышенного счетчика, если процесс упал во время ожидания.
+        pipe.expire(QUOTA_WAITERS_KEY, GEMINI_QUOTA_MAX_BLOCK_SECONDS * 2)
+        await pipe.execute()
+        try:
+            await redis_client.blpop([QUOTA_WAKEUP_KEY], timeout=max(timeout, 0.01))
+        finally:
+            await asyncio.shield(_get_script("leave_wait", _LEAVE_WAIT_SCRIPT)(keys=[QUOTA_WAITERS_KEY, QUOTA_WAKEUP_KEY]))
+    except RedisConnectionError as e:
+        logger.error(f"Ошибка подключения Redis при ожидании квоты: {e}")
+        raise HTTPException(status_code=503, detail="Сервис временно недоступен (Redis)")
+
+
+async def reserve_key(deadline: Optional[float] = None, priority: str = PRIORITY_STANDARD,
+                      chat_id: Optional[int] = None) -> int:
+    """Резервирует единицу квоты ключа с наименьшим ожидаемым временем выполнения, ожидая ее появления не дольше
+    deadline (значение time.monotonic()). Ключи с разомкнутой цепью пропускаются. Ожидающие обслуживаются
+    по классу приоритета, внутри класса - в пользу чатов, занимающих меньше ключей."""
+    if not db_module.redis_client:
+        logger.error("Клиент Redis не инициализирован. Невозможно получить API-ключ.")
+        raise HTTPException(status_code=503, detail="Сервис временно недоступен (Redis)")
+
+    started = time.monotonic()
+    queue_entered(priority)
+    try:
+        key_index = await _reserve_key_queued(deadline, priority, chat_id)
+    except HTTPException:
+        await record_queue_wait(priority, time.monotonic() - started, reserved=False)
+        raise
+    finally:
+        queue_left(priority)
+    _chat_in_flight[chat_id] = _chat_in_flight.get(chat_id, 0) + 1
+    try:
+        await record_queue_wait(priority, time.monotonic() - started, reserved=True)
+    except asyncio.CancelledError:
+        # Зарезервированный ключ еще никому не передан - возвращаем его сами.
+        await release_key(key_index, refund=True, chat_id=chat_id)
+        raise
+    return key_index
+
+
+async def _reserve_key_queued(deadline: Optional[float], priority: str, chat_id: Optional[int]) -> int:
+    remaining = _remaining(deadline)
+    try:
+        await asyncio.wait_for(_reservation_lock.acquire(priority_rank(priority), chat_id), remaining)
+    except asyncio.TimeoutError:
+        logger.warning(f"Истекло время ожидания очереди за квотой Gemini (класс {priority}).")
+        raise _quota_exhausted()
+
+    try:
+        while True:
+            key_index, wait_seconds = await _try_reserve()
+            if key_index >= 0:
+                return key_index
+            remaining = _remaining(deadline)
+            if remaining is not None and remaining <= 0:
+                logger.warning(f"Истекло время ожидания свободной квоты Gemini (класс {priority}).")
+                raise _quota_exhausted()
+            await _wait_for_capacity(wait_seconds, deadline)
+    finally:
+        _reservation_lock.release()
+
+
+def _hedge_budget_key() -> str:
+    return f"gemini_hedges:{date.today().isoformat()}"
+
+
+async def reserve_hedge_key(exclude: FrozenSet[int], chat_id: Optional[int] = None) -> Optional[int]:
+    """Резервирует ключ для дублирующего вызова без ожидания: только при свободной квоте на другом ключе
+    и в пределах дневного бюджета хеджирования. Возвращает None, если дублировать нельзя."""
+    redis_client = db_module.redis_client
+    if not redis_client or _reservation_lock.locked():
+        # Кто-то уже ждет квоту - лишней квоты на дублирование нет.
+        return None
+    budget = int(NUM_KEYS * REQUESTS_PER_DAY_LIMIT * GEMINI_HEDGE_BUDGET_PERCENT / 100)
+    try:
+        pipe = redis_client.pipeline(transaction=True)
+        pipe.incr(_hedge_budget_key())
+        pipe.expire(_hedge_budget_key(), 60 * 60 * 48)
+        used, _ = await pipe.execute()
+        if used > budget:
+            await redis_client.decr(_hedge_budget_key())
+            return None
+
+        await _reservation_lock.acquire(priority_rank(PRIORITY_STANDARD), None)
+        try:
+            key_index, _ = await _try_reserve(exclude)
+        finally:
+            _reservation_lock.release()
+        if key_index < 0:
+            await redis_client.decr(_hedge_budget_key())
+            return None
+    except Exception as e:
+        logger.error(f"Не удалось зарезервировать ключ для дублирующего вызова: {e}")
+        return None
+    _chat_in_flight[chat_id] = _chat_in_flight.get(chat_id, 0) + 1
+    logger.info(f"Зарезервирован ключ {key_index} для дублирующего вызова ({used}/{budget} за сутки)")
+    return key_index
+
+
+async def release_key(key_index: int, refund: bool = False, chat_id: Optional[int] = None):
+    remaining = _key_in_flight.get(key_index, 0) - 1
+    if remaining > 0:
+        _key_in_flight[key_index] = remaining
+    else:
+        _key_in_flight.pop(key_index, None)
+    chat_remaining = _chat_in_flight.get(chat_id, 0) - 1
+    if chat_remaining > 0:
+        _chat_in_flight[chat_id] = chat_remaining
+    else:
+        _chat_in_flight.pop(chat_id, None)
+    _slot_released.set()
+
+    if not refund:
+        return
+    if not db_module.redis_client:
+        logger.error("Клиент Redis не инициализирован. Невозможно вернуть квоту.")
+        return
+    try:
+        minute_left, daily_left = await _get_script("release", _RELEASE_SCRIPT)(
+            keys=_key_names(key_index)[:2] + [QUOTA_WAKEUP_KEY, QUOTA_WAITERS_KEY],
+            args=[REQUESTS_PER_MINUTE_LIMIT, REQUESTS_PER_DAY_LIMIT])
+        logger.info(
+            f"Возвращена единица квоты ключу {key_index}. Осталось в минуту: {float(minute_left):.2f}, в день: {daily_left}")
+    except Exception as e:
+        logger.error(f"Не удалось вернуть квоту ключу {key_index}: {e}")
+
+
+async def init_quota_counters():
+    redis_client = db_module.redis_client
+    if not redis_client:
+        return
+    try:
+        now_ts = datetime.now().timestamp()
+        for i in range(NUM_KEYS):
+            key_prefix = f"gemini_key:{i}"
+            await redis_client.setnx(f"{key_prefix}:minute_requests", REQUESTS_PER_MINUTE_LIMIT)
+            await redis_client.setnx(f"{key_prefix}:daily_requests", REQUESTS_PER_DAY_LIMIT)
+            await redis_client.setnx(f"{key_prefix}:last_minute_reset", now_ts)
+            await redis_client.setnx(f"{key_prefix}:last_daily_reset", now_ts)
+        logger.info("Квоты Redis инициализированы/проверены.")
+    except Exception as e:
+        logger.error(f"Не удалось инициализировать квоты Redis: {e}", exc_info=True)
+
+
+async def get_quota_snapshot() -> List[dict]:
+    """Текущие остатки квот всех ключей с учетом пополнения минутного бакета (без записи в Redis)."""
+    redis_client = db_module.redis_client
+    if not redis_client:
+        raise HTTPException(status_code=503, detail="Redis недоступен")
+    pipe = redis_client.pipeline(transaction=False)
+    for i in range(NUM_KEYS):
+        for key in _key_names(i):
+            pipe.get(key)
+    values = await pipe.execute()
+
+    now_ts = datetime.now().timestamp()
+    day_start_ts = datetime.combine(datetime.now().date(), datetime.min.time()).timestamp()
+    snapshot = []
+    for i in range(NUM_KEYS):
+        minute_raw, daily_raw, daily_reset_raw, minute_reset_raw = values[i * 4:i * 4 + 4]
+        tokens = float(minute_raw) if minute_raw is not None else float(REQUESTS_PER_MINUTE_LIMIT)
+        if minute_reset_raw is not None and now_ts > float(minute_reset_raw):
+            tokens = min(float(REQUESTS_PER_MINUTE_LIMIT),
+                         tokens + (now_ts - float(minute_reset_raw)) * REQUESTS_PER_MINUTE_LIMIT / 60)
+        daily_remaining = int(daily_raw) if daily_raw is not None else REQUESTS_PER_DAY_LIMIT
+        if daily_reset_raw is None or float(daily_reset_raw) < day_start_ts:
+            daily_remaining = REQUESTS_PER_DAY_LIMIT
+        snapshot.append({"key_index": i, "minute_requests_remaining": int(tokens),
+                         "daily_requests_remaining": max(0, daily_remaining),
+                         "in_flight": _key_in_flight.get(i, 0), "health": get_key_health(i)})
+    return snapshot
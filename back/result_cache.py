@@ -0,0 +1,160 @@
+import hashlib
+import time
+from typing import Dict, List, Optional
+
+from . import db as db_module
+from .config import (GENERATION_CACHE_ENABLED, GENERATION_CACHE_TTL_SECONDS, GENERATION_CACHE_MAX_BYTES,
+                     GENERATION_PROMPT, logger)
+
+GENERATION_CACHE_LRU_KEY = "generation_cache:lru"
+GENERATION_CACHE_SIZES_KEY = "generation_cache:sizes"
+GENERATION_CACHE_BYTES_KEY = "generation_cache:bytes"
+GENERATION_CACHE_STATS_KEY = "generation_cache:stats"
+
+# Результаты зависят от промпта, поэтому при его изменении старые записи перестают находиться.
+_PROMPT_DIGEST = hashlib.sha256(GENERATION_PROMPT.encode("utf-8")).hexdigest()[:8]
+
+# KEYS: lru, sizes, bytes. ARGV: дайджест, размер записи в байтах, время использования.
+_ACCOUNT_SCRIPT = """
+local previous = tonumber(redis.call('HGET', KEYS[2], ARGV[1]) or '0')
+redis.call('HSET', KEYS[2], ARGV[1], ARGV[2])
+redis.call('ZADD', KEYS[1], ARGV[3], ARGV[1])
+return redis.call('INCRBY', KEYS[3], tonumber(ARGV[2]) - previous)
+"""
+
+# KEYS: lru, sizes, bytes. ARGV: лимит в байтах, время, раньше которого записи уже истекли по TTL.
+# Возвращает вытесненные дайджесты, ключи записей удаляет вызывающий код.
+_EVICT_SCRIPT = """
+local evicted = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', '(' .. ARGV[2])
+local total = tonumber(redis.call('GET', KEYS[3]) or '0')
+for _, digest in ipairs(evicted) do
+    total = total - tonumber(redis.call('HGET', KEYS[2], digest) or '0')
+end
+while total > tonumber(ARGV[1]) do
+    local oldest = redis.call('ZRANGE', KEYS[1], #evicted, #evicted)
+    if #oldest == 0 then
+        break
+    end
+    table.insert(evicted, oldest[1])
+    total = total - tonumber(redis.call('HGET', KEYS[2], oldest[1]) or '0')
+end
+for _, digest in ipairs(evicted) do
+    redis.call('ZREM', KEYS[1], digest)
+    redis.call('DECRBY', KEYS[3], tonumber(redis.call('HGET', KEYS[2], digest) or '0'))
+    redis.call('HDEL', KEYS[2], digest)
+end
+return evicted
+"""
+
+_scripts: Dict[str, object] = {}
+
+
+def _get_script(name: str, source: str):
+    redis_blob_client = db_module.redis_blob_client
+    script = _scripts.get(name)
+    if script is None or script.registered_client is not redis_blob_client:
+        script = redis_blob_client.register_script(source)
+        _scripts[name] = script
+    return script
+
+
+def _entry_key(image_digest: str) -> str:
+    return f"generation_cache:{_PROMPT_DIGEST}:{image_digest}"
+
+
+def _source_key(submission_digest: str) -> str:
+    """Дайджест исходного файла -> дайджест нормализованного изображения: по нему допуск оценивает попадание в кеш
+    до обработки рисунка."""
+    return f"generation_cache:{_PROMPT_DIGEST}:source:{submission_digest}"
+
+
+async def count_cached_images(submission_digest: str) -> int:
+    if not GENERATION_CACHE_ENABLED or not db_module.redis_blob_client:
+        return 0
+    redis_blob_client = db_module.redis_blob_client
+    try:
+        image_digest = await redis_blob_client.get(_source_key(submission_digest))
+        return await redis_blob_client.hlen(_entry_key(image_digest.decode())) if image_digest else 0
+    except Exception as e:
+        logger.warning(f"Не удалось проверить кеш генераций для {submission_digest}: {e}")
+        return 0
+
+
+async def get_cached_images(image_digest: str) -> List[bytes]:
+    """Результаты для того же рисунка: кеш точный, запись ищется по SHA-256 нормализованного изображения.
+    Пересланный или повторно отправленный файл дает тот же дайджест, а похожие рисунки генерируются заново."""
+    if not GENERATION_CACHE_ENABLED or not db_module.redis_blob_client:
+        return []
+    redis_blob_client = db_module.redis_blob_client
+    try:
+        entry = await redis_blob_client.hgetall(_entry_key(image_digest))
+        if not entry:
+            return []
+        # Продлеваем TTL вместе с отметкой LRU, чтобы используемая запись не истекла раньше вытеснения.
+        pipe = redis_blob_client.pipeline(transaction=False)
+        pipe.expire(_entry_key(image_digest), GENERATION_CACHE_TTL_SECONDS)
+        pipe.zadd(GENERATION_CACHE_LRU_KEY, {image_digest: time.time()}, xx=True)
+        await pipe.execute()
+    except Exception as e:
+        logger.warning(f"Не удалось прочитать кеш генераций для {image_digest}: {e}")
+        return []
+    return [entry[index] for index in sorted(entry, key=int)]
+
+
+async def store_cached_images(image_digest: str, images: List[bytes], submission_digest: Optional[str] = None):
+    if not GENERATION_CACHE_ENABLED or not db_module.redis_blob_client or not images:
+        return
+    redis_blob_client = db_module.redis_blob_client
+    entry_key = _entry_key(image_digest)
+    now = time.time()
+    try:
+        pipe = redis_blob_client.pipeline(transaction=True)
+        pipe.delete(entry_key)
+        pipe.hset(entry_key, mapping={str(index): image for index, image in enumerate(images)})
+        pipe.expire(entry_key, GENERATION_CACHE_TTL_SECONDS)
+        if submission_digest:
+            pipe.set(_source_key(submission_digest), image_digest, ex=GENERATION_CACHE_TTL_SECONDS)
+        await pipe.execute()
+        await _get_script("account", _ACCOUNT_SCRIPT)(
+            keys=[GENERATION_CACHE_LRU_KEY, GENERATION_CACHE_SIZES_KEY, GENERATION_CACHE_BYTES_KEY],
+            args=[image_digest, sum(len(image) for image in images), now])
+
+        # Вытесняем давно не использованные записи, пока суммарный размер больше лимита; истекшие по TTL
+        # записи убираем из учета сразу.
+        evicted = await _get_script("evict", _EVICT_SCRIPT)(
+            keys=[GENERATION_CACHE_LRU_KEY, GENERATION_CACHE_SIZES_KEY, GENERATION_CACHE_BYTES_KEY],
+            args=[GENERATION_CACHE_MAX_BYTES, now - GENERATION_CACHE_TTL_SECONDS])
+        evicted_digests = [member.decode() for member in evicted]
+        if evicted_digests:
+            await redis_blob_client.delete(*[_entry_key(evicted_digest) for evicted_digest in evicted_digests])
+            logger.info(f"Из кеша генераций вытеснено записей: {len(evicted_digests)}")
+    except Exception as e:
+        logger.warning(f"Не удалось сохранить результат генерации в кеш для {image_digest}: {e}")
+
+
+async def record_cache_lookup(outcome: str, calls_saved: int):
+    """Учитывает результат обращения к кешу: outcome - hit, partial или miss."""
+    if not GENERATION_CACHE_ENABLED or not db_module.redis_client:
+        return
+    try:
+        pipe = db_module.redis_client.pipeline(transaction=False)
+        pipe.hincrby(GENERATION_CACHE_STATS_KEY, outcome, 1)
+        if calls_saved:
+            pipe.hincrby(GENERATION_CACHE_STATS_KEY, "gemini_calls_saved", calls_saved)
+        await pipe.execute()
+    except Exception as e:
+        logger.warning(f"Не удалось обновить статистику кеша генераций: {e}")
+
+
+async def get_cache_stats() -> dict:
+    stats = await db_module.redis_client.hgetall(GENERATION_CACHE_STATS_KEY)
+    hits = int(stats.get("hit", 0))
+    partial = int(stats.get("partial", 0))
+    misses = int(stats.get("miss", 0))
+    lookups = hits + partial + misses
+    return {"enabled": GENERATION_CACHE_ENABLED, "hits": hits, "partial_hits": partial, "misses": misses,
+            "hit_rate": round(hits / lookups, 4) if lookups else 0.0,
+            "gemini_calls_saved": int(stats.get("gemini_calls_saved", 0)),
+            "entries": await db_module.redis_client.zcard(GENERATION_CACHE_LRU_KEY),
+            "bytes": int(await db_module.redis_client.get(GENERATION_CACHE_BYTES_KEY) or 0),
+            "max_bytes": GENERATION_CACHE_MAX_BYTES}
@@ -0,0 +1,338 @@
+import asyncio
+import sys
+from datetime import datetime, timedelta
+from typing import List, Optional
+
+from pymongo import ReplaceOne, UpdateOne
+
+from . import db as db_module
+from .config import STATS_ROLLUPS_REBUILD_LOCK_SECONDS, logger
+
+STATS_ROLLUPS_TOTAL_ID = "total"
+STATS_ROLLUPS_REBUILD_LOCK_KEY = "stats_rollups:rebuild_lock"
+# HyperLogLog генерировавших пользователей за день: активные за неделю - объединение последних дней.
+STATS_ACTIVE_USERS_KEY_PREFIX = "stats_active_users:"
+ACTIVE_USERS_WINDOW_DAYS = 7
+HIGH_LTV_THRESHOLD = 1000.0
+DAY_MS = 24 * 60 * 60 * 1000
+
+# Ссылки на фоновые обновления счетчиков, чтобы задачи не были собраны сборщиком мусора до завершения.
+_pending_updates = set()
+
+
+def _day_id(moment: datetime) -> str:
+    return f"day:{moment.strftime('%Y-%m-%d')}"
+
+
+def _source_id(source_code: Optional[str]) -> str:
+    return f"source:{source_code or ''}"
+
+
+def _ms_between(later: Optional[datetime], earlier: Optional[datetime]) -> Optional[float]:
+    if not later or not earlier:
+        return None
+    return (later - earlier).total_seconds() * 1000
+
+
+def _active_users_key(moment: datetime) -> str:
+    return f"{STATS_ACTIVE_USERS_KEY_PREFIX}{moment.strftime('%Y-%m-%d')}"
+
+
+async def _apply_updates(operations: List[UpdateOne], increments: dict):
+    try:
+        await db_module.stats_rollups_collection.bulk_write(operations, ordered=False)
+    except Exception as e:
+        # Увеличения логируются целиком: по ним видно расхождение сводок до пересчета (POST /stats/rebuild).
+        logger.error(f"Не удалось обновить счетчики статистики {increments}: {e}")
+
+
+async def _mark_active(chat_id: int, moment: datetime):
+    redis_client = db_module.redis_client
+    if not redis_client:
+        return
+    try:
+        pipe = redis_client.pipeline(transaction=False)
+        pipe.pfadd(_active_users_key(moment), chat_id)
+        pipe.expire(_active_users_key(moment), (ACTIVE_USERS_WINDOW_DAYS + 1) * 24 * 60 * 60)
+        await pipe.execute()
+    except Exception as e:
+        logger.error(f"Не удалось отметить активность пользователя {chat_id} в статистике: {e}")
+
+
+def _run_in_background(coroutine):
+    task = asyncio.create_task(coroutine)
+    _pending_updates.add(task)
+    task.add_done_callback(_pending_updates.discard)
+
+
+def _bump(moment: datetime, total: dict, day: Optional[dict] = None, user: Optional[dict] = None,
+          source: Optional[dict] = None):
+    """Атомарно увеличивает счетчики общей, дневной и источниковой сводок в фоне, не задерживая ответ."""
+    if db_module.stats_rollups_collection is None:
+        return
+    operations = [UpdateOne({"_id": STATS_ROLLUPS_TOTAL_ID}, {"$inc": total}, upsert=True)] if total else []
+    if day:
+        operations.append(UpdateOne({"_id": _day_id(moment)},
+                                    {"$inc": day, "$setOnInsert": {"date": moment.strftime("%Y-%m-%d")}},
+                                    upsert=True))
+    if source and user is not None:
+        source_code = user.get("advertising_source")
+        operations.append(UpdateOne({"_id": _source_id(source_code)},
+                                    {"$inc": source, "$setOnInsert": {"source_code": source_code}}, upsert=True))
+    _run_in_background(_apply_updates(operations, {"total": total, "day": day, "source": source}))
+
+
+def _repeat_user_terms(generation_count: int, user: dict) -> dict:
+    """Вклад пользователя в суммы глубины активности и интервала между генерациями (только от 2 генераций)."""
+    depth_ms = _ms_between(user.get("last_generation_time"), user.get("first_generation_time"))
+    if generation_count < 2 or depth_ms is None:
+        return {"repeat_users": 0, "activity_depth_sum_ms": 0, "time_between_sum_ms": 0}
+    return {"repeat_users": 1, "activity_depth_sum_ms": depth_ms,
+            "time_between_sum_ms": depth_ms / (generation_count - 1)}
+
+
+def _terms_delta(before: dict, after: dict) -> dict:
+    return {field: after[field] - before[field] for field in after if after[field] != before[field]}
+
+
+def _first_generation_terms(first_generation_time: datetime, user: dict, sign: int) -> dict:
+    """Вклад первой генерации во время до первой генерации (sign = -1 - при ее возврате)."""
+    time_to_first_gen_ms = _ms_between(first_generation_time, user.get("registered_at"))
+    if time_to_first_gen_ms is None:
+        return {}
+    terms = {"time_to_first_gen_sum_ms": sign * time_to_first_gen_ms, "time_to_first_gen_count": sign}
+    for days in (1, 7, 30):
+        if time_to_first_gen_ms <= days * DAY_MS:
+            terms[f"users_within_{days}_days"] = sign
+    return terms
+
+
+def record_user_created(user: dict):
+    _bump(user["registered_at"], {"total_users": 1, "users_with_zero_generations": 1},
+          day={"users_registered": 1}, user=user, source={"user_count": 1})
+
+
+def record_generation(user: dict, first_generation: bool):
+    """Учитывает списание генерации по документу пользователя после обновления."""
+    now = user["last_generation_time"]
+    generation_count = user["generation_count"]
+    total = {"total_generations": 1}
+    day = {"generations": 1}
+    source = {"total_generations": 1}
+    if generation_count == 1:
+        total["users_with_zero_generations"] = -1
+        source["users_with_generations"] = 1
+    if first_generation:
+        day["first_generations"] = 1
+        total.update(_first_generation_terms(user["first_generation_time"], user, 1))
+    previous = dict(user, last_generation_time=user.get("previous_generation_time"))
+    total.update(_terms_delta(_repeat_user_terms(generation_count - 1, previous),
+                              _repeat_user_terms(generation_count, user)))
+    _bump(now, total, day=day, user=user, source=source)
+    _run_in_background(_mark_active(user["chat_id"], now))
+
+
+def record_generation_refund(user: dict, first_generation_time: Optional[datetime] = None):
+    """Учитывает возврат генерации по документу пользователя после обновления. first_generation_time - время
+    возвращенной первой генерации, если возврат снял отметку о ней."""
+    generation_count = user["generation_count"]
+    total = {"total_generations": -1}
+    source = {"total_generations": -1}
+    if generation_count == 0:
+        total["users_with_zero_generations"] = 1
+        source["users_with_generations"] = -1
+    total.update(_terms_delta(_repeat_user_terms(generation_count + 1, user),
+                              _repeat_user_terms(generation_count, user)))
+    _bump(datetime.now(), total, day={"generations": -1}, user=user, source=source)
+    if first_generation_time is not None:
+        _bump(first_generation_time, _first_generation_terms(first_generation_time, user, -1),
+              day={"first_generations": -1})
+
+
+def _user_totals_pipeline() -> list:
+    """Пользовательская часть общей сводки, пересчитанная по документам пользователей."""
+    time_to_first_gen = {"$subtract": ["$first_generation_time", "$registered_at"]}
+    activity_depth = {"$subtract": ["$last_generation_time", "$first_generation_time"]}
+    is_repeat_user = {"$and": [{"$gte": ["$generation_count", 2]}, {"$ne": [activity_depth, None]}]}
+
+    def first_gen_within(days: int) -> dict:
+        return {"$sum": {"$cond": [{"$and": [{"$ne": [time_to_first_gen, None]},
+                                             {"$lte": [time_to_first_gen, days * DAY_MS]}]}, 1, 0]}}
+
+    return [{"$group": {
+        "_id": None,
+        "total_users": {"$sum": 1},
+        "total_generations": {"$sum": "$generation_count"},
+        "users_with_zero_generations": {"$sum": {"$cond": [{"$eq": ["$generation_count", 0]}, 1, 0]}},
+        "time_to_first_gen_sum_ms": {"$sum": time_to_first_gen},
+        "time_to_first_gen_count": {"$sum": {"$cond": [{"$ne": [time_to_first_gen, None]}, 1, 0]}},
+        "users_within_1_days": first_gen_within(1),
+        "users_within_7_days": first_gen_within(7),
+        "users_within_30_days": first_gen_within(30),
+        "repeat_users": {"$sum": {"$cond": [is_repeat_user, 1, 0]}},
+        "activity_depth_sum_ms": {"$sum": {"$cond": [is_repeat_user, activity_depth, 0]}},
+        "time_between_sum_ms": {"$sum": {"$cond": [is_repeat_user, {
+            "$divide": [activity_depth, {"$subtract": ["$generation_count", 1]}]}, 0]}},
+    }}, {"$project": {"_id": 0}}]
+
+
+def _payment_totals_pipeline() -> list:
+    """Платежная часть общей сводки, пересчитанная по коллекции payments."""
+    is_succeeded = {"$eq": ["$status", "succeeded"]}
+    return [
+        {"$group": {"_id": "$chat_id",
+                    "successful_payments_count": {"$sum": {"$cond": [is_succeeded, 1, 0]}},
+                    "revenue": {"$sum": {"$cond": [is_succeeded, "$price", 0]}},
+                    "has_failed_payment": {"$max": {"$in": ["$status", ["failed", "canceled"]]}}}},
+        {"$group": {
+            "_id": None,
+            "total_revenue": {"$sum": "$revenue"},
+            "total_successful_payments": {"$sum": "$successful_payments_count"},
+            "total_repeat_payments": {"$sum": {"$max": [{"$subtract": ["$successful_payments_count", 1]}, 0]}},
+            "paying_users": {"$sum": {"$cond": [{"$gt": ["$successful_payments_count", 0]}, 1, 0]}},
+            "users_with_high_ltv": {"$sum": {"$cond": [{"$gt": ["$revenue", HIGH_LTV_THRESHOLD]}, 1, 0]}},
+            "users_with_failed_payments": {"$sum": {"$cond": ["$has_failed_payment", 1, 0]}},
+        }},
+        {"$project": {"_id": 0}},
+    ]
+
+
+def _per_day_pipeline(date_field: str, counter: str) -> list:
+    return [{"$match": {date_field: {"$type": "date"}}},
+            {"$group": {"_id": {"$dateToString": {"format": "%Y-%m-%d", "date": f"${date_field}"}},
+                        counter: {"$sum": 1}}}]
+
+
+async def _compute_rollups() -> dict:
+    users = db_module.users_collection
+    rollups = {}
+
+    payments = db_module.payments_collection
+    total = {"_id": STATS_ROLLUPS_TOTAL_ID}
+    for pipeline_totals in (await users.aggregate(_user_totals_pipeline()).to_list(None),
+                            await payments.aggregate(_payment_totals_pipeline()).to_list(None)):
+        if pipeline_totals:
+            total.update(pipeline_totals[0])
+    rollups[STATS_ROLLUPS_TOTAL_ID] = total
+
+    def day_doc(day: str) -> dict:
+        return rollups.setdefault(f"day:{day}", {"_id": f"day:{day}", "date": day})
+
+    for row in await users.aggregate(_per_day_pipeline("registered_at", "users_registered")).to_list(None):
+        day_doc(row["_id"])["users_registered"] = row["users_registered"]
+    for row in await users.aggregate(_per_day_pipeline("first_generation_time", "first_generations")).to_list(None):
+        day_doc(row["_id"])["first_generations"] = row["first_generations"]
+
+    payments_pipeline = [
+        {"$match": {"status": "succeeded"}},
+        {"$group": {"_id": {"$dateToString": {"format": "%Y-%m-%d", "date": "$created_at"}},
+                    "revenue": {"$sum": "$price"}, "successful_payments": {"$sum": 1}}}]
+    for row in await payments.aggregate(payments_pipeline).to_list(None):
+        day_doc(row["_id"]).update(revenue=row["revenue"], successful_payments=row["successful_payments"])
+
+    if db_module.balance_ledger_collection is not None:
+        ledger_pipeline = [
+            {"$match": {"kind": {"$in": ["generation", "refund"]}}},
+            {"$group": {"_id": {"$dateToString": {"format": "%Y-%m-%d", "date": "$created_at"}},
+                        "generations": {"$sum": {"$cond": [{"$eq": ["$kind", "generation"]}, 1, -1]}}}}]
+        for row in await db_module.balance_ledger_collection.aggregate(ledger_pipeline).to_list(None):
+            day_doc(row["_id"])["generations"] = row["generations"]
+
+    sources_pipeline = [{"$group": {"_id": "$advertising_source", "user_count": {"$sum": 1},
+                                    "total_generations": {"$sum": "$generation_count"},
+                                    "users_with_generations": {
+                                        "$sum": {"$cond": [{"$gt": ["$generation_count", 0]}, 1, 0]}}}}]
+    for row in await users.aggregate(sources_pipeline).to_list(None):
+        source_code = row.pop("_id")
+        rollups[_source_id(source_code)] = {"_id": _source_id(source_code), "source_code": source_code, **row}
+
+    return rollups
+
+
+async def _seed_active_users():
+    """Заполняет дневные HyperLogLog активных пользователей по last_generation_time: после развертывания
+    активные за неделю видны сразу, а не через ACTIVE_USERS_WINDOW_DAYS дней."""
+    window_start = datetime.combine(datetime.now().date() - timedelta(days=ACTIVE_USERS_WINDOW_DAYS - 1),
+                                    datetime.min.time())
+    active_by_day = {}
+    async for user in db_module.users_collection.find({"last_generation_time": {"$gte": window_start}},
+                                                      {"_id": 0, "chat_id": 1, "last_generation_time": 1}):
+        active_by_day.setdefault(_active_users_key(user["last_generation_time"]), []).append(user["chat_id"])
+    pipe = db_module.redis_client.pipeline(transaction=False)
+    for key, chat_ids in active_by_day.items():
+        pipe.pfadd(key, *chat_ids)
+        pipe.expire(key, (ACTIVE_USERS_WINDOW_DAYS + 1) * 24 * 60 * 60)
+    await pipe.execute()
+
+
+async def rebuild_rollups() -> Optional[dict]:
+    """Пересчитывает все сводки по исходным данным (пользователи, платежи, журнал баланса) и заменяет их.
+    Тяжелая операция - полный проход по коллекциям: запускается вручную (POST /stats/rebuild или
+    python -m back.rollups) при расхождениях и один раз сама, если общей сводки еще нет.
+    None - пересчет уже выполняется."""
+    redis_client = db_module.redis_client
+    if not redis_client:
+        raise RuntimeError("Redis недоступен, пересчет сводок без блокировки не выполняется")
+    if not await redis_client.set(STATS_ROLLUPS_REBUILD_LOCK_KEY, 1, nx=True, ex=STATS_ROLLUPS_REBUILD_LOCK_SECONDS):
+        logger.warning("Пересчет сводок статистики уже выполняется.")
+        return None
+    try:
+        rollups = await _compute_rollups()
+        # Документы заменяются по одному, а не удаляются целиком: сводки не пропадают для читателей, а счетчики,
+        # не затронутые пересчетом, продолжают обновляться. Увеличения, пришедшие между чтением исходных данных
+        # и заменой документа, теряются - запускать в спокойное время.
+        await db_module.stats_rollups_collection.bulk_write(
+            [ReplaceOne({"_id": rollup_id}, rollup, upsert=True) for rollup_id, rollup in rollups.items()],
+            ordered=False)
+        await _seed_active_users()
+    finally:
+        await redis_client.delete(STATS_ROLLUPS_REBUILD_LOCK_KEY)
+    logger.info(f"Сводки статистики пересчитаны: {len(rollups)} документов.")
+    return {"documents": len(rollups)}
+
+
+async def get_total_rollup() -> dict:
+    total = await db_module.stats_rollups_collection.find_one({"_id": STATS_ROLLUPS_TOTAL_ID})
+    if total is not None:
+        return total
+    # Первое чтение после развертывания: сводок еще нет, пересчитываем их один раз под той же блокировкой.
+    logger.warning("Общая сводка статистики не найдена, выполняется первоначальный пересчет сводок.")
+    try:
+        rebuilt = await rebuild_rollups()
+    except Exception as e:
+        logger.error(f"Не удалось выполнить первоначальный пересчет сводок: {e}", exc_info=True)
+        return {}
+    if rebuilt is None:
+        # Пересчет уже выполняет другой процесс, до его завершения отдаем нули.
+        return {}
+    return await db_module.stats_rollups_collection.find_one({"_id": STATS_ROLLUPS_TOTAL_ID}) or {}
+
+
+async def count_active_users() -> int:
+    """Приблизительное (HyperLogLog, погрешность ~1%) число пользователей с генерацией за последние
+    ACTIVE_USERS_WINDOW_DAYS календарных дней, включая сегодняшний."""
+    redis_client = db_module.redis_client
+    if not redis_client:
+        return 0
+    today = datetime.now()
+    return await redis_client.pfcount(*[_active_users_key(today - timedelta(days=offset))
+                                        for offset in range(ACTIVE_USERS_WINDOW_DAYS)])
+
+
+async def get_daily_rollups(days: int) -> List[dict]:
+    since = (datetime.now() - timedelta(days=days - 1)).strftime("%Y-%m-%d")
+    cursor = db_module.stats_rollups_collection.find({"date": {"$gte": since}}, {"_id": 0})
+    return await cursor.sort("date", 1).to_list(None)
+
+
+async def get_source_rollups() -> List[dict]:
+    return await db_module.stats_rollups_collection.find({"_id": {"$regex": "^source:"}}).to_list(None)
+
+
+async def _rebuild_cli() -> int:
+    await db_module.connect_redis()
+    return 0 if await rebuild_rollups() else 1
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(_rebuild_cli()))
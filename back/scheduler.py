@@ -0,0 +1,196 @@
+import asyncio
+import time
+import uuid
+from typing import Dict, Optional
+
+from fastapi import HTTPException
+
+from . import db as db_module
+from .config import (GENERATION_MAX_CONCURRENT_PER_CHAT, GENERATION_CHAT_SLOT_TTL_SECONDS, GEMINI_KEY_WAIT_TIMEOUT_SECONDS,
+                     logger)
+
+PRIORITY_PAID = "paid"
+PRIORITY_FIRST_FREE = "first_free"
+PRIORITY_STANDARD = "standard"
+PRIORITY_BONUS = "bonus"
+# Меньше - раньше: при нехватке квоты первыми обслуживаются оплатившие пользователи, бонусные изображения - последними.
+PRIORITY_RANKS = {PRIORITY_PAID: 0, PRIORITY_FIRST_FREE: 1, PRIORITY_STANDARD: 2, PRIORITY_BONUS: 3}
+
+GENERATION_QUEUE_STATS_KEY = "generation_queue:stats"
+# Процесс -> "глубина:время обновления": очередь за квотой всех процессов для оценки ожидания при допуске.
+GENERATION_QUEUE_DEPTH_KEY = "generation_queue:depth"
+
+_RELEASE_CHAT_SLOT_SCRIPT = """
+if redis.call('DECR', KEYS[1]) <= 0 then
+    redis.call('DEL', KEYS[1])
+end
+"""
+
+# Число вызовов, ожидающих квоту в этом процессе, по классам приоритета.
+_queue_depth: Dict[str, int] = {}
+_PROCESS_ID = uuid.uuid4().hex
+_depth_publish: Optional[asyncio.Task] = None
+_depth_dirty = False
+
+
+def _chat_slots_key(chat_id: int) -> str:
+    return f"generation_active:{chat_id}"
+
+
+def _submission_key(chat_id: int, submission_digest: str) -> str:
+    return f"generation_submission:{chat_id}:{submission_digest}"
+
+
+def generation_priority(user: dict, generation_count: int) -> str:
+    if user.get("has_successful_payment"):
+        return PRIORITY_PAID
+    if generation_count == 1:
+        return PRIORITY_FIRST_FREE
+    return PRIORITY_STANDARD
+
+
+def priority_rank(priority: str) -> int:
+    return PRIORITY_RANKS.get(priority, PRIORITY_RANKS[PRIORITY_STANDARD])
+
+
+def queue_entered(priority: str):
+    _queue_depth[priority] = _queue_depth.get(priority, 0) + 1
+    _schedule_depth_publish()
+
+
+def queue_left(priority: str):
+    _queue_depth[priority] = max(0, _queue_depth.get(priority, 0) - 1)
+    _schedule_depth_publish()
+
+
+def total_queue_depth() -> int:
+    return sum(_queue_depth.values())
+
+
+def _schedule_depth_publish():
+    """Публикует глубину очереди процесса в Redis в фоне; изменения во время записи сливаются в одну запись."""
+    global _depth_publish, _depth_dirty
+    _depth_dirty = True
+    if db_module.redis_client and (_depth_publish is None or _depth_publish.done()):
+        _depth_publish = asyncio.create_task(_publish_queue_depth())
+
+
+async def _publish_queue_depth():
+    global _depth_dirty
+    while _depth_dirty:
+        _depth_dirty = False
+        try:
+            pipe = db_module.redis_client.pipeline(transaction=False)
+            pipe.hset(GENERATION_QUEUE_DEPTH_KEY, _PROCESS_ID, f"{total_queue_depth()}:{time.time()}")
+            pipe.expire(GENERATION_QUEUE_DEPTH_KEY, GEMINI_KEY_WAIT_TIMEOUT_SECONDS * 2)
+            await pipe.execute()
+        except Exception as e:
+            logger.warning(f"Не удалось опубликовать глубину очереди генераций: {e}")
+            return
+
+
+async def cluster_queue_depth() -> int:
+    """Число вызовов, ожидающих квоту во всех процессах. Вызов ждет квоту не дольше GEMINI_KEY_WAIT_TIMEOUT_SECONDS,
+    поэтому запись процесса, не обновлявшаяся дольше, устарела (очередь опустела или процесс упал). Без Redis -
+    только очередь этого процесса."""
+    depth = total_queue_depth()
+    redis_client = db_module.redis_client
+    if not redis_client:
+        return depth
+    try:
+        entries = await redis_client.hgetall(GENERATION_QUEUE_DEPTH_KEY)
+    except Exception as e:
+        logger.warning(f"Не удалось прочитать глубину очереди генераций: {e}")
+        return depth
+    fresh_after = time.time() - GEMINI_KEY_WAIT_TIMEOUT_SECONDS
+    stale = []
+    for process_id, value in entries.items():
+        process_depth, updated_at = value.split(":")
+        if float(updated_at) < fresh_after:
+            stale.append(process_id)
+        elif process_id != _PROCESS_ID:
+            depth += int(process_depth)
+    if stale:
+        try:
+            await redis_client.hdel(GENERATION_QUEUE_DEPTH_KEY, *stale)
+        except Exception:
+            pass
+    return depth
+
+
+async def record_queue_wait(priority: str, wait_seconds: float, reserved: bool):
+    if not db_module.redis_client:
+        return
+    try:
+        pipe = db_module.redis_client.pipeline(transaction=False)
+        if reserved:
+            pipe.hincrby(GENERATION_QUEUE_STATS_KEY, f"{priority}:reserved", 1)
+            pipe.hincrbyfloat(GENERATION_QUEUE_STATS_KEY, f"{priority}:wait_seconds_total", wait_seconds)
+        else:
+            pipe.hincrby(GENERATION_QUEUE_STATS_KEY, f"{priority}:timed_out", 1)
+        await pipe.execute()
+    except Exception as e:
+        logger.warning(f"Не удалось обновить статистику очереди генераций: {e}")
+
+
+async def get_queue_stats() -> dict:
+    stats = await db_module.redis_client.hgetall(GENERATION_QUEUE_STATS_KEY)
+    classes = {}
+    for priority in PRIORITY_RANKS:
+        reserved = int(stats.get(f"{priority}:reserved", 0))
+        wait_total = float(stats.get(f"{priority}:wait_seconds_total", 0))
+        classes[priority] = {"queue_depth": _queue_depth.get(priority, 0), "reserved": reserved,
+                             "timed_out": int(stats.get(f"{priority}:timed_out", 0)),
+                             "avg_wait_seconds": round(wait_total / reserved, 3) if reserved else 0.0}
+    return classes
+
+
+async def acquire_chat_slot(chat_id: int, submission_digest: Optional[str] = None):
+    """Ограничивает число одновременных генераций одного чата (включая стоящие в очереди задачи) и не дает
+    запустить повторно рисунок с тем же содержимым, пока он уже генерируется (409)."""
+    redis_client = db_module.redis_client
+    if not redis_client:
+        return
+    if submission_digest:
+        # TTL страхует от утечки отметки и слота, если процесс упал, не освободив их.
+        is_new = await redis_client.set(_submission_key(chat_id, submission_digest), 1, nx=True,
+                                        ex=GENERATION_CHAT_SLOT_TTL_SECONDS)
+        if not is_new:
+            logger.warning(f"Пользователь {chat_id} повторно отправил рисунок, который уже генерируется.")
+            raise HTTPException(status_code=409, detail="Этот рисунок уже генерируется")
+    pipe = redis_client.pipeline(transaction=True)
+    pipe.incr(_chat_slots_key(chat_id))
+    pipe.expire(_chat_slots_key(chat_id), GENERATION_CHAT_SLOT_TTL_SECONDS)
+    active, _ = await pipe.execute()
+    if active > GENERATION_MAX_CONCURRENT_PER_CHAT:
+        await release_chat_slot(chat_id, submission_digest)
+        logger.warning(f"Пользователь {chat_id} превысил лимит одновременных генераций ({GENERATION_MAX_CONCURRENT_PER_CHAT}).")
+        raise HTTPException(status_code=429, detail="Дождитесь завершения текущей генерации")
+
+
+async def extend_chat_slot(chat_id: int, submission_digest: Optional[str], ttl_seconds: int):
+    """Продлевает слот чата (и отметку рисунка) на время жизни задачи очереди, чтобы он не истек, пока задача ждет
+    воркера."""
+    redis_client = db_module.redis_client
+    if not redis_client:
+        return
+    try:
+        pipe = redis_client.pipeline(transaction=False)
+        pipe.expire(_chat_slots_key(chat_id), ttl_seconds)
+        if submission_digest:
+            pipe.expire(_submission_key(chat_id, submission_digest), ttl_seconds)
+        await pipe.execute()
+    except Exception as e:
+        logger.warning(f"Не удалось продлить слот генерации пользователя {chat_id}: {e}")
+
+
+async def release_chat_slot(chat_id: int, submission_digest: Optional[str] = None):
+    redis_client = db_module.redis_client
+    if not redis_client:
+        return
+    try:
+        await redis_client.eval(_RELEASE_CHAT_SLOT_SCRIPT, 1, _chat_slots_key(chat_id))
+        if submission_digest:
+            await redis_client.delete(_submission_key(chat_id, submission_digest))
+    except Exception as e:
+        logger.error(f"Не удалось освободить слот генерации пользователя {chat_id}: {e}")
@@ -1,20 +1,35 @@
 import asyncio
 import base64
+import hashlib
+import math
+import time
 import uuid
+from contextlib import aclosing
 from datetime import datetime
-from io import BytesIO
-from typing import List
+from typing import AsyncIterator, List, Optional, Tuple
 
-from PIL import Image
 from fastapi import HTTPException, Header
-from google import genai
 from google.genai import types as genai_types
 from yookassa import Payment as YooKassaPayment
 
-from .config import (GEMINI_API_KEYS, NUM_KEYS, REQUESTS_PER_MINUTE_LIMIT, REQUESTS_PER_DAY_LIMIT, GENERATION_PROMPT,
-                     API_KEY, logger, TELEGRAM_BOT_USERNAME)
-from .db import redis_client, users_collection, get_db_user
-from .models import GenerationResponse, PaymentInfo
+from .admission import check_admission
+from .blobs import put_blob
+from .config import (GEMINI_API_KEYS, GENERATION_PROMPT, API_KEY, logger, TELEGRAM_BOT_USERNAME,
+                     GEMINI_KEY_WAIT_TIMEOUT_SECONDS, GENERATION_CACHE_BILL_HITS, GEMINI_CANDIDATES_PER_CALL,
+                     GENERATION_BONUS_WAIT_SECONDS, GENERATION_ADMISSION_MAX_WAIT_SECONDS,
+                     GENERATION_DEADLINE_SECONDS)
+from .db import users_collection, payments_collection, get_db_user
+from .gemini import generate_content
+from .images import prepare_image_part
+from .key_health import record_call_result, release_probe, hedge_delay_seconds
+from .ledger import apply_balance_op, record_ledger_entry
+from .models import GenerationResponse, PaymentInfo, GenerationDebit
+from .quota import reserve_key, reserve_hedge_key, release_key
+from .rollups import record_generation, record_generation_refund
+from .result_cache import get_cached_images, store_cached_images, count_cached_images, record_cache_lookup
+from .scheduler import PRIORITY_BONUS, generation_priority, acquire_chat_slot, release_chat_slot
+
+MAIN_IMAGES_PER_GENERATION = 4
 
 
 async def get_api_key_dependency(
@@ -25,231 +40,423 @@ async def get_api_key_dependency(
     return internal_api_key
 
 
-async def reset_daily_quota(key_index: int):
-    if not redis_client:
-        logger.error("Сервис Redis недоступен, не могу сбросить дневную квоту.")
-        return
-    key_prefix = f"gemini_key:{key_index}"
-    try:
-        await redis_client.set(f"{key_prefix}:daily_requests", REQUESTS_PER_DAY_LIMIT)
-        await redis_client.set(f"{key_prefix}:last_daily_reset", datetime.now().timestamp())
-        logger.info(f"Дневной лимит для ключа {key_index} сброшен.")
-    except Exception as e:
-        logger.error(f"Не удалось сбросить дневную квоту для ключа {key_index}: {e}")
-
-
-async def get_available_key() -> int:
-    if not redis_client:
-        logger.error("Клиент Redis не инициализирован. Невозможно получить API-ключ.")
-        raise HTTPException(status_code=503, detail="Сервис временно недоступен (Redis)")
-
-    while True:
-        available_keys_quota = []
-        current_time = datetime.now()
-        for i in range(NUM_KEYS):
-            key_prefix = f"gemini_key:{i}"
-            try:
-                last_daily_reset_ts_bytes = await redis_client.get(f"{key_prefix}:last_daily_reset")
-                if last_daily_reset_ts_bytes:
-                    last_daily_reset_ts = float(last_daily_reset_ts_bytes)
-                    last_daily_reset_time = datetime.fromtimestamp(last_daily_reset_ts)
-                    if current_time.day != last_daily_reset_time.day:
-                        await reset_daily_quota(i)
-                else:
-                    await reset_daily_quota(i)
-
-                minute_requests_bytes = await redis_client.get(f"{key_prefix}:minute_requests")
-                daily_requests_bytes = await redis_client.get(f"{key_prefix}:daily_requests")
-
-                minute_requests_remaining = int(
-                    minute_requests_bytes) if minute_requests_bytes else REQUESTS_PER_MINUTE_LIMIT
-                daily_requests_remaining = int(daily_requests_bytes) if daily_requests_bytes else REQUESTS_PER_DAY_LIMIT
-
-                if minute_requests_remaining > 0 and daily_requests_remaining > 0:
-                    available_keys_quota.append({'index': i, 'daily_quota': daily_requests_remaining})
-
-            except ConnectionError as e:
-                logger.error(f"Ошибка подключения Redis при проверке ключа {i}: {e}")
-                raise HTTPException(status_code=503, detail="Сервис временно недоступен (Redis)")
-            except Exception as e:
-                logger.error(f"Ошибка проверки квоты для ключа {i}: {e}")
-
-        if available_keys_quota:
-            best_key = max(available_keys_quota, key=lambda k: k['daily_quota'])
-            logger.info(f"Выбран индекс ключа Gemini {best_key['index']} с дневной квотой: {best_key['daily_quota']}")
-            return best_key['index']
-        else:
-            logger.info("Нет доступных ключей Gemini в соответствии с квотой, ожидание...")
-            await asyncio.sleep(0.2)
-
-
-async def decrement_quota(key_index: int):
-    if not redis_client:
-        logger.error("Клиент Redis не инициализирован. Невозможно уменьшить квоту.")
-        return
+async def _apply_referral_bonus(chat_id: int, referrer_id: int):
+    # Идентификатор операции не дает начислить бонус дважды за одного приглашенного.
+    referrer_user = await apply_balance_op(referrer_id, f"referral:{chat_id}",
+                                           [{"$set": {"ozhivashki": {"$add": ["$ozhivashki", 2]}}}])
+    if referrer_user:
+        record_ledger_entry(f"referral:{chat_id}", referrer_id, "referral_bonus", 2, referrer_user.get("ozhivashki"))
+        logger.info(
+            f"Начислено 2 реферальных оживашки пригласившему {referrer_id} за первую генерацию пользователя {chat_id}.")
+    else:
+        logger.warning(f"Пригласивший {referrer_id} не найден для пользователя {chat_id} или бонус уже начислен.")
 
-    key_prefix = f"gemini_key:{key_index}"
-    try:
-        minute_requests_remaining = await redis_client.decr(f"{key_prefix}:minute_requests")
-        if minute_requests_remaining < 0:
-            await redis_client.set(f"{key_prefix}:minute_requests", 0)
-
-        daily_requests_remaining = await redis_client.decr(f"{key_prefix}:daily_requests")
-        if daily_requests_remaining < 0:
-            await redis_client.set(f"{key_prefix}:daily_requests", 0)
-
-        logger.info(f"Уменьшена квота для ключа {key_index}. "
-                    f"Осталось в минуту: {max(0, minute_requests_remaining if minute_requests_remaining is not None else 0)}, "
-                    f"Осталось в день: {max(0, daily_requests_remaining if daily_requests_remaining is not None else 0)}")
-    except ConnectionError as e:
-        logger.error(f"Ошибка подключения Redis при уменьшении квоты для ключа {key_index}: {e}")
-    except Exception as e:
-        logger.error(f"Не удалось уменьшить квоту для ключа {key_index}: {e}")
 
+async def _call_gemini(chat_id: int, selected_key_index: int, image_part: genai_types.Part, call_number: int,
+                       total_calls: int, candidate_count: int) -> Optional[List[bytes]]:
+    """Выполняет вызов модели на зарезервированном ключе. None - вызов не удался и квоту ключа нужно вернуть."""
+    started = time.monotonic()
+    logger.info(
+        f"Выполнение вызова Gemini #{call_number}/{total_calls} ({candidate_count} изобр.) с использованием ключа с индексом {selected_key_index} для пользователя {chat_id}")
 
-async def _apply_referral_bonus(chat_id: int, referrer_id: int):
-    if not users_collection:
-        logger.error("Коллекция пользователей не инициализирована, не могу применить реферальный бонус.")
-        return
-    referrer_user = await get_db_user(referrer_id)
-    if referrer_user:
-        referrer_update_result = await users_collection.update_one({"chat_id": referrer_id},
-            {"$inc": {"ozhivashki": 2}})
-        if referrer_update_result.modified_count > 0:
-            await users_collection.update_one({"chat_id": chat_id}, {"$set": {"referral_bonus_claimed": True}})
-            logger.info(
-                f"Начислено 2 реферальных оживашки пригласившему {referrer_id} за первую генерацию пользователя {chat_id}.")
-        else:
-            logger.warning(f"Не удалось обновить баланс оживашек пригласившего {referrer_id}.")
+    generation_config = genai_types.GenerateContentConfig(temperature=0.6, candidate_count=candidate_count)
+
+    try:
+        response = await generate_content(selected_key_index, [GENERATION_PROMPT, image_part], generation_config)
+    except Exception as e:
+        logger.error(f"Ошибка вызова Gemini #{call_number} для пользователя {chat_id}: {e}")
+        record_call_result(selected_key_index, time.monotonic() - started, "error")
+        return None
+    latency = time.monotonic() - started
+
+    images = []
+    if response.candidates:
+        if response.prompt_feedback and response.prompt_feedback.block_reason:
+            block_reason = response.prompt_feedback.block_reason.name
+            block_msg = response.prompt_feedback.block_reason_message
+            logger.error(f"Генерация заблокирована для вызова #{call_number}. Причина: {block_reason} - {block_msg}")
+            record_call_result(selected_key_index, latency, "blocked")
+            raise HTTPException(status_code=400, detail=f"Генерация заблокирована: {block_reason} - {block_msg}")
+
+        # Берем первое изображение каждого кандидата.
+        for candidate in response.candidates:
+            if candidate.content and candidate.content.parts:
+                for part in candidate.content.parts:
+                    if part.inline_data and part.inline_data.mime_type.startswith("image/"):
+                        images.append(part.inline_data.data)
+                        break
+
+    record_call_result(selected_key_index, latency, "ok")
+    if images:
+        logger.info(f"Успешно обработано изображений из вызова #{call_number}: {len(images)}/{candidate_count} для пользователя {chat_id}")
     else:
-        logger.warning(f"Пригласивший {referrer_id} не найден для пользователя {chat_id}.")
+        logger.warning(f"Не удалось извлечь изображение из ответа Gemini для вызова #{call_number}, пользователь {chat_id}.")
+    return images
 
 
-async def generate_images_service(chat_id: int, image_bytes: bytes) -> GenerationResponse:
+async def _generate_images(chat_id: int, image_part: genai_types.Part, call_number: int, total_calls: int,
+                           candidate_count: int, deadline: float, priority: str) -> Optional[List[bytes]]:
+    """Возвращает изображения одного вызова (с хеджированием) или None, если бонусный вызов отложен из-за нехватки
+    квоты."""
+    try:
+        key_index = await reserve_key(deadline, priority, chat_id)
+    except HTTPException:
+        if priority != PRIORITY_BONUS:
+            raise
+        logger.info(f"Бонусный вызов Gemini #{call_number} для пользователя {chat_id} отменен: нет свободной квоты")
+        return None
+    # Ключ освобождает владелец задачи вызова, а не сама задача: отмененная до старта задача не выполнит finally.
+    calls = {asyncio.create_task(
+        _call_gemini(chat_id, key_index, image_part, call_number, total_calls, candidate_count)): key_index}
+    primary = next(iter(calls))
+    try:
+        hedge_delay = hedge_delay_seconds()
+        if hedge_delay is None:
+            return await primary or []
+        done, _ = await asyncio.wait({primary}, timeout=hedge_delay)
+        if done:
+            return primary.result() or []
+
+        # Вызов дольше обычного - дублируем его на другой ключ, победит первый ответ с изображением.
+        hedge_key_index = await reserve_hedge_key(frozenset({key_index}), chat_id)
+        if hedge_key_index is None:
+            return await primary or []
+        logger.info(f"Вызов Gemini #{call_number} для пользователя {chat_id} не ответил за {hedge_delay:.1f} с, "
+                    f"дублируем на ключ {hedge_key_index}")
+        calls[asyncio.create_task(
+            _call_gemini(chat_id, hedge_key_index, image_part, call_number, total_calls, candidate_count))] = \
+            hedge_key_index
+        pending = set(calls)
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                images = task.result()
+                if images:
+                    return images
+        return []
+    finally:
+        for task, task_key_index in calls.items():
+            # Прерванный или неудавшийся вызов возвращает квоту ключу.
+            interrupted = not task.done() or task.cancelled()
+            if interrupted:
+                task.cancel()
+                release_probe(task_key_index)
+            refund = interrupted or (task.exception() is None and task.result() is None)
+            await release_key(task_key_index, refund=refund, chat_id=chat_id)
+
+
+def _bonus_images_for(generation_count: int) -> int:
+    return 2 if generation_count == 1 or generation_count % 2 == 0 else 0
+
+
+async def _expected_gemini_calls(chat_id: int, submission_digest: Optional[str]) -> int:
+    """Число вызовов Gemini для следующей генерации чата: основные и бонусные изображения за вычетом уже
+    найденных в кеше, по GEMINI_CANDIDATES_PER_CALL изображений за вызов."""
+    user = None
+    if users_collection is not None:
+        user = await users_collection.find_one({"chat_id": chat_id}, {"generation_count": 1})
+    images_needed = MAIN_IMAGES_PER_GENERATION + _bonus_images_for((user or {}).get("generation_count", 0) + 1)
+    if submission_digest:
+        images_needed -= await count_cached_images(submission_digest)
+    return math.ceil(max(0, images_needed) / max(1, GEMINI_CANDIDATES_PER_CALL))
+
+
+async def debit_generation(chat_id: int, image_bytes: Optional[bytes] = None,
+                           max_wait_seconds: Optional[float] = GENERATION_ADMISSION_MAX_WAIT_SECONDS) -> GenerationDebit:
+    """Списывает оживашку за генерацию. Сначала проверяет, что квоты Gemini хватит и ожидание не превысит
+    max_wait_seconds (иначе 429). Занимает слот одновременных генераций чата (и отметку содержимого рисунка,
+    если передан image_bytes), который освобождается по окончании stream_generation (или здесь же, если
+    списание не удалось)."""
+    submission_digest = hashlib.sha256(image_bytes).hexdigest() if image_bytes else None
+    calls_needed = await _expected_gemini_calls(chat_id, submission_digest)
+    estimated_wait_seconds = await check_admission(calls_needed, max_wait_seconds) if calls_needed else 0.0
+    await acquire_chat_slot(chat_id, submission_digest)
+    debit_task = asyncio.ensure_future(_debit_generation(chat_id))
+    try:
+        # shield: отмена запроса не прерывает списание между обновлением в MongoDB и реферальным бонусом.
+        debit = await asyncio.shield(debit_task)
+    except asyncio.CancelledError:
+        await asyncio.shield(_abandon_debit(debit_task, chat_id, submission_digest))
+        raise
+    except BaseException:
+        await release_chat_slot(chat_id, submission_digest)
+        raise
+    debit.estimated_wait_seconds = round(estimated_wait_seconds, 1)
+    debit.submission_digest = submission_digest
+    return debit
+
+
+async def _abandon_debit(debit_task: asyncio.Future, chat_id: int, submission_digest: Optional[str]):
+    """Дожидается списания, запрос на которое был отменен, возвращает его, если оно успело примениться,
+    и освобождает слот чата."""
+    try:
+        debit = await debit_task
+    except BaseException:
+        debit = None
+    if debit:
+        logger.warning(f"Запрос генерации для {chat_id} отменен после списания, возвращаем оживашку")
+        await refund_generation(debit)
+    await release_chat_slot(chat_id, submission_digest)
+
+
+def _debit_stages(debit_id: str, now: datetime) -> list:
+    """Конвейер списания: -1 оживашка, +1 за каждую пятую генерацию, отметки о первой генерации и
+    о реферальном бонусе за нее. Первой считается генерация, после которой счетчик стал равен 1: если первую
+    генерацию вернули, время первой генерации выставляет следующая."""
+    is_first_generation = {"$eq": ["$generation_count", 1]}
+    return [
+        {"$set": {"generation_count": {"$add": [{"$ifNull": ["$generation_count", 0]}, 1]},
+                  "previous_generation_time": "$last_generation_time"}},
+        {"$set": {
+            "ozhivashki": {"$add": ["$ozhivashki", -1,
+                                    {"$cond": [{"$eq": [{"$mod": ["$generation_count", 5]}, 0]}, 1, 0]}]},
+            "last_generation_time": now,
+            "last_activity_time": now,
+            "first_generation_time": {"$cond": [is_first_generation, now, "$first_generation_time"]},
+            "first_generation_op": {"$cond": [is_first_generation, debit_id, "$first_generation_op"]},
+            # Бонус пригласившему начисляет та генерация, которая первой выставила отметку.
+            "referral_bonus_op": {"$cond": [{"$and": [{"$eq": ["$generation_count", 1]},
+                                                      {"$gt": ["$referred_by", None]},
+                                                      {"$ne": ["$referral_bonus_claimed", True]}]},
+                                            debit_id, "$referral_bonus_op"]},
+        }},
+        {"$set": {"referral_bonus_claimed": {"$or": [{"$eq": ["$referral_bonus_claimed", True]},
+                                                     {"$eq": ["$referral_bonus_op", debit_id]}]}}},
+    ]
+
+
+async def _debit_generation(chat_id: int) -> GenerationDebit:
     if not users_collection:
         logger.error("Коллекция пользователей не инициализирована.")
         raise HTTPException(status_code=500, detail="Ошибка сервера: база данных пользователей недоступна.")
 
-    user = await get_db_user(chat_id)
+    # Проверка баланса и списание - один условный запрос, поэтому параллельные генерации не уводят баланс в минус.
+    debit_id = f"generation:{uuid.uuid4().hex}"
+    user = await apply_balance_op(chat_id, debit_id, _debit_stages(debit_id, datetime.now()),
+                                  condition={"ozhivashki": {"$gt": 0}})
     if not user:
-        raise HTTPException(status_code=404, detail="Пользователь не найден")
-
-    current_ozhivashki = user.get("ozhivashki", 0)
-    if current_ozhivashki <= 0:
+        if not await users_collection.count_documents({"chat_id": chat_id}, limit=1):
+            raise HTTPException(status_code=404, detail="Пользователь не найден")
         logger.warning(f"Пользователь {chat_id} попытался сгенерировать изображение с 0 оживашек.")
         raise HTTPException(status_code=402, detail="Недостаточно оживашек")
 
     ozhivashki_spent = 1
-    new_balance = current_ozhivashki - ozhivashki_spent
-    generation_count = user.get("generation_count", 0) + 1
+    new_balance = user["ozhivashki"]
+    generation_count = user["generation_count"]
     streak_bonus_ozhivashka = 1 if generation_count % 5 == 0 else 0
-    new_balance += streak_bonus_ozhivashka
-
-    update_fields = {"$inc": {"ozhivashki": -ozhivashki_spent + streak_bonus_ozhivashka, "generation_count": 1},
-        "$set": {"last_generation_time": datetime.now(), "last_activity_time": datetime.now()}}
-    if user.get("generation_count", 0) == 0:
-        update_fields["$set"]["first_generation_time"] = datetime.now()
-
-    await users_collection.update_one({"chat_id": chat_id}, update_fields)
+    record_ledger_entry(debit_id, chat_id, "generation", -ozhivashki_spent + streak_bonus_ozhivashka, new_balance)
     logger.info(
         f"Пользователь {chat_id}: Потрачено {ozhivashki_spent} оживашка, новое количество генераций {generation_count}. Бонус за серию: {streak_bonus_ozhivashka}. Новый баланс: {new_balance}")
 
-    referrer_id = user.get("referred_by")
-    is_first_generation = generation_count == 1
-    referral_bonus_claimed = user.get("referral_bonus_claimed", False)
+    first_generation = user.get("first_generation_op") == debit_id
+    record_generation(user, first_generation=first_generation)
+
+    if user.get("referral_bonus_op") == debit_id:
+        await _apply_referral_bonus(chat_id, user["referred_by"])
+
+    return GenerationDebit(chat_id=chat_id, debit_id=debit_id, generation_count=generation_count,
+                           ozhivashki_spent=ozhivashki_spent, new_balance=new_balance,
+                           num_main_images=MAIN_IMAGES_PER_GENERATION,
+                           num_bonus_images=_bonus_images_for(generation_count),
+                           priority=generation_priority(user, generation_count),
+                           first_generation_time=user["first_generation_time"] if first_generation else None)
+
+
+async def refund_generation(debit: GenerationDebit):
+    op_id = f"refund:{debit.debit_id}"
+    # Возврат единственной генерации снимает отметку о первой генерации, как будто генерации не было.
+    refunds_first_generation = {"$and": [{"$eq": ["$generation_count", 0]},
+                                         {"$eq": ["$first_generation_op", debit.debit_id]}]}
+    user = await apply_balance_op(debit.chat_id, op_id, [
+        {"$set": {"ozhivashki": {"$add": ["$ozhivashki", debit.ozhivashki_spent]},
+                  "generation_count": {"$subtract": ["$generation_count", 1]}}},
+        {"$set": {"first_generation_time": {"$cond": [refunds_first_generation, None, "$first_generation_time"]},
+                  "first_generation_op": {"$cond": [refunds_first_generation, None, "$first_generation_op"]}}},
+    ])
+    if user:
+        record_ledger_entry(op_id, debit.chat_id, "refund", debit.ozhivashki_spent, user.get("ozhivashki"))
+        first_generation_refunded = debit.first_generation_time is not None and user["generation_count"] == 0
+        record_generation_refund(user, debit.first_generation_time if first_generation_refunded else None)
+    else:
+        logger.warning(f"Возврат за генерацию {debit.debit_id} пользователя {debit.chat_id} уже выполнен или невозможен.")
 
-    if is_first_generation and referrer_id and not referral_bonus_claimed:
-        await _apply_referral_bonus(chat_id, referrer_id)
 
-    try:
-        image_pil = Image.open(BytesIO(image_bytes))
-        if image_pil.mode == 'RGBA':
-            image_pil = image_pil.convert('RGB')
-        logger.info(
-            f"Изображение загружено для пользователя {chat_id}. Размер: {image_pil.size}, Режим: {image_pil.mode}")
+async def _waive_generation_charge(debit: GenerationDebit):
+    if debit.ozhivashki_spent <= 0:
+        return
+    op_id = f"waive:{debit.debit_id}"
+    user = await apply_balance_op(debit.chat_id, op_id,
+                                  [{"$set": {"ozhivashki": {"$add": ["$ozhivashki", debit.ozhivashki_spent]}}}])
+    if not user:
+        return
+    record_ledger_entry(op_id, debit.chat_id, "cache_waiver", debit.ozhivashki_spent, user.get("ozhivashki"))
+    logger.info(f"Генерация для {debit.chat_id} полностью взята из кеша, оживашка не списывается.")
+    debit.new_balance += debit.ozhivashki_spent
+    debit.ozhivashki_spent = 0
 
-        needs_bonus = (generation_count == 1) or (generation_count % 2 == 0)
-        num_main_images = 4
-        num_bonus_images = 2 if needs_bonus else 0
-        total_images_to_generate = num_main_images + num_bonus_images
 
-        logger.info(
-            f"Запрос {total_images_to_generate} изображений ({num_main_images} основных + {num_bonus_images} бонусных) для пользователя {chat_id} (Генерация #{generation_count}).")
-
-        main_images_b64: List[str] = []
-        bonus_images_b64: List[str] = []
-        generated_count = 0
-
-        for i in range(total_images_to_generate):
-            if not GEMINI_API_KEYS:
-                logger.error("Отсутствуют API ключи Gemini.")
-                raise HTTPException(status_code=503, detail="Сервис генерации временно недоступен (нет ключей)")
-
-            selected_key_index = await get_available_key()
-            api_key_to_use = GEMINI_API_KEYS[selected_key_index]
-
-            genai.configure(api_key=api_key_to_use)
-            model = genai.GenerativeModel("gemini-1.5-flash-latest")
-
-            logger.info(
-                f"Выполнение вызова Gemini #{i + 1}/{total_images_to_generate} с использованием ключа с индексом {selected_key_index} для пользователя {chat_id}")
-
-            generation_config = genai_types.GenerationConfig(temperature=0.6, candidate_count=1)
-
-            response = await model.generate_content_async(contents=[GENERATION_PROMPT, image_pil],
-                generation_config=generation_config)
-            await decrement_quota(selected_key_index)
-
-            image_found = False
-            if response.candidates:
-                candidate = response.candidates[0]
-                if response.prompt_feedback and response.prompt_feedback.block_reason:
-                    block_reason = response.prompt_feedback.block_reason.name
-                    block_msg = response.prompt_feedback.block_reason_message
-                    logger.error(f"Генерация заблокирована для вызова #{i + 1}. Причина: {block_reason} - {block_msg}")
-                    raise HTTPException(status_code=400,
-                                        detail=f"Генерация заблокирована: {block_reason} - {block_msg}")
-
-                if candidate.content and candidate.content.parts:
-                    for part in candidate.content.parts:
-                        if part.inline_data and part.inline_data.mime_type.startswith("image/"):
-                            img_bytes = part.inline_data.data
-                            img_b64 = base64.b64encode(img_bytes).decode('utf-8')
-                            if len(main_images_b64) < num_main_images:
-                                main_images_b64.append(img_b64)
-                            else:
-                                bonus_images_b64.append(img_b64)
-                            generated_count += 1
-                            image_found = True
-                            logger.info(f"Успешно обработано изображение из вызова #{i + 1} для пользователя {chat_id}")
-                            break
-            if not image_found:
-                logger.warning(
-                    f"Не удалось извлечь изображение из ответа Gemini для вызова #{i + 1}, пользователь {chat_id}.")
-
-        if generated_count < num_main_images:
-            logger.error(
-                f"Не удалось сгенерировать достаточно основных изображений для пользователя {chat_id}. Получено {generated_count}/{num_main_images}.")
-            raise Exception("ИИ не смог сгенерировать необходимое количество основных изображений.")
-
-        logger.info(
-            f"Успешно сгенерированы изображения для {chat_id}. Основные: {len(main_images_b64)}, Бонусные: {len(bonus_images_b64)}")
-        return GenerationResponse(main_images=main_images_b64, bonus_images=bonus_images_b64,
-                                  ozhivashki_spent=ozhivashki_spent, new_balance=new_balance)
+async def _iter_generated_images(debit: GenerationDebit, image_bytes: bytes,
+                                 generation_deadline: float) -> AsyncIterator[Tuple[str, bytes]]:
+    chat_id = debit.chat_id
+    num_main_images = debit.num_main_images
+    total_images_to_generate = num_main_images + debit.num_bonus_images
 
+    logger.info(
+        f"Запрос {total_images_to_generate} изображений ({num_main_images} основных + {debit.num_bonus_images} бонусных) для пользователя {chat_id} (Генерация #{debit.generation_count}).")
+
+    prepared_part = await prepare_image_part(chat_id, image_bytes)
+    image_part = genai_types.Part.from_bytes(data=prepared_part["data"], mime_type=prepared_part["mime_type"])
+    image_digest = hashlib.sha256(prepared_part["data"]).hexdigest()
+    cached_images = await get_cached_images(image_digest)
+    from_cache = cached_images[:total_images_to_generate]
+    calls_needed = total_images_to_generate - len(from_cache)
+    if not from_cache:
+        await record_cache_lookup("miss", 0)
+    else:
+        await record_cache_lookup("hit" if calls_needed == 0 else "partial", len(from_cache))
+        logger.info(f"Кеш генераций для {chat_id}: найдено {len(from_cache)} из {total_images_to_generate} изображений")
+        if calls_needed == 0 and not GENERATION_CACHE_BILL_HITS:
+            await _waive_generation_charge(debit)
+
+    if calls_needed and not GEMINI_API_KEYS:
+        logger.error("Отсутствуют API ключи Gemini.")
+        raise HTTPException(status_code=503, detail="Сервис генерации временно недоступен (нет ключей)")
+
+    generated_count = 0
+    new_images = []
+    for img_bytes in from_cache:
+        kind = "main" if generated_count < num_main_images else "bonus"
+        generated_count += 1
+        yield kind, img_bytes
+
+    # Несколько изображений за один вызов экономят квоту; недостающие после пакетного вызова догенерируются
+    # одиночными вызовами.
+    # Бонусные вызовы идут с низшим приоритетом и короткой отсрочкой: при нехватке квоты от них отказываемся первыми.
+    main_calls_needed = max(0, num_main_images - len(from_cache))
+    batch_offsets = list(range(0, calls_needed, max(1, GEMINI_CANDIDATES_PER_CALL)))
+    deadline = min(generation_deadline, time.monotonic() + GEMINI_KEY_WAIT_TIMEOUT_SECONDS)
+    bonus_deadline = min(deadline, time.monotonic() + GENERATION_BONUS_WAIT_SECONDS)
+    requested = {}
+    for call_number, offset in enumerate(batch_offsets, start=1):
+        batch_size = min(GEMINI_CANDIDATES_PER_CALL, calls_needed - offset)
+        is_bonus = offset >= main_calls_needed
+        task = asyncio.create_task(
+            _generate_images(chat_id, image_part, call_number, len(batch_offsets), batch_size,
+                             bonus_deadline if is_bonus else deadline, PRIORITY_BONUS if is_bonus else debit.priority))
+        requested[task] = (batch_size, is_bonus)
+    pending = set(requested)
+    try:
+        while pending:
+            done, pending = await asyncio.wait(pending, timeout=generation_deadline - time.monotonic(),
+                                               return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                if generated_count >= num_main_images:
+                    logger.warning(f"Время генерации для {chat_id} истекло, бонусные изображения не дождались")
+                    break
+                logger.error(f"Время генерации для {chat_id} истекло, отменяем оставшиеся вызовы Gemini")
+                raise HTTPException(status_code=504, detail="Генерация не уложилась в отведенное время")
+            for task in done:
+                batch_size, is_bonus = requested[task]
+                images = task.result()
+                if images is None:
+                    continue
+                images = images[:batch_size]
+                for img_bytes in images:
+                    kind = "main" if generated_count < num_main_images else "bonus"
+                    generated_count += 1
+                    new_images.append(img_bytes)
+                    yield kind, img_bytes
+
+                shortfall = batch_size - len(images)
+                if batch_size > 1 and shortfall > 0:
+                    logger.info(f"Пакетный вызов для {chat_id} вернул {len(images)}/{batch_size} изображений, "
+                                f"догенерируем {shortfall} одиночными вызовами")
+                    for _ in range(shortfall):
+                        fallback = asyncio.create_task(
+                            _generate_images(chat_id, image_part, len(requested) + 1, len(requested) + 1, 1,
+                                             bonus_deadline if is_bonus else deadline,
+                                             PRIORITY_BONUS if is_bonus else debit.priority))
+                        requested[fallback] = (1, is_bonus)
+                        pending.add(fallback)
+    finally:
+        for task in requested:
+            if not task.done():
+                task.cancel()
+
+    if generated_count < num_main_images:
+        logger.error(
+            f"Не удалось сгенерировать достаточно основных изображений для пользователя {chat_id}. Получено {generated_count}/{num_main_images}.")
+        raise Exception("ИИ не смог сгенерировать необходимое количество основных изображений.")
+
+    if new_images:
+        await store_cached_images(image_digest, cached_images + new_images, debit.submission_digest)
+
+
+async def _refund_interrupted(debit: GenerationDebit, reason: str):
+    await refund_generation(debit)
+    logger.info(f"Возвращена {debit.ozhivashki_spent} оживашка и уменьшен счетчик генераций для {debit.chat_id} {reason}.")
+
+
+async def abort_generation(debit: GenerationDebit):
+    """Возвращает оживашку и освобождает слот чата для генерации, которая так и не началась (клиент отключился)."""
+    await asyncio.shield(_refund_interrupted(debit, "после отключения клиента"))
+    await asyncio.shield(release_chat_slot(debit.chat_id, debit.submission_digest))
+
+
+async def stream_generation(debit: GenerationDebit, image_bytes: bytes,
+                            refund_on_cancel: bool = True) -> AsyncIterator[Tuple[str, bytes]]:
+    """Генерирует изображения, возвращая оживашку при ошибке. Если потребитель отменен или перестал читать поток
+    (клиент отключился), незавершенные вызовы Gemini отменяются с возвратом квоты, а оживашка возвращается сразу;
+    refund_on_cancel=False оставляет списание, когда генерация будет перезапущена (задачи очереди)."""
+    chat_id = debit.chat_id
+    generation_deadline = time.monotonic() + GENERATION_DEADLINE_SECONDS
+    try:
+        # aclosing: вызовы Gemini отменяются сразу при закрытии потока, не дожидаясь сборщика мусора.
+        async with aclosing(_iter_generated_images(debit, image_bytes, generation_deadline)) as images:
+            async for kind, img_bytes in images:
+                yield kind, img_bytes
     except HTTPException as http_exc:
         logger.error(f"HTTP ошибка при генерации для {chat_id}: {http_exc.detail}")
-        await users_collection.update_one({"chat_id": chat_id},
-                                          {"$inc": {"ozhivashki": ozhivashki_spent, "generation_count": -1}})
-        logger.info(f"Возвращена {ozhivashki_spent} оживашка и уменьшен счетчик генераций для {chat_id} из-за ошибки.")
+        await _refund_interrupted(debit, "из-за ошибки")
         raise http_exc  # Re-raise the HTTPException
+    except (asyncio.CancelledError, GeneratorExit):
+        if refund_on_cancel:
+            logger.warning(f"Генерация для {chat_id} прервана: клиент отключился")
+            # shield: при отмене из-за отключения клиента повторная отмена не должна прервать возврат.
+            await asyncio.shield(_refund_interrupted(debit, "после отключения клиента"))
+        raise
     except Exception as e:
         logger.error(f"Ошибка в процессе генерации для {chat_id}: {e}", exc_info=True)
-        await users_collection.update_one({"chat_id": chat_id},
-                                          {"$inc": {"ozhivashki": ozhivashki_spent, "generation_count": -1}})
-        logger.info(
-            f"Возвращена {ozhivashki_spent} оживашка и уменьшен счетчик генераций для {chat_id} из-за непредвиденной ошибки.")
+        await _refund_interrupted(debit, "из-за непредвиденной ошибки")
         raise HTTPException(status_code=500, detail="Внутренняя ошибка сервера при генерации изображений.")
+    finally:
+        await asyncio.shield(release_chat_slot(chat_id, debit.submission_digest))
+
+
+async def run_generation(debit: GenerationDebit, image_bytes: bytes, transport: str = "base64",
+                         refund_on_cancel: bool = True) -> GenerationResponse:
+    response = GenerationResponse(ozhivashki_spent=debit.ozhivashki_spent, new_balance=debit.new_balance)
+    async with aclosing(stream_generation(debit, image_bytes, refund_on_cancel)) as generated:
+        async for kind, img_bytes in generated:
+            if transport == "blob":
+                images = response.main_image_ids if kind == "main" else response.bonus_image_ids
+                images.append(await put_blob(img_bytes))
+            else:
+                images = response.main_images if kind == "main" else response.bonus_images
+                images.append(base64.b64encode(img_bytes).decode('utf-8'))
+    # Списание могло быть отменено, если результат целиком взят из кеша.
+    response.ozhivashki_spent = debit.ozhivashki_spent
+    response.new_balance = debit.new_balance
+
+    logger.info(f"Успешно сгенерированы изображения для {debit.chat_id}. "
+                f"Основные: {len(response.main_images) + len(response.main_image_ids)}, "
+                f"Бонусные: {len(response.bonus_images) + len(response.bonus_image_ids)}")
+    return response
+
+
+async def generate_images_service(chat_id: int, image_bytes: bytes, transport: str = "base64") -> GenerationResponse:
+    debit = await debit_generation(chat_id, image_bytes)
+    return await run_generation(debit, image_bytes, transport)
 
 
 async def create_yookassa_payment_service(chat_id: int, item_name: str, quantity: int, price: float) -> dict:
@@ -286,9 +493,8 @@ async def create_yookassa_payment_service(chat_id: int, item_name: str, quantity
     payment_info_to_save = PaymentInfo(item_name=item_name, quantity=quantity, price=price, status=payment.status,
         created_at=datetime.now())
     try:
-        payment_dict = payment_info_to_save.model_dump(mode='json')
-        await users_collection.update_one({"chat_id": chat_id},
-            {"$set": {f"yookassa_payments.{payment_id}": payment_dict}})
+        await payments_collection.insert_one({"_id": payment_id, "chat_id": chat_id,
+                                              **payment_info_to_save.model_dump()})
     except Exception as db_e:
         logger.error(f"Не удалось сохранить информацию о платеже {payment_id} в БД для chat_id={chat_id}: {db_e}",
                      exc_info=True)
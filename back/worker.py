@@ -0,0 +1,35 @@
+import asyncio
+import os
+import socket
+import uuid
+
+from . import db as db_module
+from .config import logger
+from .db import client as mongo_client
+from .jobs import run_generation_worker
+from .quota import init_quota_counters
+
+
+async def main():
+    logger.info("Запуск воркера генераций Ozhivlyator...")
+    await db_module.connect_redis()
+    if not db_module.redis_client:
+        logger.critical("Воркер генераций не может работать без Redis. Завершение.")
+        return
+    await init_quota_counters()
+
+    consumer_name = os.getenv("GENERATION_WORKER_NAME") or f"{socket.gethostname()}-{uuid.uuid4().hex[:6]}"
+    try:
+        await run_generation_worker(consumer_name)
+    finally:
+        await db_module.close_redis()
+        if mongo_client:
+            mongo_client.close()
+        logger.info("Воркер генераций остановлен.")
+
+
+if __name__ == "__main__":
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        logger.info("Воркер генераций остановлен вручную.")
@@ -18,6 +18,15 @@ TELEGRAM_BOT_TOKEN = os.getenv('TELEGRAM_BOT_TOKEN')
 API_URL = os.getenv("API_URL", "http://localhost:8000")
 API_KEY = os.getenv("API_KEY", 'your_secret_api_key_for_internal_auth')
 ADMIN_CHAT_ID = os.getenv("ADMIN_CHAT_ID")
+# "stream" - изображения приходят по мере готовности, "job" - очередь задач бэкенда, "sync" - один долгий запрос
+GENERATION_MODE = os.getenv("GENERATION_MODE", "stream")
+GENERATION_JOB_POLL_INTERVAL_SECONDS = 2
+GENERATION_JOB_TIMEOUT_SECONDS = 600
+# "blob" - бэкенд возвращает идентификаторы, байты изображений забираются через /blobs/{id}; "base64" - внутри JSON
+IMAGE_TRANSPORT = os.getenv("IMAGE_TRANSPORT", "blob")
+# Сообщения альбома собираются в одну пачку генераций в течение этого времени.
+ALBUM_COLLECT_SECONDS = 1.5
+DRAWING_DEDUP_WINDOW_SECONDS = 60
 
 if not TELEGRAM_BOT_TOKEN or not API_KEY or not API_URL or not ADMIN_CHAT_ID:
     logger.error("TELEGRAM_BOT_TOKEN, API_KEY, API_URL, and ADMIN_CHAT_ID must be set in .env")
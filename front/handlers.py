@@ -1,8 +1,10 @@
 import asyncio
+import base64
+import json
 import os
 import uuid
 from datetime import datetime
-from typing import Union
+from typing import Dict, List, Optional, Set, Tuple, Union
 
 import httpx
 from aiogram import F, types
@@ -17,9 +19,11 @@ from .config import (router, bot, logger, API_URL, API_KEY, CURRENCY_NAME, CURRE
                      EMOJI_ROBOT, EMOJI_GIFT, EMOJI_STAR, EMOJI_PENCIL, EMOJI_MONEY, EMOJI_HOME,
                      EMOJI_HOURGLASS, EMOJI_INFO, EMOJI_SAD, EMOJI_THINKING,
                      EMOJI_POINT_DOWN, EMOJI_PARTY, EMOJI_HEART, EMOJI_CHILD,
-                     EMOJI_CALENDAR, EXAMPLE_IMAGE_PATHS)
+                     EMOJI_CALENDAR, EXAMPLE_IMAGE_PATHS, GENERATION_MODE, IMAGE_TRANSPORT,
+                     ALBUM_COLLECT_SECONDS, DRAWING_DEDUP_WINDOW_SECONDS, redis_client)
 from .states import OzhivlyatorState
-from .utils import (pluralize_ozhivashki, safe_delete_message, send_or_edit_message, get_user_data, create_user)
+from .utils import (pluralize_ozhivashki, safe_delete_message, send_or_edit_message, get_user_data, create_user,
+                    run_generation_job, fetch_blob, format_wait_time, parse_retry_after)
 
 
 async def show_main_menu(target: Union[Message, CallbackQuery], state: FSMContext):
@@ -428,8 +432,236 @@ async def cb_claim_daily_bonus(query: CallbackQuery, state: FSMContext):
                 await state.set_state(OzhivlyatorState.main_menu)
 
 
+async def _load_result_images(client: httpx.AsyncClient, chat_id: int, images_b64: List[str],
+                              image_ids: List[str]) -> List[bytes]:
+    if not image_ids:
+        images = []
+        for i, img_b64 in enumerate(images_b64):
+            try:
+                images.append(base64.b64decode(img_b64))
+            except Exception as decode_err:
+                logger.error(f"Error decoding image {i} for {chat_id}: {decode_err}")
+        return images
+
+    results = await asyncio.gather(*(fetch_blob(client, blob_id) for blob_id in image_ids), return_exceptions=True)
+    images = []
+    for blob_id, result in zip(image_ids, results):
+        if isinstance(result, Exception):
+            logger.error(f"Error fetching image blob {blob_id} for {chat_id}: {result}")
+        else:
+            images.append(result)
+    return images
+
+
+async def _send_generation_result(client: httpx.AsyncClient, chat_id: int, generation_result: dict, user_data: dict,
+                                  state: FSMContext):
+    main_images = await _load_result_images(client, chat_id, generation_result.get("main_images", []),
+                                            generation_result.get("main_image_ids", []))
+    bonus_images = await _load_result_images(client, chat_id, generation_result.get("bonus_images", []),
+                                             generation_result.get("bonus_image_ids", []))
+    ozhivashki_spent = generation_result.get("ozhivashki_spent", 0)
+    new_balance = generation_result.get("new_balance")
+
+    logger.info(
+        f"Generation successful for {chat_id}. Main: {len(main_images)}, Bonus: {len(bonus_images)}. Spent: {ozhivashki_spent}")
+
+    if main_images:
+        media_group_main = []
+        first = True
+        for i, img_bytes in enumerate(main_images):
+            try:
+                if first:
+                    media_group_main.append(
+                        InputMediaPhoto(media=BufferedInputFile(img_bytes, filename=f"result_{i + 1}.png"),
+                                        caption=f"{EMOJI_PARTY} Готово! Вот 4 оживших рисунка:"))
+                    first = False
+                else:
+                    media_group_main.append(
+                        InputMediaPhoto(media=BufferedInputFile(img_bytes, filename=f"result_{i + 1}.png")))
+            except Exception as decode_err:
+                logger.error(f"Error adding main image {i} for {chat_id}: {decode_err}")
+        if media_group_main:
+            await bot.send_media_group(chat_id=chat_id, media=media_group_main)
+        else:
+            await bot.send_message(chat_id, f"{EMOJI_SAD} Не удалось подготовить основные изображения.")
+    else:
+        await bot.send_message(chat_id, f"{EMOJI_SAD} Не удалось сгенерировать основные изображения.")
+
+    if bonus_images:
+        await asyncio.sleep(1)
+        media_group_bonus = []
+        first_bonus = True
+        for i, img_bytes in enumerate(bonus_images):
+            try:
+                if first_bonus:
+                    media_group_bonus.append(
+                        InputMediaPhoto(media=BufferedInputFile(img_bytes, filename=f"bonus_{i + 1}.png"),
+                                        caption=f"{EMOJI_GIFT} А вот и бонусные 2 фото! Напоминаю, такой бонус дается за каждую 2-ю генерацию! {EMOJI_SPARKLES}"))
+                    first_bonus = False
+                else:
+                    media_group_bonus.append(
+                        InputMediaPhoto(media=BufferedInputFile(img_bytes, filename=f"bonus_{i + 1}.png")))
+            except Exception as decode_err:
+                logger.error(f"Error adding bonus image {i} for {chat_id}: {decode_err}")
+        if media_group_bonus:
+            await bot.send_media_group(chat_id=chat_id, media=media_group_bonus)
+
+    await _finish_generation(chat_id, user_data, new_balance, state)
+
+
+async def _finish_generation(chat_id: int, user_data: dict, new_balance: Optional[int], state: FSMContext):
+    referrer_id = user_data.get("referred_by")
+    is_first_generation = user_data.get("generation_count", 0) == 0
+    if referrer_id and is_first_generation:
+        try:
+            await bot.send_message(referrer_id,
+                                   f"{EMOJI_PARTY} Твой друг только что сделал первую генерацию! "
+                                   f"Тебе начислено <b>2 {CURRENCY_NAME_PLURAL_2_4}</b> за приглашение!")
+        except Exception as e:
+            logger.error(f"Failed to notify referrer {referrer_id}: {e}")
+
+    if new_balance == 0:
+        await bot.send_message(chat_id,
+                               f"{EMOJI_INFO} Твоя бесплатная {CURRENCY_NAME} потрачена на эту генерацию. "
+                               f"Пополни баланс, чтобы оживить еще рисунки!")
+
+    temp_msg = await bot.send_message(chat_id, "Обновляю меню...")
+    await show_main_menu(temp_msg, state)
+
+
+async def _stream_generation(client: httpx.AsyncClient, chat_id: int, files: dict,
+                             processing_msg: Message) -> Tuple[int, Optional[dict]]:
+    total_main = 4
+    sent = {"main": 0, "bonus": 0}
+    async with client.stream("POST", f"{API_URL}/generate/stream", headers={"api-key": API_KEY}, files=files,
+                             data={"chat_id": chat_id, "transport": IMAGE_TRANSPORT}) as response:
+        if response.status_code != 200:
+            await response.aread()
+            if response.status_code not in (402, 409, 429):
+                response.raise_for_status()
+            return response.status_code, {"retry_after": parse_retry_after(response)}
+
+        async for line in response.aiter_lines():
+            if not line:
+                continue
+            event = json.loads(line)
+            event_type = event.get("event")
+            if event_type == "started":
+                total_main = event.get("num_main_images", total_main)
+                estimated_wait = event.get("estimated_wait_seconds") or 0
+                if estimated_wait >= 30:
+                    try:
+                        await bot.edit_message_text(
+                            f"{EMOJI_HOURGLASS} Магия началась... Сейчас много желающих, "
+                            f"оживление займет около {format_wait_time(int(estimated_wait))}",
+                            chat_id=chat_id, message_id=processing_msg.message_id)
+                    except TelegramBadRequest:
+                        pass
+            elif event_type == "image":
+                kind = event.get("kind")
+                if kind == "main":
+                    caption = f"{EMOJI_PARTY} Готово! Первый оживший рисунок:" if sent["main"] == 0 else None
+                    filename = f"result_{sent['main'] + 1}.png"
+                else:
+                    caption = (f"{EMOJI_GIFT} А вот и бонусные фото! Напоминаю, такой бонус дается за каждую 2-ю "
+                               f"генерацию! {EMOJI_SPARKLES}") if sent["bonus"] == 0 else None
+                    filename = f"bonus_{sent['bonus'] + 1}.png"
+                try:
+                    if event.get("blob_id"):
+                        img_bytes = await fetch_blob(client, event["blob_id"])
+                    else:
+                        img_bytes = base64.b64decode(event["image"])
+                    await bot.send_photo(chat_id, BufferedInputFile(img_bytes, filename=filename), caption=caption)
+                    sent[kind] += 1
+                except Exception as send_err:
+                    logger.error(f"Error sending streamed {kind} image for {chat_id}: {send_err}")
+                if kind == "main" and sent["main"] < total_main:
+                    try:
+                        await bot.edit_message_text(
+                            f"{EMOJI_HOURGLASS} Магия продолжается... Готово {sent['main']} из {total_main}!",
+                            chat_id=chat_id, message_id=processing_msg.message_id)
+                    except TelegramBadRequest:
+                        pass
+            elif event_type == "done":
+                logger.info(
+                    f"Streamed generation finished for {chat_id}. Main: {sent['main']}, Bonus: {sent['bonus']}. Spent: {event.get('ozhivashki_spent')}")
+                return 200, event
+            elif event_type == "error":
+                logger.error(
+                    f"Streamed generation failed for {chat_id}: Status {event.get('status_code')}, {event.get('detail')}")
+                return event.get("status_code") or 500, None
+
+    raise ValueError("Generation stream ended unexpectedly")
+
+
+# media_group_id -> сообщения альбома, собираемые первым сообщением альбома.
+_album_buffers: Dict[str, List[Message]] = {}
+# Чаты, для которых бот прямо сейчас выполняет генерацию.
+_chats_generating: Set[int] = set()
+
+
+def _recent_drawing_key(chat_id: int, message: Message) -> str:
+    return f"bot:recent_drawing:{chat_id}:{message.photo[-1].file_unique_id}"
+
+
+async def _is_duplicate_drawing(chat_id: int, message: Message) -> bool:
+    try:
+        return bool(await redis_client.exists(_recent_drawing_key(chat_id, message)))
+    except Exception as e:
+        logger.error(f"Failed to check duplicate drawing for {chat_id}: {e}")
+        return False
+
+
+async def _remember_drawing(chat_id: int, message: Message):
+    # Only successfully animated drawings are remembered, so a resend after a failed generation is processed.
+    try:
+        await redis_client.set(_recent_drawing_key(chat_id, message), 1, ex=DRAWING_DEDUP_WINDOW_SECONDS)
+    except Exception as e:
+        logger.error(f"Failed to remember drawing for {chat_id}: {e}")
+
+
 @router.message(F.photo)
 async def msg_handle_drawing_upload(message: Message, state: FSMContext):
+    chat_id = message.chat.id
+    if message.media_group_id:
+        album = _album_buffers.setdefault(message.media_group_id, [])
+        album.append(message)
+        if len(album) > 1:
+            return
+        await asyncio.sleep(ALBUM_COLLECT_SECONDS)
+        messages = _album_buffers.pop(message.media_group_id, album)
+        logger.info(f"User {chat_id} uploaded an album of {len(messages)} drawings")
+    else:
+        messages = [message]
+
+    if chat_id in _chats_generating:
+        logger.info(f"User {chat_id} sent a drawing while another generation is running, ignoring")
+        await message.answer(f"{EMOJI_HOURGLASS} Предыдущий рисунок еще оживает, дождись результата!")
+        for msg in messages:
+            await safe_delete_message(chat_id, msg.message_id)
+        return
+
+    _chats_generating.add(chat_id)
+    try:
+        for msg in messages:
+            if await _is_duplicate_drawing(chat_id, msg):
+                logger.info(f"User {chat_id} re-sent the same drawing, skipping duplicate")
+                await safe_delete_message(chat_id, msg.message_id)
+                await message.answer(f"{EMOJI_INFO} Этот рисунок уже оживлен только что - результат выше, "
+                                     f"повторная отправка пропущена.")
+                continue
+            result = await _process_drawing(msg, state)
+            if result:
+                await _remember_drawing(chat_id, msg)
+            elif result is False:
+                # Оживашки закончились - остальные рисунки альбома не отправляем.
+                break
+    finally:
+        _chats_generating.discard(chat_id)
+
+
+async def _process_drawing(message: Message, state: FSMContext) -> Optional[bool]:
+    """Оживляет один рисунок. Возвращает True при успехе и False, если у пользователя закончились оживашки."""
     try:
         data = await state.get_data()
         message_id = data.get("message_to_delete")
@@ -454,7 +686,7 @@ async def msg_handle_drawing_upload(message: Message, state: FSMContext):
         await safe_delete_message(chat_id, message.message_id)
         if prompt_message_id: await safe_delete_message(chat_id, prompt_message_id)
         await show_main_menu(message, state)
-        return
+        return False
 
     processing_msg = await message.answer(f"{EMOJI_HOURGLASS} Магия началась... Оживляю рисунок!")
     await safe_delete_message(chat_id, message.message_id)
@@ -472,91 +704,74 @@ async def msg_handle_drawing_upload(message: Message, state: FSMContext):
                 raise ValueError("Downloaded file is empty")
 
             files = {'image': ('drawing.png', file_bytes, 'image/png')}
-            response = await client.post(f"{API_URL}/generate", headers={"api-key": API_KEY}, files=files,
-                                         data={"chat_id": chat_id})
-
-            if response.status_code == 200:
-                generation_result = response.json()
-                main_images_b64 = generation_result.get("main_images", [])
-                bonus_images_b64 = generation_result.get("bonus_images", [])
-                ozhivashki_spent = generation_result.get("ozhivashki_spent", 0)
-                new_balance = generation_result.get("new_balance")
-
-                logger.info(
-                    f"Generation successful for {chat_id}. Main: {len(main_images_b64)}, Bonus: {len(bonus_images_b64)}. Spent: {ozhivashki_spent}")
-
+            generation_result = None
+            if GENERATION_MODE == "stream":
+                status_code, generation_result = await _stream_generation(client, chat_id, files, processing_msg)
+            elif GENERATION_MODE == "job":
+                job = await run_generation_job(client, chat_id, files)
+                if job.get("status") == "done":
+                    status_code = 200
+                    generation_result = job.get("result") or {}
+                else:
+                    status_code = job.get("error_status_code") or 500
+                    generation_result = job
+                    if status_code not in (402, 409, 429):
+                        logger.error(
+                            f"Generation job {job.get('job_id')} failed for {chat_id}: Status {status_code}, {job.get('error_detail')}")
+            else:
+                response = await client.post(f"{API_URL}/generate", headers={"api-key": API_KEY}, files=files,
+                                             data={"chat_id": chat_id, "transport": IMAGE_TRANSPORT})
+                status_code = response.status_code
+                if status_code == 200:
+                    generation_result = response.json()
+                elif status_code == 429:
+                    generation_result = {"retry_after": parse_retry_after(response)}
+                elif status_code not in (402, 409):
+                    response.raise_for_status()
+
+            if status_code == 200:
                 await safe_delete_message(chat_id, processing_msg.message_id)
-
-                if main_images_b64:
-                    import base64
-                    media_group_main = []
-                    first = True
-                    for i, img_b64 in enumerate(main_images_b64):
-                        try:
-                            img_bytes = base64.b64decode(img_b64)
-                            if first:
-                                media_group_main.append(
-                                    InputMediaPhoto(media=BufferedInputFile(img_bytes, filename=f"result_{i + 1}.png"),
-                                                    caption=f"{EMOJI_PARTY} Готово! Вот 4 оживших рисунка:"))
-                                first = False
-                            else:
-                                media_group_main.append(
-                                    InputMediaPhoto(media=BufferedInputFile(img_bytes, filename=f"result_{i + 1}.png")))
-                        except Exception as decode_err:
-                            logger.error(f"Error decoding/adding main image {i} for {chat_id}: {decode_err}")
-                    if media_group_main:
-                        await bot.send_media_group(chat_id=chat_id, media=media_group_main)
-                    else:
-                        await bot.send_message(chat_id, f"{EMOJI_SAD} Не удалось подготовить основные изображения.")
+                if GENERATION_MODE == "stream":
+                    await _finish_generation(chat_id, user_data, generation_result.get("new_balance"), state)
                 else:
-                    await bot.send_message(chat_id, f"{EMOJI_SAD} Не удалось сгенерировать основные изображения.")
+                    await _send_generation_result(client, chat_id, generation_result, user_data, state)
+                return True
 
-                if bonus_images_b64:
-                    await asyncio.sleep(1)
-                    media_group_bonus = []
-                    first_bonus = True
-                    for i, img_b64 in enumerate(bonus_images_b64):
-                        try:
-                            img_bytes = base64.b64decode(img_b64)
-                            if first_bonus:
-                                media_group_bonus.append(
-                                    InputMediaPhoto(media=BufferedInputFile(img_bytes, filename=f"bonus_{i + 1}.png"),
-                                                    caption=f"{EMOJI_GIFT} А вот и бонусные 2 фото! Напоминаю, такой бонус дается за каждую 2-ю генерацию! {EMOJI_SPARKLES}"))
-                                first_bonus = False
-                            else:
-                                media_group_bonus.append(
-                                    InputMediaPhoto(media=BufferedInputFile(img_bytes, filename=f"bonus_{i + 1}.png")))
-                        except Exception as decode_err:
-                            logger.error(f"Error decoding/adding bonus image {i} for {chat_id}: {decode_err}")
-                    if media_group_bonus:
-                        await bot.send_media_group(chat_id=chat_id, media=media_group_bonus)
-
-                referrer_id = user_data.get("referred_by")
-                is_first_generation = user_data.get("generation_count", 0) == 0
-                if referrer_id and is_first_generation:
-                    try:
-                        await bot.send_message(referrer_id,
-                                               f"{EMOJI_PARTY} Твой друг только что сделал первую генерацию! "
-                                               f"Тебе начислено <b>2 {CURRENCY_NAME_PLURAL_2_4}</b> за приглашение!")
-                    except Exception as e:
-                        logger.error(f"Failed to notify referrer {referrer_id}: {e}")
-
-                if new_balance == 0:
-                    await bot.send_message(chat_id,
-                                           f"{EMOJI_INFO} Твоя бесплатная {CURRENCY_NAME} потрачена на эту генерацию. "
-                                           f"Пополни баланс, чтобы оживить еще рисунки!")
-
-                temp_msg = await bot.send_message(chat_id, "Обновляю меню...")
-                await show_main_menu(temp_msg, state)
-
-            elif response.status_code == 402:
+            elif status_code == 402:
                 await safe_delete_message(chat_id, processing_msg.message_id)
                 await bot.send_message(chat_id,
                                        f"{EMOJI_SAD} Упс! Не хватает {CURRENCY_NAME_PLURAL_5_0} для генерации.")
                 await show_main_menu(message, state)
+                return False
+            elif status_code == 409:
+                await safe_delete_message(chat_id, processing_msg.message_id)
+                await bot.send_message(chat_id, f"{EMOJI_HOURGLASS} Этот рисунок уже оживает, дождись результата!")
+                await show_main_menu(message, state)
+            elif status_code == 429:
+                await safe_delete_message(chat_id, processing_msg.message_id)
+                retry_after = (generation_result or {}).get("retry_after")
+                if retry_after:
+                    await bot.send_message(chat_id,
+                                           f"{EMOJI_HOURGLASS} Сейчас очень много желающих оживить рисунок!\n"
+                                           f"Попробуй снова примерно через {format_wait_time(retry_after)}\n"
+                                           f"Оживашка не потрачена.")
+                else:
+                    await bot.send_message(chat_id,
+                                           f"{EMOJI_HOURGLASS} Предыдущий рисунок еще оживает, дождись результата!")
+                await show_main_menu(message, state)
             else:
-                response.raise_for_status()
+                await safe_delete_message(chat_id, processing_msg.message_id)
+                await bot.send_message(chat_id,
+                                       f"{EMOJI_SAD} Ошибка во время генерации.\nОживляшка не потрачена!\nПопробуй позже.")
+                await show_main_menu(message, state)
 
+        except asyncio.TimeoutError as e:
+            logger.error(f"Generation timed out for {chat_id}: {e}")
+            await safe_delete_message(chat_id, processing_msg.message_id)
+            await bot.send_message(chat_id,
+                                   f"{EMOJI_HOURGLASS} Оживление заняло слишком много времени.\n"
+                                   f"Если генерация не удастся, оживашка вернется на баланс автоматически.")
+            await show_main_menu(message, state)
         except httpx.HTTPStatusError as e:
             logger.error(
                 f"API error during generation for {chat_id}: Status {e.response.status_code}, Resp: {e.response.text[:100]}")
@@ -1,3 +1,5 @@
+import asyncio
+import math
 from typing import Optional
 
 import httpx
@@ -5,7 +7,8 @@ from aiogram.exceptions import TelegramBadRequest
 from aiogram.fsm.context import FSMContext
 from aiogram.types import InlineKeyboardMarkup
 
-from .config import (bot, logger, API_URL, API_KEY, CURRENCY_NAME, CURRENCY_NAME_PLURAL_2_4, CURRENCY_NAME_PLURAL_5_0)
+from .config import (bot, logger, API_URL, API_KEY, CURRENCY_NAME, CURRENCY_NAME_PLURAL_2_4, CURRENCY_NAME_PLURAL_5_0,
+                     GENERATION_JOB_POLL_INTERVAL_SECONDS, GENERATION_JOB_TIMEOUT_SECONDS, IMAGE_TRANSPORT)
 
 
 def pluralize_ozhivashki(count: int) -> str:
@@ -20,6 +23,19 @@ def pluralize_ozhivashki(count: int) -> str:
         return CURRENCY_NAME_PLURAL_5_0
 
 
+def format_wait_time(seconds: int) -> str:
+    if seconds < 60:
+        return f"{max(1, seconds)} сек."
+    if seconds < 60 * 60:
+        return f"{math.ceil(seconds / 60)} мин."
+    return f"{math.ceil(seconds / 3600)} ч."
+
+
+def parse_retry_after(response: httpx.Response) -> Optional[int]:
+    retry_after = response.headers.get("Retry-After")
+    return int(retry_after) if retry_after and retry_after.isdigit() else None
+
+
 async def safe_delete_message(chat_id: int, message_id: int):
     try:
         await bot.delete_message(chat_id=chat_id, message_id=message_id)
@@ -64,9 +80,10 @@ async def send_or_edit_message(chat_id: int, text: str, reply_markup: Optional[I
 
 
 async def get_user_data(chat_id: int) -> Optional[dict]:
+    """Compact user summary used to render menus (balance, bonus flags, referral info)."""
     async with httpx.AsyncClient(timeout=30) as client:
         try:
-            response = await client.get(f"{API_URL}/users/{chat_id}", headers={"api-key": API_KEY})
+            response = await client.get(f"{API_URL}/users/{chat_id}/summary", headers={"api-key": API_KEY})
             if response.status_code == 404:
                 logger.info(f"User {chat_id} not found in API.")
                 return None
@@ -98,3 +115,32 @@ async def create_user(chat_id: int, username: Optional[str], referral_code: Opti
         except Exception as e:
             logger.error(f"Ошибка создания пользователя {chat_id}: {e}")
             return None
+
+
+async def fetch_blob(client: httpx.AsyncClient, blob_id: str) -> bytes:
+    response = await client.get(f"{API_URL}/blobs/{blob_id}", headers={"api-key": API_KEY})
+    response.raise_for_status()
+    return response.content
+
+
+async def run_generation_job(client: httpx.AsyncClient, chat_id: int, files: dict) -> dict:
+    response = await client.post(f"{API_URL}/generate/jobs", headers={"api-key": API_KEY}, files=files,
+                                 data={"chat_id": chat_id, "transport": IMAGE_TRANSPORT})
+    if response.status_code in (402, 409, 429):
+        return {"status": "failed", "error_status_code": response.status_code,
+                "retry_after": parse_retry_after(response)}
+    response.raise_for_status()
+    job = response.json()
+    job_id = job["job_id"]
+    logger.info(f"Generation job {job_id} queued for {chat_id}")
+
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + GENERATION_JOB_TIMEOUT_SECONDS
+    while job.get("status") not in ("done", "failed"):
+        if loop.time() > deadline:
+            raise asyncio.TimeoutError(f"Generation job {job_id} did not finish in time")
+        await asyncio.sleep(GENERATION_JOB_POLL_INTERVAL_SECONDS)
+        response = await client.get(f"{API_URL}/generate/jobs/{job_id}", headers={"api-key": API_KEY})
+        response.raise_for_status()
+        job = response.json()
+    return job
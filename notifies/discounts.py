@@ -1,10 +1,26 @@
 from datetime import datetime, timedelta
 
+import httpx
 import telegram
 from motor.motor_asyncio import AsyncIOMotorCollection
 
 from .bot import send_telegram_message_direct
-from .config import DISCOUNT_DELAY_HOURS, logger
+from .config import API_URL, API_KEY, DISCOUNT_DELAY_HOURS, logger
+
+
+async def mark_discount_offered(users_collection: AsyncIOMotorCollection, chat_id: int):
+    """Marks the offer through the backend API so the backend drops its cached user profile. Falls back to a direct
+    write (the profile then refreshes after its cache TTL) so the offer is not sent again on the next check."""
+    if API_URL:
+        async with httpx.AsyncClient(timeout=15) as client:
+            try:
+                response = await client.put(f"{API_URL}/users/{chat_id}/mark_discount_offered",
+                                            headers={"api-key": API_KEY})
+                response.raise_for_status()
+                return
+            except Exception as e:
+                logger.warning(f"Worker: Failed to mark discount offered for {chat_id} via API: {e}")
+    await users_collection.update_one({"chat_id": chat_id}, {"$set": {"discount_offered": True}})
 
 
 async def check_and_send_discount_offers(users_collection: AsyncIOMotorCollection, tg_bot_instance: telegram.Bot):
@@ -31,7 +47,7 @@ async def check_and_send_discount_offers(users_collection: AsyncIOMotorCollectio
             success = await send_telegram_message_direct(tg_bot_instance, chat_id, discount_text)
 
             if success:
-                await users_collection.update_one({"chat_id": chat_id}, {"$set": {"discount_offered": True}})
+                await mark_discount_offered(users_collection, chat_id)
                 logger.info(f"Discount offer sent to {chat_id} and marked in DB.")
             else:
                 logger.warning(f"Worker: Failed to send discount offer to {chat_id}.")
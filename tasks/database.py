@@ -9,14 +9,18 @@ logger = logging.getLogger(__name__)
 client = None
 db = None
 users_collection = None
+payments_collection = None
+stats_rollups_collection = None
 
 
 async def connect_db():
-    global client, db, users_collection
+    global client, db, users_collection, payments_collection, stats_rollups_collection
     try:
         client = AsyncIOMotorClient(MONGO_URI, serverSelectionTimeoutMS=10000)
         db = client[MONGO_DB_NAME]
         users_collection = db.users
+        payments_collection = db.payments
+        stats_rollups_collection = db.stats_rollups
         await client.admin.command('ping')
         logger.info(f"Connected to MongoDB")
         return users_collection
@@ -32,6 +36,20 @@ async def get_users_collection():
     return users_collection
 
 
+async def get_payments_collection():
+    global payments_collection
+    if payments_collection is None:
+        await connect_db()
+    return payments_collection
+
+
+async def get_stats_rollups_collection():
+    global stats_rollups_collection
+    if stats_rollups_collection is None:
+        await connect_db()
+    return stats_rollups_collection
+
+
 async def close_db_connection():
     global client
     if client:
@@ -1,5 +1,6 @@
 import asyncio
 import uuid
+from datetime import datetime
 
 import httpx
 from telegram import InlineKeyboardMarkup, InlineKeyboardButton
@@ -10,18 +11,25 @@ from yookassa.domain.exceptions import NotFoundError as YooKassaNotFoundError
 from .bots import send_user_notification, send_admin_notification
 from .config import (YOOKASSA_SHOP_ID, YOOKASSA_SECRET_KEY, API_URL, API_KEY, EMOJI_PARTY, EMOJI_SAD, EMOJI_CHECK,
                      EMOJI_CROSS, EMOJI_WARNING, EMOJI_MAGIC_WAND, pluralize_ozhivashki, logger)
-from .database import get_users_collection
+from .database import get_payments_collection, get_stats_rollups_collection
 
 YooKassaConfig.account_id = YOOKASSA_SHOP_ID
 YooKassaConfig.secret_key = YOOKASSA_SECRET_KEY
 
+HIGH_LTV_THRESHOLD = 1000.0
+FAILED_PAYMENT_STATUSES = ("failed", "canceled")
+# Payments still to be checked in YooKassa: not final yet, or succeeded without ozhivashki credited.
+UNPROCESSED_PAYMENTS_QUERY = {"$or": [{"status": {"$nin": ["succeeded", "canceled"]}},
+                                      {"status": "succeeded", "generations_added": {"$ne": True}}]}
 
-async def add_ozhivashki_via_api(chat_id: int, amount: int) -> bool:
+
+async def add_ozhivashki_via_api(chat_id: int, amount: int, payment_id: str) -> bool:
     if amount <= 0: return False
     async with httpx.AsyncClient(timeout=15) as client:
         try:
+            # payment_id makes the credit idempotent on the backend, so a retry after a timeout never credits twice.
             response = await client.post(f"{API_URL}/users/{chat_id}/add_ozhivashki/{amount}",
-                headers={"api-key": API_KEY})
+                params={"payment_id": payment_id}, headers={"api-key": API_KEY})
             response.raise_for_status()
             logger.info(f"Successfully called API to add {amount} ozhivashki for {chat_id}")
             return True
@@ -34,154 +42,207 @@ async def add_ozhivashki_via_api(chat_id: int, amount: int) -> bool:
         return False
 
 
+async def retry_payment_credit(payments_collection, payment_info: dict):
+    """Retries crediting ozhivashki for a payment that is already succeeded in the DB but whose credit failed.
+    YooKassa is not queried again: the success is final."""
+    payment_id = payment_info["_id"]
+    chat_id = payment_info["chat_id"]
+    quantity = payment_info.get("quantity", 0)
+    if quantity <= 0:
+        logger.error(f"Invalid quantity ({quantity}) for successful payment {payment_id}, user {chat_id}")
+        await payments_collection.update_one({"_id": payment_id}, {"$set": {"generations_added": True}})
+        return
+    if not await add_ozhivashki_via_api(chat_id, quantity, payment_id):
+        logger.warning(f"Retry of ozhivashki credit for payment {payment_id}, user {chat_id} failed, will try again")
+        return
+    await payments_collection.update_one({"_id": payment_id}, {"$set": {"generations_added": True}})
+    logger.info(f"Credited {quantity} ozhivashki for {chat_id} on retry, payment {payment_id}")
+    item_name = payment_info.get("item_name", "покупка")
+    user_markup = InlineKeyboardMarkup([[InlineKeyboardButton(
+        text=f"{EMOJI_MAGIC_WAND} Оживить еще!", callback_data="generate_drawing")]])
+    await send_user_notification(
+        chat_id, f"{EMOJI_PARTY} Оплата прошла успешно! Начислено <b>{quantity} {pluralize_ozhivashki(quantity)}</b> ({item_name}).",
+        reply_markup=user_markup)
+    await send_admin_notification(
+        f"{EMOJI_CHECK} Повторное начисление по платежу {payment_id} ({item_name}) для user {chat_id} выполнено. Начислено: {quantity}.")
+
+
+async def record_payment_status_change(payment_info: dict, new_status: str):
+    """Applies the side effects of a payment status change that was just written to the payments collection:
+    updates the backend's statistics rollups (stats_rollups). The user's has_successful_payment flag is set by
+    the backend together with the credit, so its cached profile is invalidated."""
+    payment_id = payment_info["_id"]
+    chat_id = payment_info.get("chat_id")
+    old_status = payment_info.get("status")
+    payment_info["status"] = new_status
+    if old_status == new_status:
+        return
+
+    try:
+        payments_collection = await get_payments_collection()
+        other_payments = await payments_collection.find({"chat_id": chat_id, "_id": {"$ne": payment_id}},
+                                                        {"status": 1, "price": 1}).to_list(None)
+        total = {}
+        day = {}
+        if new_status == "succeeded":
+            price = payment_info.get("price", 0)
+            previous_prices = [info.get("price", 0) for info in other_payments if info.get("status") == "succeeded"]
+            previous_revenue = sum(previous_prices)
+            total.update(total_revenue=price, total_successful_payments=1)
+            day.update(revenue=price, successful_payments=1)
+            if previous_prices:
+                total["total_repeat_payments"] = 1
+            else:
+                total["paying_users"] = 1
+            if previous_revenue <= HIGH_LTV_THRESHOLD < previous_revenue + price:
+                total["users_with_high_ltv"] = 1
+        elif new_status in FAILED_PAYMENT_STATUSES and old_status not in FAILED_PAYMENT_STATUSES:
+            if not any(info.get("status") in FAILED_PAYMENT_STATUSES for info in other_payments):
+                total["users_with_failed_payments"] = 1
+        if not total:
+            return
+
+        rollups_collection = await get_stats_rollups_collection()
+        await rollups_collection.update_one({"_id": "total"}, {"$inc": total}, upsert=True)
+        if day:
+            date = (payment_info.get("created_at") or datetime.now()).strftime("%Y-%m-%d")
+            await rollups_collection.update_one({"_id": f"day:{date}"},
+                                                {"$inc": day, "$setOnInsert": {"date": date}}, upsert=True)
+    except Exception as e:
+        logger.error(f"Failed to record status change of payment {payment_id}: {e}")
+
+
 async def check_payment_status_loop():
-    users_collection = await get_users_collection()
-    if users_collection is None:
+    payments_collection = await get_payments_collection()
+    if payments_collection is None:
         logger.critical("DB collection is None in payment loop")
         return
 
     logger.info("Payment check task started")
 
     while True:
-        processed_in_iteration = set()
         try:
-            users_cursor = users_collection.find({"yookassa_payments": {"$exists": True, "$ne": None, "$ne": {}}})
+            payments_cursor = payments_collection.find(UNPROCESSED_PAYMENTS_QUERY).sort("created_at", 1)
 
-            async for user in users_cursor:
-                chat_id = user.get("chat_id")
-                payments = user.get("yookassa_payments", {})
+            async for payment_info in payments_cursor:
+                payment_id = payment_info["_id"]
+                chat_id = payment_info.get("chat_id")
 
-                if not chat_id or not isinstance(payments, dict):
-                    logger.warning(f"Skipping user with invalid data: {user.get('_id')}")
+                if not chat_id or "status" not in payment_info:
+                    logger.warning(f"Skipping payment with invalid data: {payment_id}")
                     continue
 
-                payment_ids_to_check = list(payments.keys())
+                db_status = payment_info.get("status")
+                already_processed_success = payment_info.get("generations_added", False)
 
-                for payment_id in payment_ids_to_check:
-                    if payment_id in processed_in_iteration:
-                        continue
+                if db_status == "succeeded" and not already_processed_success:
+                    # The success branch below only runs on a status transition, so a failed credit is retried here.
+                    await retry_payment_credit(payments_collection, payment_info)
+                    continue
+
+                try:
+                    logger.debug(f"Checking YooKassa status for payment {payment_id}, user {chat_id}")
+                    payment_yookassa = YooKassaPayment.find_one(payment_id)
+                    current_yookassa_status = payment_yookassa.status
+                    logger.debug(f"YooKassa status for {payment_id} is {current_yookassa_status}")
+
+                except YooKassaNotFoundError:
+                    logger.warning(f"Payment {payment_id} (user {chat_id}) not found in YooKassa")
+                    await payments_collection.update_one({"_id": payment_id}, {
+                        "$set": {"status": "canceled", "cancellation_details": {"reason": "not_found_in_yookassa"}}})
+                    await record_payment_status_change(payment_info, "canceled")
+                    continue
+                except Exception as e:
+                    logger.error(f"Error querying YooKassa for {payment_id}, user {chat_id}: {e}")
+                    continue
 
-                    payment_info = payments.get(payment_id)
+                if current_yookassa_status != db_status:
+                    logger.info(
+                        f"Status change for {payment_id}, user {chat_id}: {db_status} -> {current_yookassa_status}")
+                    update_payload = {"$set": {"status": current_yookassa_status}}
+                    notify_user = False
+                    notify_admin = False
+                    user_message = ""
+                    admin_message = ""
+                    ozhivashki_to_add = 0
+                    user_markup = None
+                    item_name = payment_info.get("item_name", "покупка")
+
+                    if current_yookassa_status == "succeeded" and not already_processed_success:
+                        ozhivashki_to_add = payment_info.get("quantity", 0)
+
+                        if ozhivashki_to_add > 0:
+                            if await add_ozhivashki_via_api(chat_id, ozhivashki_to_add, payment_id):
+                                update_payload["$set"]["generations_added"] = True
+                                logger.info(
+                                    f"Successfully added {ozhivashki_to_add} ozhivashki for {chat_id}, payment {payment_id}")
+
+                                notify_user = True
+                                user_markup = InlineKeyboardMarkup([[InlineKeyboardButton(
+                                    text=f"{EMOJI_MAGIC_WAND} Оживить еще!", callback_data="generate_drawing")]])
+                                user_message = f"{EMOJI_PARTY} Оплата прошла успешно! Начислено <b>{ozhivashki_to_add} {pluralize_ozhivashki(ozhivashki_to_add)}</b> ({item_name})."
+
+                                notify_admin = True
+                                admin_message = f"{EMOJI_CHECK} Успешный платеж {payment_id} ({item_name}) для user {chat_id}. Начислено: {ozhivashki_to_add}."
+                            else:
+                                logger.error(
+                                    f"Failed to add ozhivashki via API for successful payment {payment_id}, user {chat_id}")
+                                notify_admin = True
+                                admin_message = f"{EMOJI_WARNING} ОШИБКА API начисления для УСПЕШНОГО платежа {payment_id}, user {chat_id}. {ozhivashki_to_add} НЕ начислены."
+                                ozhivashki_to_add = 0
+                        else:
+                            logger.error(
+                                f"Invalid quantity ({ozhivashki_to_add}) for successful payment {payment_id}, user {chat_id}")
+                            update_payload["$set"]["generations_added"] = True
+                            notify_admin = True
+                            admin_message = f"{EMOJI_WARNING} ОШИБКА: Некорректное кол-во ({ozhivashki_to_add}) для УСПЕШНОГО платежа {payment_id}, user {chat_id}."
 
-                    if not isinstance(payment_info, dict) or "status" not in payment_info:
-                        logger.warning(f"Invalid payment_info structure for {payment_id}, user {chat_id}")
-                        processed_in_iteration.add(payment_id)
-                        continue
+                    elif current_yookassa_status == "canceled":
+                        reason = payment_yookassa.cancellation_details.reason if payment_yookassa.cancellation_details else "N/A"
+                        party = payment_yookassa.cancellation_details.party if payment_yookassa.cancellation_details else "N/A"
+                        logger.info(
+                            f"Payment {payment_id} canceled for user {chat_id}. Reason: {reason}, Party: {party}")
+                        update_payload["$set"]["cancellation_details"] = {"reason": reason, "party": party}
+                        update_payload["$set"]["generations_added"] = True
 
-                    db_status = payment_info.get("status")
-                    already_processed_success = payment_info.get("generations_added", False)
+                        notify_user = True
+                        user_message = f"{EMOJI_SAD} Платеж ({item_name}) был отменен. Попробуй еще раз или напиши в поддержку, если это ошибка."
+                        notify_admin = True
+                        admin_message = f"{EMOJI_CROSS} Платеж {payment_id} отменен для user {chat_id}. Причина: {reason} ({party})."
 
-                    if db_status in ["succeeded", "canceled"] and already_processed_success:
-                        continue
-                    if db_status == "canceled":
-                        continue
+                    else:
+                        logger.info(
+                            f"Status for {payment_id} updated to {current_yookassa_status} for user {chat_id}")
 
                     try:
-                        logger.debug(f"Checking YooKassa status for payment {payment_id}, user {chat_id}")
-                        payment_yookassa = YooKassaPayment.find_one(payment_id)
-                        current_yookassa_status = payment_yookassa.status
-                        logger.debug(f"YooKassa status for {payment_id} is {current_yookassa_status}")
-
-                    except YooKassaNotFoundError:
-                        logger.warning(f"Payment {payment_id} (user {chat_id}) not found in YooKassa")
-                        await users_collection.update_one({"chat_id": chat_id}, {
-                            "$set": {f"yookassa_payments.{payment_id}.status": "canceled",
-                                f"yookassa_payments.{payment_id}.cancellation_details": {
-                                    "reason": "not_found_in_yookassa"}}})
-                        processed_in_iteration.add(payment_id)
-                        continue
-                    except Exception as e:
-                        logger.error(f"Error querying YooKassa for {payment_id}, user {chat_id}: {e}")
-                        continue
-
-                    if current_yookassa_status != db_status:
-                        logger.info(
-                            f"Status change for {payment_id}, user {chat_id}: {db_status} -> {current_yookassa_status}")
-                        update_payload = {"$set": {f"yookassa_payments.{payment_id}.status": current_yookassa_status}}
+                        await payments_collection.update_one({"_id": payment_id}, update_payload)
+                        await record_payment_status_change(payment_info, current_yookassa_status)
+                    except Exception as db_e:
+                        logger.error(f"Failed to update DB for payment {payment_id}, user {chat_id}: {db_e}")
                         notify_user = False
                         notify_admin = False
-                        user_message = ""
-                        admin_message = ""
-                        ozhivashki_to_add = 0
-                        user_markup = None
-                        item_name = payment_info.get("item_name", "покупка")
-
-                        if current_yookassa_status == "succeeded" and not already_processed_success:
-                            ozhivashki_to_add = payment_info.get("quantity", 0)
-
-                            if ozhivashki_to_add > 0:
-                                if await add_ozhivashki_via_api(chat_id, ozhivashki_to_add):
-                                    update_payload["$set"][f"yookassa_payments.{payment_id}.generations_added"] = True
-                                    logger.info(
-                                        f"Successfully added {ozhivashki_to_add} ozhivashki for {chat_id}, payment {payment_id}")
-
-                                    notify_user = True
-                                    user_markup = InlineKeyboardMarkup([[InlineKeyboardButton(
-                                        text=f"{EMOJI_MAGIC_WAND} Оживить еще!", callback_data="generate_drawing")]])
-                                    user_message = f"{EMOJI_PARTY} Оплата прошла успешно! Начислено <b>{ozhivashki_to_add} {pluralize_ozhivashki(ozhivashki_to_add)}</b> ({item_name})."
-
-                                    notify_admin = True
-                                    admin_message = f"{EMOJI_CHECK} Успешный платеж {payment_id} ({item_name}) для user {chat_id}. Начислено: {ozhivashki_to_add}."
-                                else:
-                                    logger.error(
-                                        f"Failed to add ozhivashki via API for successful payment {payment_id}, user {chat_id}")
-                                    notify_admin = True
-                                    admin_message = f"{EMOJI_WARNING} ОШИБКА API начисления для УСПЕШНОГО платежа {payment_id}, user {chat_id}. {ozhivashki_to_add} НЕ начислены."
-                                    ozhivashki_to_add = 0
-                            else:
-                                logger.error(
-                                    f"Invalid quantity ({ozhivashki_to_add}) for successful payment {payment_id}, user {chat_id}")
-                                update_payload["$set"][f"yookassa_payments.{payment_id}.generations_added"] = True
-                                notify_admin = True
-                                admin_message = f"{EMOJI_WARNING} ОШИБКА: Некорректное кол-во ({ozhivashki_to_add}) для УСПЕШНОГО платежа {payment_id}, user {chat_id}."
-
-                        elif current_yookassa_status == "canceled":
-                            reason = payment_yookassa.cancellation_details.reason if payment_yookassa.cancellation_details else "N/A"
-                            party = payment_yookassa.cancellation_details.party if payment_yookassa.cancellation_details else "N/A"
-                            logger.info(
-                                f"Payment {payment_id} canceled for user {chat_id}. Reason: {reason}, Party: {party}")
-                            update_payload["$set"][f"yookassa_payments.{payment_id}.cancellation_details"] = {
-                                "reason": reason, "party": party}
-                            update_payload["$set"][f"yookassa_payments.{payment_id}.generations_added"] = True
-
-                            notify_user = True
-                            user_message = f"{EMOJI_SAD} Платеж ({item_name}) был отменен. Попробуй еще раз или напиши в поддержку, если это ошибка."
-                            notify_admin = True
-                            admin_message = f"{EMOJI_CROSS} Платеж {payment_id} отменен для user {chat_id}. Причина: {reason} ({party})."
 
-                        else:
-                            logger.info(
-                                f"Status for {payment_id} updated to {current_yookassa_status} for user {chat_id}")
-
-                        try:
-                            await users_collection.update_one({"chat_id": chat_id}, update_payload)
-                            processed_in_iteration.add(payment_id)
-                        except Exception as db_e:
-                            logger.error(f"Failed to update DB for payment {payment_id}, user {chat_id}: {db_e}")
-                            notify_user = False
-                            notify_admin = False
-
-                        if notify_user:
-                            await send_user_notification(chat_id, user_message, reply_markup=user_markup)
-                        if notify_admin:
-                            await send_admin_notification(admin_message)
-
-                    elif current_yookassa_status == "waiting_for_capture" and db_status != "succeeded":
-                        logger.info(f"Payment {payment_id} (user {chat_id}) is waiting_for_capture")
-                        try:
-                            capture_idempotence_key = str(uuid.uuid4())
-                            capture_response = YooKassaPayment.capture(payment_id, {"amount": payment_yookassa.amount},
-                                capture_idempotence_key)
-                            logger.info(f"Capture result for {payment_id}: status {capture_response.status}")
-                            await users_collection.update_one({"chat_id": chat_id},
-                                {"$set": {f"yookassa_payments.{payment_id}.status": capture_response.status}})
-                            processed_in_iteration.add(payment_id)
-                            if capture_response.status == "succeeded":
-                                await send_admin_notification(
-                                    f"ℹ️ Платеж {payment_id} (user {chat_id}) успешно подтвержден")
-
-                        except Exception as cap_e:
-                            logger.error(f"Error capturing payment {payment_id} for user {chat_id}: {cap_e}")
+                    if notify_user:
+                        await send_user_notification(chat_id, user_message, reply_markup=user_markup)
+                    if notify_admin:
+                        await send_admin_notification(admin_message)
+
+                elif current_yookassa_status == "waiting_for_capture" and db_status != "succeeded":
+                    logger.info(f"Payment {payment_id} (user {chat_id}) is waiting_for_capture")
+                    try:
+                        capture_idempotence_key = str(uuid.uuid4())
+                        capture_response = YooKassaPayment.capture(payment_id, {"amount": payment_yookassa.amount},
+                            capture_idempotence_key)
+                        logger.info(f"Capture result for {payment_id}: status {capture_response.status}")
+                        await payments_collection.update_one({"_id": payment_id},
+                            {"$set": {"status": capture_response.status}})
+                        await record_payment_status_change(payment_info, capture_response.status)
+                        if capture_response.status == "succeeded":
+                            await send_admin_notification(
+                                f"ℹ️ Платеж {payment_id} (user {chat_id}) успешно подтвержден")
+
+                    except Exception as cap_e:
+                        logger.error(f"Error capturing payment {payment_id} for user {chat_id}: {cap_e}")
 
         except Exception as loop_e:
             logger.error(f"Critical error in payment check loop: {loop_e}")